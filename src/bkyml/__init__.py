@@ -1,11 +1,40 @@
 # -*- coding: utf-8 -*-
 # pylint: disable=missing-docstring
-from pkg_resources import get_distribution, DistributionNotFound
-
-try:
-    # Change here if project is renamed and does not equal the package name
-    # pylint: disable=invalid-name
-    dist_name = __name__
-    __version__ = get_distribution(dist_name).version
-except DistributionNotFound:  # pragma: no cover
-    __version__ = 'unknown'   # pragma: no cover
+import sys
+
+# Change here if project is renamed and does not equal the package name
+# pylint: disable=invalid-name
+dist_name = __name__
+
+
+def get_version():
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:  # pragma: no cover
+        from pkg_resources import get_distribution, DistributionNotFound \
+            as PackageNotFoundError
+
+        def version(name):
+            return get_distribution(name).version
+    try:
+        return version(dist_name)
+    except PackageNotFoundError:  # pragma: no cover
+        return 'unknown'          # pragma: no cover
+
+
+# Looking up the distribution is by far the most expensive part of importing
+# bkyml, so it only happens when __version__ is actually accessed. The
+# pipeline builders are resolved lazily as well, so the command line does not
+# import the skeleton twice.
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        if name == '__version__':
+            return get_version()
+        if name in ('Pipeline', 'PipelineWriter'):
+            from bkyml import pipeline
+            return getattr(pipeline, name)
+        raise AttributeError("module {mod!r} has no attribute {name!r}".format(
+            mod=__name__, name=name))
+else:  # pragma: no cover
+    __version__ = get_version()
+    from bkyml.pipeline import Pipeline, PipelineWriter  # noqa: E402,F401
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+'''
+    Replace ``wait`` steps by dependencies on the steps whose artifacts are needed
+
+    A ``wait`` holds back every step after it until all steps before it
+    passed, so one slow step delays everything that follows. Steps declaring
+    the artifacts they need (``--needs-artifact``) only have to wait for the
+    steps uploading them (``--artifact-paths``). A ``wait`` is removed if
+    every step between it and the next ``wait`` or ``block`` declared what it
+    needs; those steps get a ``depends_on`` on the producers of their
+    artifacts before the removed waits instead, and the producers get a
+    ``key`` if they do not have one. Dependencies across
+    ``continue_on_failure`` waits only allow the producer to fail if every
+    wait removed between producer and step continued on failure.
+
+    Artifacts are matched like ``--watch`` patterns, either side may be a
+    glob. Needed artifacts no step before produces come from before the last
+    remaining barrier or from outside the pipeline and add no dependency.
+'''
+from __future__ import division, print_function, absolute_import
+
+import re
+from collections import OrderedDict
+
+from bkyml import changes
+from bkyml import chunks
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+KEY = 'step-{number}'
+# the keys a step starts with, followed by its key and dependencies
+LEADING = ('block', 'trigger', 'label')
+
+
+def is_wait(step):
+    return step == 'wait' or isinstance(step, dict) and 'wait' in step
+
+
+def words(value):
+    if value is None:
+        return []
+    if isinstance(value, (str, dict)):
+        return [value]
+    return list(value)
+
+
+class Artifacts:
+    """Matches needed artifacts against the artifact paths of the producers"""
+
+    def __init__(self):
+        self.patterns = {}
+
+    def pattern(self, glob):
+        if glob not in self.patterns:
+            self.patterns[glob] = re.compile(changes.translate(changes.normalize(glob)))
+        return self.patterns[glob]
+
+    def match(self, need, produced):
+        """Whether ``need`` and ``produced`` can name the same file"""
+        need, produced = changes.normalize(need), changes.normalize(produced)
+        return need == produced or bool(self.pattern(produced).fullmatch(need)) or \
+            bool(self.pattern(need).fullmatch(produced))
+
+
+def removable(steps, needs):
+    """Positions of the waits after which every step up to the next barrier declared its needs"""
+    found = set()
+    candidate = None
+    for index, step in enumerate(steps):
+        if chunks.is_barrier(step):
+            if candidate is not None:
+                found.add(candidate)
+            candidate = index if is_wait(step) else None
+        elif needs[index] is None:
+            candidate = None
+    if candidate is not None and candidate < len(steps) - 1:
+        found.add(candidate)
+    return found
+
+
+def with_dependencies(step, key, depends):
+    """A copy of ``step`` with a ``key`` and more ``depends_on``, placed like the subcommands do"""
+    items = [(name, value) for name, value in step.items() if name != 'depends_on']
+    position = 0
+    while position < len(items) and items[position][0] in LEADING:
+        position += 1
+    if 'key' in step:
+        position = [name for name, _ in items].index('key') + 1
+    elif key is not None:
+        items.insert(position, ('key', key))
+        position += 1
+    depends = words(step.get('depends_on')) + (depends or [])
+    if depends:
+        single = len(depends) == 1 and isinstance(depends[0], str)
+        items.insert(position, ('depends_on', depends[0] if single else depends))
+    return OrderedDict(items)
+
+
+def eliminate(steps, needs):
+    """Replace the waits that can go by dependencies
+
+    Args:
+      steps ([dict or str]): the steps of a pipeline
+      needs ([[str]]): per step the artifacts it needs, None if it did not declare them
+
+    Returns:
+      ([dict or str], [[str]], int): the steps, their needs and the number of
+        waits removed
+    """
+    gone = removable(steps, needs)
+    taken = {step['key'] for step in steps if isinstance(step, dict) and 'key' in step}
+    artifacts = Artifacts()
+    keys = {}
+    depends = {}
+    # (index, artifact paths, segment, strict waits removed before) since the last barrier kept
+    producers = []
+    segment = strict = 0
+    for index, step in enumerate(steps):
+        if index in gone:
+            segment += 1
+            if not (isinstance(step, dict) and step.get('continue_on_failure')):
+                strict += 1
+            continue
+        if chunks.is_barrier(step):
+            producers = []
+            continue
+        if segment and needs[index]:
+            for producer, paths, produced_in, strict_before in producers:
+                if produced_in == segment or not any(
+                        artifacts.match(need, path) for need in needs[index] for path in paths):
+                    continue
+                if producer not in keys:
+                    keys[producer] = steps[producer].get('key') or new_key(producer, taken)
+                dependency = keys[producer]
+                if strict == strict_before:
+                    dependency = OrderedDict([('step', dependency), ('allow_failure', True)])
+                depends.setdefault(index, []).append(dependency)
+        paths = words(step.get('artifact_paths')) if isinstance(step, dict) else []
+        if paths:
+            producers.append((index, paths, segment, strict))
+    result, remaining = [], []
+    for index, step in enumerate(steps):
+        if index in gone:
+            continue
+        if index in keys or index in depends:
+            step = with_dependencies(step, keys.get(index), depends.get(index))
+        result.append(step)
+        remaining.append(needs[index])
+    return result, remaining, len(gone)
+
+
+def new_key(index, taken):
+    key = KEY.format(number=index + 1)
+    suffix = 1
+    while key in taken:
+        suffix += 1
+        key = KEY.format(number=index + 1) + '-%d' % suffix
+    taken.add(key)
+    return key
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+'''
+    Evaluate Buildkite branch filters while generating the pipeline
+
+    A filter is a space separated list of patterns where ``*`` matches any
+    characters, ``/`` included, and a leading ``!`` excludes the branches
+    matching the rest of the pattern. A branch passes if it matches one of
+    the other patterns, or if there are none, and none of the excluding
+    ones. Filters are compiled once into a single regular expression each and
+    steps usually share a handful of them, so both compiling and matching
+    are cached.
+'''
+from __future__ import division, print_function, absolute_import
+
+import re
+from functools import lru_cache
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+
+def translate(pattern):
+    """Regular expression source for one pattern, without the ``!``"""
+    return '.*'.join(re.escape(part) for part in pattern.split('*'))
+
+
+@lru_cache(maxsize=None)
+def compile_filter(branches):
+    """Compile a filter into ``(including, excluding)`` regular expressions
+
+    Args:
+      branches (str): the patterns, as in the ``branches`` attribute of a step
+
+    Returns:
+      tuple: a compiled expression each, None for no patterns of that kind
+    """
+    including, excluding = [], []
+    for pattern in branches.split():
+        if pattern.startswith('!'):
+            excluding.append(translate(pattern[1:]))
+        else:
+            including.append(translate(pattern))
+    return tuple(re.compile('(?:%s)\\Z' % '|'.join(patterns), re.S) if patterns else None
+                 for patterns in (including, excluding))
+
+
+@lru_cache(maxsize=4096)
+def matches(branches, branch):
+    """Whether Buildkite would run a step with filter ``branches`` on ``branch``"""
+    including, excluding = compile_filter(branches)
+    if including is not None and not including.match(branch):
+        return False
+    return excluding is None or not excluding.match(branch)
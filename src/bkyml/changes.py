@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+'''
+    Match ``--watch`` patterns against the paths a change touches
+
+    The changed paths are kept sorted and joined into one string. A pattern
+    only looks at the paths below its literal leading directories, which
+    bisecting the sorted paths finds, and searches all of them with one
+    compiled regular expression instead of trying path after path with
+    :mod:`fnmatch`. Results are cached per pattern, so steps sharing their
+    patterns cost a dictionary lookup.
+'''
+from __future__ import division, print_function, absolute_import
+
+import bisect
+import re
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+MAGIC = re.compile(r'[*?[]')
+
+
+def normalize(path):
+    """``path`` without surrounding whitespace, leading ``./`` and slashes"""
+    path = path.strip()
+    while path.startswith('./'):
+        path = path[2:]
+    return path.strip('/')
+
+
+def translate(pattern):
+    """Regular expression source for a glob that never matches a newline
+
+    ``*``, ``?`` and ``[...]`` stay within a directory, ``**/`` matches any
+    number of directories and any other ``**`` anything at all.
+    """
+    parts = []
+    index, end = 0, len(pattern)
+    while index < end:
+        char = pattern[index]
+        index += 1
+        if char == '*' and pattern.startswith('*/', index):
+            parts.append('(?:[^\n]*/)?')
+            index += 2
+        elif char == '*' and pattern.startswith('*', index):
+            parts.append('[^\n]*')
+            index += 1
+        elif char == '*':
+            parts.append('[^/\n]*')
+        elif char == '?':
+            parts.append('[^/\n]')
+        elif char == '[':
+            close = index
+            if close < end and pattern[close] == '!':
+                close += 1
+            if close < end and pattern[close] == ']':
+                close += 1
+            close = pattern.find(']', close)
+            if close < 0:
+                parts.append('\\[')
+                continue
+            chars = pattern[index:close].replace('\\', '\\\\')
+            index = close + 1
+            if chars.startswith('!'):
+                parts.append('[^%s/\n]' % chars[1:])
+            elif chars.startswith('^'):
+                parts.append('[\\%s]' % chars)
+            else:
+                parts.append('[%s]' % chars)
+        else:
+            parts.append(re.escape(char))
+    return ''.join(parts)
+
+
+class ChangeIndex:
+    """The paths a change touches, ready to be matched against patterns
+
+    A pattern matches a path if it matches the whole path or one of the
+    directories the path is in, so ``packages/a`` and ``packages/*`` both
+    match ``packages/a/setup.py``.
+
+    Args:
+      paths ([str]): the changed paths, e.g. ``git diff --name-only``
+    """
+
+    def __init__(self, paths):
+        self.paths = sorted({path for path in map(normalize, paths) if path})
+        self.text = '\n'.join(self.paths)
+        # offset of every path in text, and one past the end
+        self.offsets = [0]
+        for path in self.paths:
+            self.offsets.append(self.offsets[-1] + len(path) + 1)
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.paths)
+
+    @classmethod
+    def load(cls, path):
+        """The index of the lines of the file at ``path``, or of stdin for ``-``"""
+        # imported here as only --changed-files needs it
+        from bkyml import sharding
+        return cls(line.decode('utf-8', 'surrogateescape') for line in sharding.read_lines(path))
+
+    def below(self, directory):
+        """Positions of the first path below ``directory`` and of the first one after them"""
+        if not directory:
+            return 0, len(self.paths)
+        # '0' sorts right after '/'
+        return (bisect.bisect_left(self.paths, directory + '/'),
+                bisect.bisect_left(self.paths, directory + '0'))
+
+    def match(self, pattern):
+        """The first changed path ``pattern`` matches, None if there is none"""
+        pattern = normalize(pattern)
+        if pattern not in self.cache:
+            self.cache[pattern] = self.search(pattern)
+        return self.cache[pattern]
+
+    def search(self, pattern):
+        parts = pattern.split('/')
+        literal = 0
+        while literal < len(parts) and not MAGIC.search(parts[literal]):
+            literal += 1
+        if literal == len(parts):
+            position = bisect.bisect_left(self.paths, pattern)
+            if position < len(self.paths) and self.paths[position] == pattern:
+                return pattern
+            start, stop = self.below(pattern)
+            return self.paths[start] if start < stop else None
+        start, stop = self.below('/'.join(parts[:literal]))
+        if start == stop:
+            return None
+        regexp = re.compile('^%s(?:/[^\n]*)?$' % translate(pattern), re.M)
+        found = regexp.search(self.text, self.offsets[start], self.offsets[stop] - 1)
+        return found.group() if found else None
+
+    def watched(self, patterns):
+        """The first changed path any of ``patterns`` matches, None if there is none"""
+        for pattern in patterns:
+            path = self.match(pattern)
+            if path is not None:
+                return path
+        return None
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+'''
+    Split a pipeline into fragment files of bounded size
+
+    Every fragment is a complete pipeline: it repeats the comments and the
+    ``env`` of the pipeline and holds a run of its steps, in order. Fragments
+    are cut between steps once the next step would take them past the
+    maximum number of steps or bytes. A ``wait`` or ``block`` barrier starts
+    the fragment of the steps it guards, so no fragment ends in a barrier
+    unless it has room for nothing else. A manifest lists the fragments in
+    the order they have to be uploaded.
+
+    Example::
+
+        from bkyml.chunks import Chunker
+        from bkyml.skeleton import YAML
+
+        chunker = Chunker(YAML, 'fragments', max_steps=500)
+        for step in steps:
+            chunker.add('step', step)
+        manifest = chunker.close()
+'''
+from __future__ import division, print_function, absolute_import
+
+import logging
+import os
+
+from bkyml import formats
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+LOGGER = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.txt'
+NAME = 'pipeline-{number:04d}{extension}'
+
+
+def is_barrier(step):
+    """Whether a step waits for the steps before it"""
+    if isinstance(step, dict):
+        return 'wait' in step or 'block' in step
+    return step == 'wait'
+
+
+class Chunker:
+    """Collects the parts of a pipeline and writes them to fragment files
+
+    Args:
+      fmt (:obj:`bkyml.formats.Format`): the output format
+      directory (str): where the fragments and the manifest are written
+      max_steps (int): at most this many steps per fragment, None for any
+      max_bytes (int): at most this many bytes per fragment, None for any; a
+        single step larger than that gets a fragment of its own
+      written (callable): called with the path of every fragment once it
+        was written, e.g. to upload it while the next one is rendered
+    """
+
+    def __init__(self, fmt, directory, max_steps=None, max_bytes=None, written=None):
+        self.format = fmt
+        self.directory = directory
+        self.max_steps = max_steps
+        self.max_bytes = max_bytes
+        self.written = written
+        self.extension = '.json' if fmt.name == 'json' else '.yml'
+        self.header = formats.Document()
+        self.header_size = None
+        self.steps = []
+        self.sizes = []
+        self.total = 0
+        self.paths = []
+
+    def add(self, kind, data):
+        if kind == 'step':
+            if data is not None:
+                self.step(data)
+            return
+        if self.header_size is not None:
+            raise ValueError('%s has to come before the steps to split a pipeline' % kind)
+        self.header.add(kind, data)
+
+    def size(self, step):
+        """Bytes ``step`` adds to a fragment"""
+        if self.format.streamable:
+            text = self.format.to_string([step]) + '\n'
+        else:
+            text = self.format.to_string(step) + self.format.separator
+        return len(text.encode('utf-8', 'surrogateescape'))
+
+    def step(self, step):
+        if self.header_size is None:
+            self.header.has_steps = True
+            self.header_size = len(self.format.document(self.header)
+                                   .encode('utf-8', 'surrogateescape'))
+        size = self.size(step) if self.max_bytes is not None else 0
+        if self.steps and self.full(size):
+            self.cut()
+        self.steps.append(step)
+        self.sizes.append(size)
+        self.total += size
+
+    def full(self, size):
+        if self.max_steps is not None and len(self.steps) + 1 > self.max_steps:
+            return True
+        return self.max_bytes is not None and \
+            self.header_size + self.total + size > self.max_bytes
+
+    def cut(self):
+        """Write all but the trailing barriers, which start the next fragment"""
+        end = len(self.steps)
+        while end and is_barrier(self.steps[end - 1]):
+            end -= 1
+        if not end:
+            # nothing but barriers, they can only go together
+            end = len(self.steps)
+        self.write(self.steps[:end])
+        self.steps, self.sizes = self.steps[end:], self.sizes[end:]
+        self.total = sum(self.sizes)
+
+    def write(self, steps):
+        document = formats.Document()
+        document.comments = self.header.comments
+        document.env = self.header.env
+        document.has_steps = True
+        document.steps = steps
+        path = os.path.join(self.directory, NAME.format(number=len(self.paths) + 1,
+                                                        extension=self.extension))
+        text = self.format.document(document)
+        if self.max_bytes is not None and len(steps) == 1 and \
+           len(text.encode('utf-8', 'surrogateescape')) > self.max_bytes:
+            LOGGER.warning('%s holds a single step larger than %d bytes', path, self.max_bytes)
+        with open(path, 'w', encoding='utf-8', errors='surrogateescape') as stream:
+            stream.write(text)
+        self.paths.append(path)
+        if self.written is not None:
+            self.written(path)
+
+    def close(self):
+        """Write the last fragment and the manifest
+
+        Returns:
+          [str]: the paths of the fragments, in upload order
+        """
+        if self.steps or not self.paths:
+            self.write(self.steps)
+            self.steps, self.sizes, self.total = [], [], 0
+        with open(os.path.join(self.directory, MANIFEST), 'w') as stream:
+            stream.write(''.join(path + '\n' for path in self.paths))
+        return self.paths
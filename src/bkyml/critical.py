@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+'''
+    Find the steps that decide how long a build takes
+
+    A step starts once the ``wait`` or ``block`` barrier before it and the
+    steps it depends on finished, a barrier once every step before it
+    finished (see :mod:`bkyml.graph`). Given how long every step takes and
+    enough agents to start every step as soon as it can, :class:`Analysis`
+    finds the earliest start of every step, the longest chain of steps
+    through the pipeline - its critical path, as long as the build at
+    least takes - and the slack of every step: how much later it could
+    finish without the build taking longer. Barriers take no time, the
+    time a ``block`` waits to be unblocked is not known.
+
+    :func:`prioritize` gives the command steps with little slack a
+    ``priority`` and orders the steps between two barriers by how long the
+    build takes from their start on, longest first, so agents pick up the
+    steps the build waits for first.
+
+    Example::
+
+        from bkyml import critical
+
+        analysis = critical.Analysis(steps, critical.durations(steps, timings)[0])
+        steps, order = critical.prioritize(steps, analysis)
+'''
+from __future__ import division, print_function, absolute_import
+
+from collections import OrderedDict
+
+from bkyml import chunks
+from bkyml import graph
+from bkyml import incremental
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+PRIORITY = 1
+# durations are summed up, so compare them with a little tolerance
+TOLERANCE = 1e-9
+
+
+def names(step):
+    """The names the duration of a step is looked up by, most specific first"""
+    if not isinstance(step, dict):
+        return []
+    found = [step[name] for name in ('key', 'label', 'trigger')
+             if isinstance(step.get(name), str)]
+    found.append(incremental.identity(step))
+    return found
+
+
+def durations(steps, timings, estimates=None, default=None):
+    """How long every step takes
+
+    Durations from previous builds come before the estimates of the steps.
+
+    Args:
+      steps ([dict or str]): the steps of a pipeline
+      timings (dict): step key, label or identity to seconds
+      estimates ([float]): per step its ``--estimate``, None if it has none
+      default (float): seconds of the steps with neither, defaults to the
+        mean of the other steps
+
+    Returns:
+      ([float], int, float): the durations, none for barriers, the number
+        of steps that took the default and the default
+    """
+    estimates = estimates or [None] * len(steps)
+    found = []
+    for step, estimate in zip(steps, estimates):
+        if chunks.is_barrier(step):
+            found.append(0.0)
+            continue
+        known = [timings[name] for name in names(step) if name in timings]
+        found.append(known[0] if known else estimate)
+    known = [duration for duration, step in zip(found, steps)
+             if duration is not None and not chunks.is_barrier(step)]
+    if default is None:
+        default = sum(known) / len(known) if known else 0.0
+    missing = found.count(None)
+    return [default if duration is None else duration for duration in found], missing, default
+
+
+def predecessors(steps):
+    """Per step the positions of the steps it waits for"""
+    keys = {step['key']: index for index, step in enumerate(steps)
+            if isinstance(step, dict) and 'key' in step}
+    found = []
+    barrier, since = None, []
+    for index, step in enumerate(steps):
+        before = [] if barrier is None else [barrier]
+        if chunks.is_barrier(step):
+            before.extend(since)
+            barrier, since = index, []
+        else:
+            since.append(index)
+        if isinstance(step, dict):
+            before.extend(keys[key] for key in graph.dependencies(step.get('depends_on'))
+                          if key in keys)
+        found.append(before)
+    return found
+
+
+class Analysis:
+    """The schedule of a pipeline with enough agents to start every step once it can
+
+    Args:
+      steps ([dict or str]): the steps of a pipeline
+      durations ([float]): seconds every step takes
+
+    Raises:
+      ValueError: if a dependency is on an unknown key or goes round in a circle
+
+    Attributes:
+      start ([float]): the earliest start of every step
+      tail ([float]): how long the build takes from the start of every step on
+      slack ([float]): how much later every step could finish without the
+        build taking longer
+      duration (float): the least time the build takes
+      path ([int]): the positions of the steps along the critical path
+    """
+
+    def __init__(self, steps, durations):
+        graph.validate(steps)
+        self.steps = steps
+        self.durations = durations
+        before = predecessors(steps)
+        after = [[] for _ in steps]
+        for index, found in enumerate(before):
+            for other in found:
+                after[other].append(index)
+        order = self.order(before, after)
+        self.start = [0.0] * len(steps)
+        for index in order:
+            self.start[index] = max((self.start[other] + durations[other]
+                                     for other in before[index]), default=0.0)
+        self.tail = [0.0] * len(steps)
+        for index in reversed(order):
+            self.tail[index] = durations[index] + max(
+                (self.tail[other] for other in after[index]), default=0.0)
+        self.duration = max(self.tail, default=0.0)
+        self.slack = [max(0.0, self.duration - start - tail)
+                      for start, tail in zip(self.start, self.tail)]
+        self.path = self.critical(after)
+
+    @staticmethod
+    def order(before, after):
+        """The positions of the steps, every step after the steps it waits for"""
+        pending = [len(found) for found in before]
+        ready = [index for index, count in enumerate(pending) if not count]
+        ready.reverse()
+        found = []
+        while ready:
+            index = ready.pop()
+            found.append(index)
+            for other in after[index]:
+                pending[other] -= 1
+                if not pending[other]:
+                    ready.append(other)
+        return found
+
+    def close(self, value, other):
+        return abs(value - other) <= TOLERANCE * max(1.0, self.duration)
+
+    def critical(self, after):
+        if not self.steps:
+            return []
+        index = next(index for index, tail in enumerate(self.tail)
+                     if self.close(self.start[index], 0.0) and self.close(tail, self.duration))
+        path = [index]
+        while True:
+            rest = self.tail[index] - self.durations[index]
+            index = next((other for other in after[index]
+                          if self.close(self.tail[other], rest)), None)
+            if index is None:
+                return path
+            path.append(index)
+
+    def critical_steps(self, max_slack=0.0):
+        """The positions of the steps with no more than ``max_slack`` seconds of slack"""
+        return [index for index, slack in enumerate(self.slack)
+                if slack <= max_slack or self.close(slack, max_slack)]
+
+
+def takes_priority(step):
+    """Whether a step runs a job a ``priority`` applies to"""
+    return isinstance(step, dict) and not chunks.is_barrier(step) and \
+        'trigger' not in step and 'priority' not in step
+
+
+def prioritize(steps, analysis, max_slack=0.0, priority=PRIORITY):
+    """Give the command steps close to the critical path a priority, longest first
+
+    Steps that have a ``priority`` already keep it. Barriers stay where
+    they are, the steps between them are ordered by
+    :attr:`Analysis.tail`, longest first and in their order otherwise.
+
+    Returns:
+      ([dict or str], [int]): the steps and their positions before
+    """
+    critical = set(analysis.critical_steps(max_slack))
+    order, segment = [], []
+    for index, step in enumerate(steps):
+        if chunks.is_barrier(step):
+            order.extend(sorted(segment, key=lambda other: -analysis.tail[other]))
+            order.append(index)
+            segment = []
+        else:
+            segment.append(index)
+    order.extend(sorted(segment, key=lambda other: -analysis.tail[other]))
+    result = []
+    for index in order:
+        step = steps[index]
+        if index in critical and takes_priority(step):
+            step = OrderedDict(step)
+            step['priority'] = priority
+        result.append(step)
+    return result, order
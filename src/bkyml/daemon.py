@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+'''
+    Long-lived bkyml process answering requests over a local Unix socket,
+    plus the thin client used by ``bkyml --via-daemon`` / ``BKYML_SOCKET``
+'''
+from __future__ import division, print_function, absolute_import
+
+import io
+import json
+import os
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+SOCKET_ENV = 'BKYML_SOCKET'
+VIA_DAEMON_FLAG = '--via-daemon'
+DEFAULT_IDLE_TIMEOUT = 600
+SPAWN_TIMEOUT = 5.0
+# seconds the daemon waits for a client to send its request or read the reply
+CONNECTION_TIMEOUT = 10.0
+RECV_SIZE = 65536
+# options before the subcommand that take a value
+OPTIONS_WITH_VALUE = ('--format', '--changed-files', '--resolve-branches')
+# options before the subcommand that read stdin for -
+STDIN_OPTIONS = ('--changed-files',)
+# subcommands reading stdin unless the option names a file
+STDIN_SUBCOMMANDS = {'batch': '--file', 'shard': '--files', 'split': '--files'}
+# environment variables of the client a request runs with, e.g.
+# $BUILDKITE_PARALLEL_JOB for split or $BKYML_CACHE_DIR
+ENV_PREFIXES = ('BUILDKITE_', 'BKYML_')
+
+
+def private_directory():
+    """A directory only the current user can access
+
+    ``$XDG_RUNTIME_DIR`` if set, otherwise ``bkyml-<uid>`` in the temp
+    directory, which is created with mode 0700 and rejected if somebody else
+    owns it or can access it.
+    """
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        return runtime
+    path = os.path.join(tempfile.gettempdir(), 'bkyml-{uid}'.format(uid=os.getuid()))
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() \
+       or info.st_mode & 0o077:
+        raise PermissionError('%s is not a private directory of the current user' % path)
+    return path
+
+
+def default_socket_path():
+    return os.environ.get(SOCKET_ENV) or os.path.join(private_directory(), 'bkyml.sock')
+
+
+def wants_daemon(argv):
+    """Whether a command line should be forwarded to the daemon
+
+    Args:
+      argv ([str]): command line parameters (without the program name)
+    """
+    if argv and argv[0] == 'serve':
+        return False
+    return VIA_DAEMON_FLAG in argv or bool(os.environ.get(SOCKET_ENV))
+
+
+def reads_stdin(argv):
+    """Whether a command line reads stdin, e.g. a ``batch`` without ``--file``"""
+    args = iter(argv)
+    for arg in args:
+        if arg in OPTIONS_WITH_VALUE:
+            if next(args, None) == '-' and arg in STDIN_OPTIONS:
+                return True
+        elif arg.endswith('=-') and arg[:-2] in STDIN_OPTIONS:
+            return True
+        elif not arg.startswith('-'):
+            if arg not in STDIN_SUBCOMMANDS:
+                return False
+            option = STDIN_SUBCOMMANDS[arg]
+            break
+    else:
+        return False
+    source = '-'
+    for arg in args:
+        if arg == option:
+            source = next(args, '-')
+        elif arg.startswith(option + '='):
+            source = arg[len(option) + 1:]
+    return source == '-'
+
+
+def forwarded_env(environ=None):
+    """The variables of ``environ`` (default: ``os.environ``) sent along with a request"""
+    environ = os.environ if environ is None else environ
+    return {name: value for name, value in environ.items()
+            if name.startswith(ENV_PREFIXES) and name != SOCKET_ENV}
+
+
+def use_env(env):
+    """Make the forwarded variables of ``os.environ`` exactly those of ``env``"""
+    for name in forwarded_env():
+        if name not in env:
+            del os.environ[name]
+    os.environ.update(env)
+
+
+def peer_uid(sock):
+    """User id of the other end of a Unix socket, None if the OS can not tell"""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                  struct.calcsize('3i'))
+    return struct.unpack('3i', credentials)[1]
+
+
+def check_owner(path, sock):
+    """Refuse to talk to a socket or peer belonging to another user"""
+    uid = os.getuid()
+    if os.stat(path).st_uid != uid or peer_uid(sock) not in (None, uid):
+        raise PermissionError('%s does not belong to the current user' % path)
+
+
+class LatencyHistogram:
+    """Latency histogram with power-of-two buckets in microseconds"""
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        micros = max(1, int(seconds * 1e6))
+        bucket = 1 << (micros - 1).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'buckets': sorted(self.buckets.items()),
+        }
+
+    @staticmethod
+    def format(stats):
+        lines = ['requests: {count}'.format(count=stats['count'])]
+        if stats['count']:
+            lines.append('mean: {mean:.3f} ms'.format(
+                mean=stats['total'] * 1000 / stats['count']))
+        peak = max([count for _, count in stats['buckets']] or [1])
+        for bucket, count in stats['buckets']:
+            lines.append('<= {ms:>10.3f} ms {count:>8} {bar}'.format(
+                ms=bucket / 1000,
+                count=count,
+                bar='#' * max(1, count * 40 // peak)))
+        return '\n'.join(lines)
+
+
+def listening(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except (OSError, socket.error):
+        return False
+    finally:
+        sock.close()
+
+
+def _send(sock, payload):
+    sock.sendall(json.dumps(payload).encode('utf-8'))
+    sock.shutdown(socket.SHUT_WR)
+
+
+def _receive(sock):
+    """Read a JSON payload until the peer shuts down its side
+
+    Returns:
+      dict: the payload or None if the peer sent nothing
+    """
+    chunks = []
+    while True:
+        chunk = sock.recv(RECV_SIZE)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    if not chunks:
+        return None
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+
+class Server:
+    """Serve render requests sequentially with a warm parser and emitter
+
+    Args:
+      path (str): path of the Unix socket to listen on
+      handler (callable): renders an argument list, returns the output or None
+      idle_timeout (float): seconds without a request after which to exit
+    """
+
+    def __init__(self, path, handler, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.path = path
+        self.handler = handler
+        self.idle_timeout = idle_timeout
+        self.histogram = LatencyHistogram()
+        self.running = False
+
+    def dispatch(self, request):
+        if request.get('stats'):
+            return {'status': 0, 'stats': self.histogram.as_dict()}
+        if request.get('shutdown'):
+            self.running = False
+            return {'status': 0, 'stdout': '', 'stderr': ''}
+
+        started = time.time()
+        stdout, stderr = io.StringIO(), io.StringIO()
+        saved = sys.stdin, sys.stdout, sys.stderr
+        cwd = os.getcwd()
+        env = forwarded_env()
+        status = 0
+        try:
+            sys.stdin = io.StringIO(request.get('stdin') or '')
+            sys.stdout, sys.stderr = stdout, stderr
+            os.chdir(request.get('cwd') or cwd)
+            if request.get('env') is not None:
+                use_env(request['env'])
+            output = self.handler(request['argv'])
+            if output is not None:
+                print(output)
+        except SystemExit as err:
+            if err.code is None or isinstance(err.code, int):
+                status = err.code or 0
+            else:
+                print(err.code, file=stderr)
+                status = 1
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc(file=stderr)
+            status = 1
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = saved
+            os.chdir(cwd)
+            use_env(env)
+        self.histogram.add(time.time() - started)
+        return {
+            'status': status,
+            'stdout': stdout.getvalue(),
+            'stderr': stderr.getvalue(),
+        }
+
+    def bind(self):
+        if os.path.exists(self.path):
+            if listening(self.path):
+                raise RuntimeError('bkyml daemon already listening on %s' % self.path)
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        sock.listen(16)
+        sock.settimeout(self.idle_timeout)
+        return sock
+
+    def serve_connection(self, conn):
+        conn.settimeout(CONNECTION_TIMEOUT)
+        if peer_uid(conn) not in (None, os.getuid()):
+            return
+        try:
+            payload = _receive(conn)
+        except ValueError as err:
+            response = {'status': 2, 'stdout': '', 'stderr': str(err) + '\n'}
+        else:
+            if payload is None:
+                # somebody checking whether the daemon is listening
+                return
+            response = self.dispatch(payload)
+        conn.sendall(json.dumps(response).encode('utf-8'))
+
+    def serve_forever(self, sock=None):
+        sock = sock or self.bind()
+        self.running = True
+        try:
+            while self.running:
+                try:
+                    conn, _ = sock.accept()
+                except socket.timeout:
+                    break
+                with conn:
+                    try:
+                        self.serve_connection(conn)
+                    except (OSError, socket.error):
+                        # a client that disconnected early or timed out
+                        # must not take the daemon down
+                        pass
+        finally:
+            sock.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+def spawn(path, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    """Start a detached daemon listening on ``path``"""
+    with open(os.devnull, 'r+b') as devnull:
+        subprocess.Popen(
+            [sys.executable, '-m', 'bkyml.skeleton', 'serve',
+             '--socket', path,
+             '--idle-timeout', str(idle_timeout)],
+            stdin=devnull, stdout=devnull, stderr=devnull,
+            start_new_session=True,
+            env=dict(os.environ, **{SOCKET_ENV: ''}))
+
+
+def request(payload, path=None, autospawn=True):
+    """Send one request to the daemon, spawning it if nobody listens
+
+    Returns:
+      dict: the decoded response
+    """
+    path = path or default_socket_path()
+    deadline = None
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            break
+        except (OSError, socket.error):
+            sock.close()
+            if not autospawn:
+                raise
+            if deadline is None:
+                spawn(path)
+                deadline = time.time() + SPAWN_TIMEOUT
+            elif time.time() > deadline:
+                raise
+            time.sleep(0.01)
+    with sock:
+        check_owner(path, sock)
+        _send(sock, payload)
+        return _receive(sock)
+
+
+def forward(argv, path=None):
+    """Run a command line through the daemon and print its output
+
+    Args:
+      argv ([str]): command line parameters (without the program name)
+
+    Returns:
+      int: exit status of the remote invocation
+    """
+    argv = [arg for arg in argv if arg != VIA_DAEMON_FLAG]
+    stdin = None
+    if reads_stdin(argv) and not sys.stdin.isatty():
+        stdin = sys.stdin.read()
+    response = request({'argv': argv, 'cwd': os.getcwd(), 'stdin': stdin,
+                        'env': forwarded_env()}, path)
+    sys.stdout.write(response.get('stdout', ''))
+    sys.stderr.write(response.get('stderr', ''))
+    return response.get('status', 1)
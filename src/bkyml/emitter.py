@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+'''
+    Fast block YAML emitter for the fixed shapes of Buildkite step documents
+
+    Produces byte-identical output to ruamel.yaml's round-trip dumper for
+    mappings, lists, strings, ints, bools and None. Anything it can not
+    reproduce exactly raises :class:`Unsupported` so the caller can fall back
+    to ruamel.yaml.
+'''
+from __future__ import division, print_function, absolute_import
+
+import functools
+import io
+import json
+import re
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+BEST_WIDTH = 80
+MAX_SIMPLE_KEY_LENGTH = 128
+# ruamel's round-trip dumper counts the ``!!str`` tag of a key towards
+# MAX_SIMPLE_KEY_LENGTH, longer keys are written as ``? key`` / ``: value``
+SIMPLE_KEY_LENGTH = MAX_SIMPLE_KEY_LENGTH - len('!!str')
+
+WHITESPACE = '\0 \t\r\n\x85\u2028\u2029'
+BREAKS = '\n\x85\u2028\u2029'
+LEADING_INDICATORS = '#,[]{}&*!|>\'"%@`'
+FLOW_UNSAFE = ':#,[]{}'
+# strings made of these characters need no analysis to be emitted plain
+SAFE_PLAIN = re.compile(r'[A-Za-z0-9_/][A-Za-z0-9_./=+ -]*\Z')
+WORDS = re.compile(r' +|[^ ]+')
+# how ruamel.yaml folds plain scalars changed between releases: whether a single
+# space at exactly BEST_WIDTH breaks the line and whether a word that would run
+# past BEST_WIDTH starts a new line
+FOLDING_RULES = [(at_width, long_words)
+                 for at_width in (True, False) for long_words in (True, False)]
+
+# YAML 1.2 implicit resolvers by first character: a plain scalar matching one
+# of these would not load back as a string, so it has to be quoted.
+_BOOL = re.compile(r'^(?:true|True|TRUE|false|False|FALSE)$')
+_FLOAT = re.compile(r'''^(?:
+     [-+]?(?:[0-9][0-9_]*)\.[0-9_]*(?:[eE][-+]?[0-9]+)?
+    |[-+]?(?:[0-9][0-9_]*)(?:[eE][-+]?[0-9]+)
+    |[-+]?\.[0-9_]+(?:[eE][-+][0-9]+)?
+    |[-+]?\.(?:inf|Inf|INF)
+    |\.(?:nan|NaN|NAN))$''', re.X)
+_INT = re.compile(r'''^(?:[-+]?0b[0-1_]+
+    |[-+]?0o?[0-7_]+
+    |[-+]?[0-9_]+
+    |[-+]?0x[0-9a-fA-F_]+)$''', re.X)
+_MERGE = re.compile(r'^(?:<<)$')
+_NULL = re.compile(r'^(?:~|null|Null|NULL)$')
+_TIMESTAMP = re.compile(r'''^(?:[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]
+    |[0-9][0-9][0-9][0-9] -[0-9][0-9]? -[0-9][0-9]?
+    (?:[Tt]|[ \t]+)[0-9][0-9]?
+    :[0-9][0-9] :[0-9][0-9] (?:\.[0-9]*)?
+    (?:[ \t]*(?:Z|[-+][0-9][0-9]?(?::[0-9][0-9])?))?)$''', re.X)
+_VALUE = re.compile(r'^(?:=)$')
+
+IMPLICIT_RESOLVERS = {}
+for _regexp, _first in (
+        (_BOOL, 'tTfF'),
+        (_FLOAT, '-+0123456789.'),
+        (_INT, '-+0123456789'),
+        (_MERGE, '<'),
+        (_NULL, '~nN'),
+        (_TIMESTAMP, '0123456789'),
+        (_VALUE, '=')):
+    for _char in _first:
+        IMPLICIT_RESOLVERS.setdefault(_char, []).append(_regexp)
+
+
+class Unsupported(Exception):
+    """Raised for data the fast emitter can not render byte-identically"""
+
+
+def resolves_implicitly(value):
+    """Whether a plain ``value`` would be loaded as something else than a string"""
+    for regexp in IMPLICIT_RESOLVERS.get(value[0], ()):
+        if regexp.match(value):
+            return True
+    return False
+
+
+def analyze(value):
+    """Port of ruamel's scalar analysis for block context
+
+    Returns:
+      (bool, bool): whether the block plain and single quoted styles are allowed
+    """
+    block_indicators = value.startswith('---') or value.startswith('...')
+    line_breaks = special_characters = False
+    leading_space = trailing_space = False
+    break_space = space_break = False
+    previous_space = previous_break = False
+    preceded_by_whitespace = True
+    followed_by_whitespace = len(value) == 1 or value[1] in WHITESPACE
+    last = len(value) - 1
+
+    for index, char in enumerate(value):
+        if index == 0:
+            if char in LEADING_INDICATORS:
+                block_indicators = True
+            if char in '?:-' and followed_by_whitespace:
+                block_indicators = True
+        elif (char == ':' and followed_by_whitespace) \
+                or (char == '#' and preceded_by_whitespace):
+            block_indicators = True
+
+        if char in BREAKS:
+            line_breaks = True
+        if not (char == '\n' or '\x20' <= char <= '\x7E'):
+            if not ((char == '\x85'
+                     or '\xA0' <= char <= '\uD7FF'
+                     or '\uE000' <= char <= '\uFFFD'
+                     or '\U00010000' <= char <= '\U0010FFFF')
+                    and char != '\uFEFF'):
+                special_characters = True
+
+        if char == ' ':
+            leading_space = leading_space or index == 0
+            trailing_space = trailing_space or index == last
+            break_space = break_space or previous_break
+            previous_space, previous_break = True, False
+        elif char in BREAKS:
+            space_break = space_break or previous_space
+            previous_space, previous_break = False, True
+        else:
+            previous_space = previous_break = False
+
+        preceded_by_whitespace = char in WHITESPACE
+        followed_by_whitespace = index + 2 > last or value[index + 2] in WHITESPACE
+
+    allow_plain = not (leading_space or trailing_space or line_breaks
+                       or break_space or special_characters or space_break
+                       or block_indicators)
+    allow_single_quoted = not (break_space or special_characters or space_break)
+    return allow_plain, allow_single_quoted
+
+
+@functools.lru_cache(maxsize=4096)
+def string(value):
+    if value == '':
+        return "''"
+    if SAFE_PLAIN.match(value) and not value.endswith(' '):
+        allow_plain = allow_single_quoted = True
+    else:
+        allow_plain, allow_single_quoted = analyze(value)
+    if allow_plain and not resolves_implicitly(value):
+        return value
+    if "'" in value or '\n' in value or not allow_single_quoted:
+        # ruamel picks the double quoted style, whose escaping and folding
+        # differs between ruamel.yaml releases
+        raise Unsupported(value)
+    if any(char in BREAKS for char in value):
+        raise Unsupported(value)
+    return "'" + value + "'"
+
+
+def scalar(value):
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, str):
+        return string(value)
+    raise Unsupported(type(value))
+
+
+def key_scalar(key):
+    if not isinstance(key, str) or len(key) >= SIMPLE_KEY_LENGTH:
+        raise Unsupported(key)
+    return scalar(key)
+
+
+def fold(text, column, indent, rule):
+    """Fold a plain scalar at spaces the way ruamel.yaml's ``write_plain`` does
+
+    Args:
+      text (str): the scalar, written starting at ``column``
+      column (int): the column the scalar starts at
+      indent (int): the indentation of continuation lines
+      rule ((bool, bool)): one of FOLDING_RULES
+
+    Returns:
+      [str]: the lines, the first one without the part before ``column``
+    """
+    at_width, long_words = rule
+    lines = []
+    line = []
+    for word in WORDS.findall(text):
+        if word[0] == ' ':
+            if len(word) == 1 and (column >= BEST_WIDTH if at_width else column > BEST_WIDTH):
+                lines.append(''.join(line))
+                line, column = [' ' * indent], indent
+                continue
+        elif long_words and column + len(word) > BEST_WIDTH and column > indent:
+            lines.append(''.join(line))
+            line, column = [' ' * indent], indent
+        line.append(word)
+        column += len(word)
+    lines.append(''.join(line))
+    return lines
+
+
+@functools.lru_cache(maxsize=None)
+def folding():
+    """The folding rule of the installed ruamel.yaml
+
+    Probed once with scalars the known rules fold differently, as ruamel.yaml
+    would have to be imported to render long scalars anyway.
+
+    Returns:
+      (bool, bool): one of FOLDING_RULES, None if ruamel.yaml follows none of them
+    """
+    from ruamel.yaml import YAML as RuamelYaml
+    probes = ['x' * 77 + ' y', 'x' * 70 + ' ' + 'y' * 20 + ' z']
+    outputs = []
+    for probe in probes:
+        stream = io.StringIO()
+        RuamelYaml().dump({'k': probe}, stream)
+        outputs.append(stream.getvalue())
+    for rule in FOLDING_RULES:
+        if all(output == 'k: ' + '\n'.join(fold(probe, 3, 2, rule)) + '\n'
+               for probe, output in zip(probes, outputs)):
+            return rule
+    return None
+
+
+class Anchors:
+    """Names the repeated mappings of a document, to write them once and alias them after
+
+    The ``env``, ``agents`` and ``plugins`` mappings of steps and the
+    configuration of every plugin are anchored where they first appear,
+    e.g. ``agents: &agents1``, and written as an alias like ``*agents1``
+    wherever an equal mapping follows. The names of the mappings of a part
+    only stick once the whole part was emitted, so a part rendered by
+    ruamel.yaml instead never defines a name that later parts refer to.
+    """
+
+    KEYS = ('env', 'agents', 'plugins')
+    # the name of a plugin configuration, plugin names do not make valid anchors
+    PLUGIN = 'plugin'
+
+    def __init__(self):
+        self.names = {}
+        self.counts = {}
+        self.pending = []
+        self.interned = {}
+        self.canonicals = {}
+
+    def copy(self):
+        """Anchors for another document, sharing the interned mappings"""
+        copy = Anchors()
+        copy.interned = self.interned
+        copy.canonicals = self.canonicals
+        return copy
+
+    def canonical(self, mapping):
+        found = self.canonicals.get(id(mapping))
+        if found is None:
+            found = json.dumps(mapping, separators=(',', ':'), ensure_ascii=False)
+        return found
+
+    def intern(self, mapping):
+        """The first mapping equal to ``mapping``, so equal mappings share memory"""
+        canonical = self.canonical(mapping)
+        found = self.interned.setdefault(canonical, mapping)
+        self.canonicals[id(found)] = canonical
+        return found
+
+    def intern_step(self, step):
+        """Replace the mappings of ``step`` that get anchored by interned ones"""
+        if not isinstance(step, dict):
+            return step
+        build = step.get('build')
+        for parent in (step, build if isinstance(build, dict) else {}):
+            plugins = parent.get('plugins')
+            if isinstance(plugins, dict):
+                for name, config in plugins.items():
+                    if isinstance(config, dict) and config:
+                        plugins[name] = self.intern(config)
+            for key in self.KEYS:
+                if isinstance(parent.get(key), dict) and parent[key]:
+                    parent[key] = self.intern(parent[key])
+        return step
+
+    def anchor(self, prefix, mapping):
+        """``(name, True)`` where ``mapping`` first appears, ``(name, False)`` after"""
+        canonical = self.canonical(mapping)
+        name = self.names.get(canonical)
+        if name is not None:
+            return name, False
+        count = self.counts.get(prefix, 0) + 1
+        self.counts[prefix] = count
+        name = self.names[canonical] = prefix + str(count)
+        self.pending.append((canonical, prefix))
+        return name, True
+
+    def commit(self):
+        self.pending = []
+
+    def rollback(self):
+        for canonical, prefix in self.pending:
+            del self.names[canonical]
+            self.counts[prefix] -= 1
+        self.pending = []
+
+
+class Emitter:
+    """Block style emitter with ruamel.yaml's ``indent()`` semantics
+
+    Args:
+      mapping (int): indentation of nested mappings
+      sequence (int): indentation of sequence item contents
+      offset (int): indentation of the dash of sequence items
+      anchors (:obj:`Anchors`): anchor and alias repeated mappings of steps
+    """
+
+    def __init__(self, mapping=2, sequence=2, offset=0, anchors=None):
+        if sequence != offset + 2:
+            raise Unsupported('sequence indent has to be offset + 2')
+        self.mapping = mapping
+        self.sequence = sequence
+        self.offset = offset
+        self.anchors = anchors
+
+    def dump(self, data):
+        """Render a top-level list or mapping
+
+        Returns:
+          str: the YAML document
+        """
+        lines = []
+        self.lines(data, lines)
+        lines.append('')
+        return '\n'.join(lines)
+
+    def lines(self, data, lines):
+        """Append the lines of a top-level list or mapping to ``lines``"""
+        try:
+            if isinstance(data, list) and data:
+                self.sequence_lines(data, 0, lines)
+            elif isinstance(data, dict) and data:
+                self.mapping_lines(data, 0, lines)
+            else:
+                raise Unsupported(data)
+        except Unsupported:
+            if self.anchors is not None:
+                self.anchors.rollback()
+            raise
+        if self.anchors is not None:
+            self.anchors.commit()
+
+    def anchor(self, key, value, indent, plugins):
+        """The anchor or alias to write after the key of a non-empty mapping
+
+        Only mappings within steps, never the top-level ``env``, are anchored.
+        """
+        if self.anchors is None or not indent:
+            return None, True
+        if plugins:
+            return self.anchors.anchor(Anchors.PLUGIN, value)
+        if key in Anchors.KEYS:
+            return self.anchors.anchor(key, value)
+        return None, True
+
+    def value_line(self, head, value, lines, indent):
+        text = scalar(value)
+        line = head + text
+        if len(line) <= BEST_WIDTH:
+            lines.append(line)
+            return
+        if not isinstance(value, str) or text != value or folding() is None:
+            # ruamel would fold the quoted scalar or move it onto its own line
+            raise Unsupported(value)
+        folded = fold(text, len(head), indent, folding())
+        lines.append(head + folded[0])
+        lines.extend(folded[1:])
+
+    def mapping_lines(self, mapping, indent, lines, prefix=None, plugins=False):
+        for key, value in mapping.items():
+            head = (' ' * indent if prefix is None else prefix) + key_scalar(key) + ':'
+            prefix = None
+            if len(head) > BEST_WIDTH:
+                # ruamel would fold the key
+                raise Unsupported(key)
+            if value is None:
+                lines.append(head)
+            elif isinstance(value, dict):
+                if value:
+                    name, first = self.anchor(key, value, indent, plugins)
+                    if not first:
+                        lines.append(head + ' *' + name)
+                        continue
+                    lines.append(head + (' &' + name if name else ''))
+                    self.mapping_lines(value, indent + self.mapping, lines,
+                                       plugins=key == 'plugins' and not plugins)
+                else:
+                    lines.append(head + ' {}')
+            elif isinstance(value, list):
+                if value:
+                    lines.append(head)
+                    self.sequence_lines(value, indent, lines)
+                else:
+                    lines.append(head + ' []')
+            else:
+                self.value_line(head + ' ', value, lines, indent + self.mapping)
+
+    def sequence_lines(self, sequence, indent, lines):
+        prefix = ' ' * (indent + self.offset) + '- '
+        for item in sequence:
+            if isinstance(item, dict) and item:
+                self.mapping_lines(item, indent + self.sequence, lines, prefix)
+            elif item is None or isinstance(item, (dict, list)):
+                raise Unsupported(item)
+            else:
+                self.value_line(prefix, item, lines, indent + self.sequence)
+
+
+def dump(data, **indent):
+    """Render ``data`` like ruamel.yaml would with the given ``indent()`` settings
+    and ``anchors``
+
+    Raises:
+      Unsupported: if the output could differ from ruamel.yaml's
+    """
+    return Emitter(**indent).dump(data)
+
+
+def flow_string(value):
+    """Plain if that is unambiguous in flow context for any YAML parser,
+    JSON-style double quoted (which is valid YAML) otherwise"""
+    if value and analyze(value)[0] and not resolves_implicitly(value) \
+            and not any(char in FLOW_UNSAFE for char in value):
+        return value
+    return json.dumps(value, ensure_ascii=False)
+
+
+def flow(data):
+    """Render ``data`` as a single line of flow style YAML"""
+    if isinstance(data, dict):
+        return '{' + ', '.join(
+            flow_string(key) + ': ' + flow(value) for key, value in data.items()
+        ) + '}'
+    if isinstance(data, list):
+        return '[' + ', '.join(flow(item) for item in data) + ']'
+    if data is None:
+        return 'null'
+    if isinstance(data, str):
+        return flow_string(data)
+    return scalar(data)
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+'''
+    Output formats for pipeline documents
+'''
+from __future__ import division, print_function, absolute_import
+
+import json
+import logging
+import sys
+from collections import OrderedDict
+
+from bkyml import emitter
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+LOGGER = logging.getLogger(__name__)
+
+
+def left_out(fmt, count):
+    """Tell on stderr that ``count`` comments are not in the output of ``fmt``"""
+    if count:
+        sys.stderr.write('left out {count} comment(s), {name} output can not hold them\n'.format(
+            count=count, name=fmt.name))
+
+
+class Document:
+    """The pieces of a pipeline: rendered comments, the env map and the steps"""
+
+    def __init__(self):
+        self.comments = []
+        self.env = None
+        self.has_steps = False
+        self.steps = []
+
+    def add(self, kind, data):
+        if kind == 'comment':
+            self.comments.append(data)
+        elif kind == 'env':
+            self.env = data
+        elif kind == 'steps':
+            self.has_steps = True
+        elif data is not None:
+            self.has_steps = True
+            self.steps.append(data)
+
+    def as_dict(self):
+        ret = OrderedDict()
+        if self.env is not None:
+            ret['env'] = self.env
+        if self.has_steps:
+            ret['steps'] = self.steps
+        return ret
+
+
+class Format:
+    """Serializes the data produced by the subcommands
+
+    Formats whose fragments can simply be concatenated into a valid document
+    are ``streamable``; the others have to render a whole :class:`Document`.
+    """
+
+    name = None
+    streamable = True
+    # the :class:`bkyml.emitter.Anchors` of the document, None to repeat mappings
+    anchors = None
+
+    def to_string(self, data):
+        raise NotImplementedError
+
+    @staticmethod
+    def parts(document):
+        """The pieces separate CLI calls would render: comment strings and data"""
+        for comment in document.comments:
+            yield comment
+        if document.env is not None:
+            yield {'env': document.env}
+        if document.has_steps:
+            yield {'steps': None}
+        for step in document.steps:
+            yield [step]
+
+    def fragments(self, document):
+        """Render a document piece by piece, like separate CLI calls would"""
+        for part in self.parts(document):
+            yield part if isinstance(part, str) else self.to_string(part)
+
+    def document(self, document):
+        return ''.join(fragment + '\n' for fragment in self.fragments(document))
+
+    def writer(self, stream, **kwargs):
+        return FragmentWriter(self, stream, **kwargs)
+
+
+class JsonFormat(Format):
+    name = 'json'
+    streamable = False
+    separator = ','
+
+    def to_string(self, data):
+        return json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+
+    def key(self, name):
+        return self.to_string(name) + ':'
+
+    def document(self, document):
+        left_out(self, len(document.comments))
+        return self.to_string(document.as_dict()) + '\n'
+
+    def writer(self, stream, **kwargs):
+        return CollectionWriter(self, stream, comments=False, **kwargs)
+
+
+class FlowYamlFormat(Format):
+    name = 'yaml-flow'
+    streamable = False
+    separator = ', '
+
+    def to_string(self, data):
+        return emitter.flow(data)
+
+    @staticmethod
+    def key(name):
+        return emitter.flow_string(name) + ': '
+
+    def document(self, document):
+        comments = ''.join(comment + '\n' for comment in document.comments)
+        return comments + self.to_string(document.as_dict()) + '\n'
+
+    def writer(self, stream, **kwargs):
+        return CollectionWriter(self, stream, comments=True, **kwargs)
+
+
+class Writer:
+    """Writes the parts of a document to ``stream`` as soon as they are added
+
+    Only the part being written is held in memory, so documents of any size
+    can be produced. Parts are written in the order they are added.
+
+    Args:
+      fmt (:obj:`Format`): the output format
+      stream: a writable text stream
+      flush_every (int): flush the stream after this many steps, 0 to leave
+        flushing to the stream
+    """
+
+    def __init__(self, fmt, stream, flush_every=0):
+        self.format = fmt
+        self.stream = stream
+        self.flush_every = flush_every
+        self.count = 0
+
+    def add(self, kind, data):
+        if kind == 'comment':
+            self.comment(data)
+        elif kind == 'env':
+            self.env(data)
+        elif kind == 'steps':
+            self.steps()
+        elif data is not None:
+            self.step(data)
+            self.count += 1
+            if self.flush_every and self.count % self.flush_every == 0:
+                self.stream.flush()
+
+    def comment(self, comment):
+        raise NotImplementedError
+
+    def env(self, env):
+        raise NotImplementedError
+
+    def steps(self):
+        raise NotImplementedError
+
+    def step(self, step):
+        raise NotImplementedError
+
+    def close(self):
+        self.stream.flush()
+
+
+class FragmentWriter(Writer):
+    """Writer for formats whose fragments concatenate into a valid document
+
+    Args:
+      implicit_steps (bool): write the ``steps:`` key before the first step
+        if it has not been added explicitly
+    """
+
+    def __init__(self, fmt, stream, flush_every=0, implicit_steps=True):
+        super().__init__(fmt, stream, flush_every)
+        self.implicit_steps = implicit_steps
+        self.has_steps = False
+
+    def write(self, data):
+        self.stream.write(self.format.to_string(data) + '\n')
+
+    def comment(self, comment):
+        self.stream.write(comment + '\n')
+
+    def env(self, env):
+        self.write({'env': env})
+
+    def steps(self):
+        self.has_steps = True
+        self.write({'steps': None})
+
+    def step(self, step):
+        if self.implicit_steps and not self.has_steps:
+            self.steps()
+        self.write([step])
+
+
+class CollectionWriter(Writer):
+    """Writer for formats that render the document as a single collection
+
+    The opening of the collection is written with the first part and closed
+    by :meth:`close`, so ``env`` has to come before the first step and
+    comments (if the format supports them at all) before everything else.
+    Comments of formats without them are left out, which :meth:`close`
+    tells on stderr.
+    """
+
+    def __init__(self, fmt, stream, comments, flush_every=0):
+        super().__init__(fmt, stream, flush_every)
+        self.comments = comments
+        self.left_out = 0
+        self.started = False
+        self.has_steps = False
+
+    def open(self, key):
+        self.stream.write((self.format.separator if self.started else '{') +
+                          self.format.key(key))
+        self.started = True
+
+    def comment(self, comment):
+        if not self.comments:
+            self.left_out += 1
+            return
+        if self.started:
+            raise ValueError('comments have to come first in %s output' % self.format.name)
+        self.stream.write(comment + '\n')
+
+    def env(self, env):
+        if self.has_steps:
+            raise ValueError('env has to come before the steps in %s output' % self.format.name)
+        self.open('env')
+        self.stream.write(self.format.to_string(env))
+
+    def steps(self):
+        if not self.has_steps:
+            self.open('steps')
+            self.stream.write('[')
+            self.has_steps = True
+
+    def step(self, step):
+        if self.has_steps and self.count:
+            self.stream.write(self.format.separator)
+        self.steps()
+        self.stream.write(self.format.to_string(step))
+
+    def close(self):
+        if not self.started:
+            self.stream.write('{')
+        self.stream.write((']' if self.has_steps else '') + '}\n')
+        left_out(self.format, self.left_out)
+        super().close()
+
+
+class CYamlFormat(Format):
+    """Block YAML through libyaml's C emitter (needs PyYAML built with libyaml)"""
+
+    name = 'yaml-c'
+
+    def __init__(self, dumper):
+        self.dumper = dumper
+
+    @staticmethod
+    def load(fallback):
+        try:
+            import yaml
+            from yaml import CSafeDumper
+        except ImportError:
+            LOGGER.warning('PyYAML with libyaml is not available, using %s', fallback.name)
+            return fallback
+
+        class Dumper(CSafeDumper):  # pylint: disable=too-many-ancestors
+            pass
+
+        def represent_ordered(dumper, data):
+            return dumper.represent_mapping(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
+                                            list(data.items()))
+
+        def represent_none(dumper, _):
+            # an empty value, like ruamel.yaml, so "steps:" can be followed by steps
+            return dumper.represent_scalar('tag:yaml.org,2002:null', '')
+
+        Dumper.add_representer(OrderedDict, represent_ordered)
+        Dumper.add_representer(dict, represent_ordered)
+        Dumper.add_representer(type(None), represent_none)
+        return CYamlFormat(Dumper)
+
+    def to_string(self, data):
+        import yaml
+        return yaml.dump(data, Dumper=self.dumper, default_flow_style=False,
+                         allow_unicode=True)
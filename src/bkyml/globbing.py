@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+'''
+    Glob matching on top of ``os.scandir`` with a thread pool
+
+    Directories of the same depth are listed in parallel, which pays off for
+    deep recursive patterns on network filesystems where every listing is a
+    round trip.
+'''
+from __future__ import division, print_function, absolute_import
+
+import fnmatch
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+WORKERS = 16
+MAGIC = re.compile(r'[*?[]')
+
+
+def join(directory, name):
+    if not directory:
+        return name
+    return directory.rstrip('/') + '/' + name
+
+
+def listing(directory):
+    """``(name, is_dir, is_symlink)`` per entry, nothing if it can not be read"""
+    path = directory or '.'
+    try:
+        if hasattr(os, 'scandir'):
+            # exhausting the iterator closes it
+            return [(entry.name, entry.is_dir(), entry.is_symlink())
+                    for entry in os.scandir(path)]
+        return [(name, os.path.isdir(os.path.join(path, name)),  # pragma: no cover
+                 os.path.islink(os.path.join(path, name)))
+                for name in os.listdir(path)]
+    except OSError:
+        return []
+
+
+def subdirectories(directory):
+    """Subdirectories not starting with a dot, without following symlinks"""
+    return [join(directory, name) for name, is_dir, is_symlink in listing(directory)
+            if is_dir and not is_symlink and not name.startswith('.')]
+
+
+class Matcher:
+    """Matches one path component, hiding dot files like :mod:`glob` does"""
+
+    def __init__(self, part):
+        self.regexp = re.compile(fnmatch.translate(part))
+        self.hidden = part.startswith('.')
+
+    def __call__(self, name):
+        return (self.hidden or not name.startswith('.')) and self.regexp.match(name)
+
+
+def scan(pattern, workers=WORKERS):
+    """Paths matching ``pattern``, sorted
+
+    Supports ``*``, ``?``, ``[...]`` and ``**`` for any number of directories
+    (symlinked directories are not descended into). Like :func:`glob.glob`, a
+    trailing slash only matches directories and is kept in the results.
+
+    Args:
+      pattern (str): the glob, relative to the working directory or absolute
+      workers (int): number of directories listed at the same time
+
+    Returns:
+      [str]: the matching paths
+    """
+    dirs_only = pattern.endswith('/')
+    parts = [part for part in pattern.split('/') if part]
+    current = ['/' if pattern.startswith('/') else '']
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for index, part in enumerate(parts):
+            last = index == len(parts) - 1
+            if part == '**' and last and not dirs_only:
+                # like glob, a trailing ** matches files too and keeps the start as dir/
+                below = recurse(pool, current, listing_files=True)[len(current):]
+                return sorted(set(below).union(
+                    join(directory, '') for directory in current if directory))
+            elif part == '**':
+                current = recurse(pool, current)
+            elif not MAGIC.search(part):
+                current = [join(directory, part) for directory in current]
+                if not last:
+                    current = [path for path in current if os.path.isdir(path)]
+            else:
+                matcher = Matcher(part)
+                wants_dir = dirs_only or not last
+                current = [
+                    join(directory, name)
+                    for directory, names in zip(current, pool.map(listing, current))
+                    for name, is_dir, _ in names
+                    if matcher(name) and (is_dir or not wants_dir)
+                ]
+    if dirs_only:
+        return sorted(path + '/' for path in current if path and os.path.isdir(path))
+    return sorted(path for path in current if path and os.path.lexists(path))
+
+
+def recurse(pool, directories, listing_files=False):
+    """The directories and all their subdirectories, listed level by level
+
+    With ``listing_files`` the files below them are part of the result as well.
+    """
+    found = list(directories)
+    level = directories
+    while level:
+        if listing_files:
+            children = [(join(directory, name), is_dir and not is_symlink)
+                        for directory, names in zip(level, pool.map(listing, level))
+                        for name, is_dir, is_symlink in names if not name.startswith('.')]
+            found.extend(path for path, _ in children)
+            level = [path for path, descend in children if descend]
+        else:
+            level = [child for children in pool.map(subdirectories, level)
+                     for child in children]
+            found.extend(level)
+    return found
+
+
+def scan_all(patterns, workers=WORKERS):
+    """Sorted union of the matches of several patterns"""
+    matches = set()
+    for pattern in patterns:
+        matches.update(scan(pattern, workers))
+    return sorted(matches)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+'''
+    Check the ``key`` / ``depends_on`` graph of a pipeline
+
+    Steps only wait for the steps they depend on and for the ``wait`` and
+    ``block`` barriers before them, and a barrier waits for every step
+    before it. A pipeline whose steps depend on a key no step has, or
+    whose dependencies go round in a circle, is rejected by Buildkite or
+    never finishes; :class:`Graph` finds both in time linear in the number
+    of steps and dependencies.
+
+    Steps without a key and without dependencies only ever depend on the
+    barrier before them, which the next barrier depends on directly as
+    well, so they can not close a cycle and are not kept at all.
+
+    Example::
+
+        from bkyml import graph
+
+        graph.validate(steps)
+'''
+from __future__ import division, print_function, absolute_import
+
+from bkyml import chunks
+from bkyml import incremental
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+# unknown keys named in an error before the rest are only counted
+REPORTED_UNKNOWN = 3
+
+
+def dependencies(value):
+    """The keys of a ``depends_on`` value: a key, a list of keys or of ``{step: key}``"""
+    if value is None:
+        return []
+    if isinstance(value, (str, dict)):
+        value = [value]
+    return [item['step'] if isinstance(item, dict) else item for item in value]
+
+
+def node(step):
+    """What the graph needs to know of a step, None if it has nothing to do with it
+
+    Returns:
+      list: ``[name, key, dependencies, barrier]``, ready to be stored as JSON
+    """
+    barrier = chunks.is_barrier(step)
+    if not isinstance(step, dict):
+        return [incremental.identity(step), None, [], True] if barrier else None
+    key = step.get('key')
+    depends = dependencies(step.get('depends_on'))
+    if key is None and not depends and not barrier:
+        return None
+    return [incremental.identity(step), key, depends, barrier]
+
+
+class Graph:
+    """Collects the dependencies of the steps of a pipeline, in order
+
+    Args:
+      known ([str]): keys of steps uploaded before, which steps may depend on
+    """
+
+    def __init__(self, known=()):
+        self.known = set(known)
+        self.names = []
+        self.depends = []
+        # dependencies on other nodes implied by the barriers
+        self.implied = []
+        self.keys = {}
+        self.barrier = None
+        self.since = []
+
+    def add(self, step):
+        self.record(node(step))
+
+    def record(self, found):
+        """Add a :func:`node`
+
+        Raises:
+          ValueError: if its key is taken already
+        """
+        if found is None:
+            return
+        name, key, depends, barrier = found
+        index = len(self.names)
+        implied = [] if self.barrier is None else [self.barrier]
+        if barrier:
+            implied.extend(self.since)
+            self.barrier, self.since = index, []
+        else:
+            self.since.append(index)
+        if key is not None:
+            if key in self.keys:
+                raise ValueError('more than one step has the key %r' % key)
+            if key in self.known:
+                raise ValueError('the key %r is taken by a step uploaded before' % key)
+            self.keys[key] = index
+        self.names.append(name)
+        self.depends.append(depends)
+        self.implied.append(implied)
+
+    def edges(self, index):
+        """The nodes a node waits for"""
+        return self.implied[index] + [self.keys[key] for key in self.depends[index]
+                                      if key in self.keys]
+
+    def unknown(self):
+        """``(name, key)`` of every dependency on a key no step has"""
+        return [(name, key) for name, depends in zip(self.names, self.depends)
+                for key in depends if key not in self.keys and key not in self.known]
+
+    def cycle(self):
+        """The names along a cycle of dependencies, the first repeated at the end, or None"""
+        done = [False] * len(self.names)
+        position = {}
+        for start in range(len(self.names)):
+            if done[start]:
+                continue
+            path, pending = [start], [iter(self.edges(start))]
+            position[start] = 0
+            while pending:
+                following = next(pending[-1], None)
+                if following is None:
+                    finished = path.pop()
+                    pending.pop()
+                    del position[finished]
+                    done[finished] = True
+                elif following in position:
+                    return [self.names[index] for index in path[position[following]:]] + \
+                        [self.names[following]]
+                elif not done[following]:
+                    position[following] = len(path)
+                    path.append(following)
+                    pending.append(iter(self.edges(following)))
+        return None
+
+    def validate(self):
+        """Check every dependency is on a known key and none go round in a circle
+
+        Raises:
+          ValueError: naming the offending steps
+        """
+        unknown = self.unknown()
+        if unknown:
+            message = '; '.join('{name} depends on the unknown key {key!r}'.format(
+                name=name, key=key) for name, key in unknown[:REPORTED_UNKNOWN])
+            if len(unknown) > REPORTED_UNKNOWN:
+                message += ' and %d more' % (len(unknown) - REPORTED_UNKNOWN)
+            raise ValueError(message)
+        found = self.cycle()
+        if found:
+            raise ValueError('dependency cycle: %s' % ' -> '.join(found))
+
+
+def validate(steps, known=()):
+    """Check the dependencies of a list of steps, see :meth:`Graph.validate`"""
+    checked = Graph(known)
+    for step in steps:
+        checked.add(step)
+    checked.validate()
+    return checked
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+'''
+    Re-render a pipeline by splicing in what did not change since last time
+
+    Next to the rendered pipeline, a sidecar index keeps the content hash,
+    offset and length of every part (comment, env, ``steps:`` or step) and
+    which parts every batch line produced. The next render copies the text of
+    unchanged lines without parsing them and the text of unchanged parts
+    without serializing them, so only new and changed steps go through the
+    serializers. The same hashes tell which steps :func:`diff` has to look
+    at in detail.
+'''
+from __future__ import division, print_function, absolute_import
+
+import hashlib
+import io
+import json
+import os
+from collections import OrderedDict
+
+from bkyml import formats
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+INDEX_SUFFIX = '.index'
+# top-level keys naming a step, in order of preference
+IDENTITY_KEYS = ('key', 'label', 'block', 'trigger', 'name', 'command', 'wait')
+
+
+def digest(value):
+    """SHA-256 of the canonical JSON of ``value``"""
+    canonical = json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8', 'surrogateescape')).hexdigest()
+
+
+def part_hash(kind, data):
+    return digest([kind, data])
+
+
+def write_atomically(path, text):
+    temporary = '{path}.{pid}.tmp'.format(path=path, pid=os.getpid())
+    with open(temporary, 'w', encoding='utf-8', errors='surrogateescape', newline='') as stream:
+        stream.write(text)
+    os.replace(temporary, path)
+
+
+class Previous:
+    """A previous render and its index, empty if there is none
+
+    Args:
+      text (str): the rendered pipeline
+      parts ([list]): ``[kind, hash, offset, length, node]`` of every part, in
+        order, with the :func:`bkyml.graph.node` of steps
+      lines (dict): hash of the arguments of a batch line to the offset and
+        length of its text and the position and number of its parts
+    """
+
+    def __init__(self, text='', parts=(), lines=None):
+        self.text = text
+        self.parts = [tuple(part) for part in parts]
+        self.offsets = {key: (offset, length) for _, key, offset, length, _ in self.parts}
+        self.lines = lines or {}
+
+    @classmethod
+    def load(cls, path, fmt, options):
+        """Load the render at ``path`` if it was made with the same versions and format
+
+        Lines are only spliced if the options the lines were rendered with,
+        like the branch steps are filtered for, match as well.
+
+        Args:
+          fmt (str): key of the format and versions, see :func:`bkyml.outputs.key`
+          options (str): key of ``fmt`` and the options
+        """
+        try:
+            with open(path + INDEX_SUFFIX) as stream:
+                index = json.load(stream)
+            with open(path, encoding='utf-8', errors='surrogateescape', newline='') as stream:
+                text = stream.read()
+        except (OSError, ValueError):
+            return cls()
+        if index.get('format') != fmt or index.get('sha256') != digest(text):
+            # rendered differently or edited since
+            return cls()
+        return cls(text, index['parts'], index['lines'] if index.get('options') == options else {})
+
+    def part(self, key):
+        """The text of the part with hash ``key``, None if there is none"""
+        found = self.offsets.get(key)
+        if found is None:
+            return None
+        offset, length = found
+        return self.text[offset:offset + length]
+
+
+class Render:
+    """Collects a render together with its index
+
+    Args:
+      fmt (:obj:`bkyml.formats.Format`): a streamable format
+      previous (:obj:`Previous`): the render to splice from
+      graph (:obj:`bkyml.graph.Graph`): gets the steps, spliced ones included
+    """
+
+    def __init__(self, fmt, previous, graph=None):
+        self.writer = formats.FragmentWriter(fmt, None, implicit_steps=False)
+        self.previous = previous
+        self.graph = graph
+        self.chunks = []
+        self.offset = 0
+        self.parts = []
+        self.lines = OrderedDict()
+        self.line = None
+        self.spliced = 0
+        self.rendered = 0
+
+    def write(self, text):
+        self.chunks.append(text)
+        self.offset += len(text)
+
+    def splice_line(self, argv):
+        """Copy the text of a batch line rendered before, return whether there was one"""
+        key = digest(argv)
+        found = self.previous.lines.get(key)
+        if found is None:
+            return False
+        offset, length, first, count = found
+        self.lines[key] = [self.offset, length, len(self.parts), count]
+        for kind, part, part_offset, part_length, node in self.previous.parts[first:first + count]:
+            self.parts.append((kind, part, part_offset - offset + self.offset, part_length, node))
+            if self.graph is not None:
+                self.graph.record(node)
+        self.write(self.previous.text[offset:offset + length])
+        self.spliced += count
+        return True
+
+    def begin_line(self, argv, reusable):
+        """Start the text of a batch line, indexed if ``reusable``"""
+        self.line = (digest(argv), self.offset, len(self.parts)) if reusable else None
+
+    def end_line(self):
+        if self.line is not None:
+            key, offset, first = self.line
+            self.lines[key] = [offset, self.offset - offset, first, len(self.parts) - first]
+            self.line = None
+
+    def add(self, kind, data):
+        """Add a part, spliced from the previous render if it has the same content"""
+        key = part_hash(kind, data)
+        text = self.previous.part(key)
+        if text is None:
+            self.writer.stream = io.StringIO()
+            self.writer.add(kind, data)
+            text = self.writer.stream.getvalue()
+            self.rendered += 1
+        else:
+            self.spliced += 1
+        node = None
+        if kind == 'step' and self.graph is not None:
+            # imported here as the graph imports this module
+            from bkyml import graph
+            node = graph.node(data)
+            self.graph.record(node)
+        self.parts.append((kind, key, self.offset, len(text), node))
+        self.write(text)
+
+    def save(self, path, fmt, options):
+        """Write the render to ``path`` and its index next to it"""
+        text = ''.join(self.chunks)
+        write_atomically(path, text)
+        write_atomically(path + INDEX_SUFFIX, json.dumps(OrderedDict([
+            ('format', fmt),
+            ('options', options),
+            ('sha256', digest(text)),
+            ('parts', self.parts),
+            ('lines', self.lines),
+        ]), separators=(',', ':')))
+
+
+class Fragment(str):
+    """The text of a step in a rendered pipeline, loaded once it is needed"""
+
+    def load(self):
+        return load_yaml(self)[0]
+
+
+def load_yaml(text):
+    # imported here as only diff reads YAML
+    from ruamel.yaml import YAML as RuamelYaml
+    return RuamelYaml(typ='safe').load(text)
+
+
+def steps(path):
+    """The steps of a rendered pipeline as ``[hash, step]``
+
+    With a matching index only the hashes are read and ``step`` is a
+    :class:`Fragment`.
+    """
+    with open(path, encoding='utf-8', errors='surrogateescape', newline='') as stream:
+        text = stream.read()
+    try:
+        with open(path + INDEX_SUFFIX) as stream:
+            index = json.load(stream)
+        if index.get('sha256') == digest(text):
+            return [[key, Fragment(text[offset:offset + length])]
+                    for kind, key, offset, length, _ in index['parts'] if kind == 'step']
+    except (OSError, ValueError):
+        pass
+    document = load_yaml(text)
+    if isinstance(document, dict):
+        document = document.get('steps')
+    return [[part_hash('step', step), step] for step in document or ()]
+
+
+def identity(step):
+    """What a step is called, matching steps across renders"""
+    if isinstance(step, dict):
+        for key in IDENTITY_KEYS:
+            if key in step:
+                value = step[key]
+                return key if value is None else '{key}: {value}'.format(
+                    key=key, value=value if isinstance(value, str) else json.dumps(value))
+        return json.dumps(step)
+    return str(step)
+
+
+def changed_keys(old, new):
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return []
+    keys = list(old) + [key for key in new if key not in old]
+    return [key for key in keys if old.get(key) != new.get(key)]
+
+
+def diff(old, new):
+    """Compare the steps of two renders
+
+    Steps with the same hash are unchanged, the others are loaded and
+    matched by :func:`identity`, in order.
+
+    Args:
+      old, new: the :func:`steps` of the renders
+
+    Returns:
+      ([(str, str, [str])], int): ``(sign, identity, changed keys)`` per added
+        (``+``), removed (``-``) or changed (``~``) step and the number of
+        unchanged steps
+    """
+    counts = {}
+    for key, _ in old:
+        counts[key] = counts.get(key, 0) + 1
+    added = []
+    for key, step in new:
+        if counts.get(key):
+            counts[key] -= 1
+        else:
+            added.append(step)
+    unchanged = len(new) - len(added)
+    removed = []
+    for key, step in reversed(old):
+        if counts.get(key):
+            counts[key] -= 1
+            removed.append(step)
+    removed.reverse()
+
+    def load(step):
+        return step.load() if isinstance(step, Fragment) else step
+
+    by_identity = OrderedDict()
+    for step in map(load, removed):
+        by_identity.setdefault(identity(step), []).append(step)
+    found = []
+    for step in map(load, added):
+        name = identity(step)
+        if by_identity.get(name):
+            found.append(('~', name, changed_keys(by_identity[name].pop(0), step)))
+        else:
+            found.append(('+', name, []))
+    for name, remaining in by_identity.items():
+        found.extend(('-', name, []) for _ in remaining)
+    return found, unchanged
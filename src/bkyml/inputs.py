@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+'''
+    Skip steps whose inputs did not change since they last passed
+
+    The hash of a step covers the step itself and the content of its input
+    files. File digests are kept in an index next to their size and
+    modification time, so a file is only read again once it changed, and
+    new or changed files are hashed in parallel. A step that passed records
+    its hash with ``bkyml cache record``, and the next pipeline generated
+    with the same hash skips the step.
+
+    Example::
+
+        from bkyml.inputs import Cache
+
+        cache = Cache('.bkyml-cache')
+        digest = cache.hash(['src/**/*.py', 'setup.cfg'])
+        cache.record(digest)
+        assert cache.passed(digest)
+'''
+from __future__ import division, print_function, absolute_import
+
+import hashlib
+import json
+import os
+import re
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+DEFAULT_CACHE_DIR = '.bkyml-cache'
+CACHE_DIR_ENV = 'BKYML_CACHE_DIR'
+# environment variable the hash of a step is passed to the step in
+HASH_ENV = 'BKYML_INPUTS_HASH'
+INDEX = 'inputs-index.json'
+PASSED = 'passed'
+WORKERS = 8
+CHUNK_SIZE = 1 << 20
+HASH = re.compile(r'\A[0-9a-f]{64}\Z')
+
+
+def default_cache_dir():
+    return os.environ.get(CACHE_DIR_ENV) or DEFAULT_CACHE_DIR
+
+
+def now():
+    """The current time in nanoseconds, like ``st_mtime_ns``"""
+    return int(time.time() * 1e9)
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def expand(patterns):
+    """Paths matching the globs, a directory standing for everything below it"""
+    # imported here as only --cache-inputs needs the thread pool
+    from bkyml import globbing
+    expanded = []
+    for pattern in patterns:
+        if not globbing.MAGIC.search(pattern) and os.path.isdir(pattern):
+            pattern = pattern.rstrip('/') + '/**'
+        expanded.append(pattern)
+    return globbing.scan_all(expanded)
+
+
+class Index:
+    """Digests of files, recomputed only once their size or modification time changes
+
+    Args:
+      path (str): the index file, created on :meth:`save`
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        written = 0
+        try:
+            with open(path) as stream:
+                data = json.load(stream)
+            self.files, written = data['files'], data['written']
+        except (OSError, ValueError, KeyError):
+            # a missing or broken index only costs hashing everything again
+            pass
+        # like git, files modified while or after the index was last written
+        # may change again within the same timestamp, so they are hashed again
+        self.racy = written
+        self.started = now()
+        self.dirty = False
+
+    def digests(self, paths, workers=WORKERS):
+        """The digest of every regular file in ``paths``
+
+        Returns:
+          [(str, str)]: path and digest, other paths are left out
+        """
+        found, stale = [], []
+        # much cheaper than os.path.abspath, paths only have to be unique
+        cwd = os.getcwd().rstrip('/') + '/'
+        files, racy = self.files, self.racy
+        for path in paths:
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(info.st_mode):
+                continue
+            key = path if path.startswith('/') else cwd + path
+            entry = files.get(key)
+            if entry is None or entry[0] != info.st_size or entry[1] != info.st_mtime_ns \
+               or info.st_mtime_ns >= racy:
+                stale.append((key, info))
+            found.append((path, key))
+        if stale:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                digests = pool.map(file_digest, [key for key, _ in stale])
+                for (key, info), digest in zip(stale, digests):
+                    self.files[key] = [info.st_size, info.st_mtime_ns, digest]
+            self.dirty = True
+        return [(path, self.files[key][2]) for path, key in found]
+
+    def save(self):
+        """Write the index if any digest was computed since it was loaded"""
+        if not self.dirty:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary = '{path}.{pid}'.format(path=self.path, pid=os.getpid())
+        with open(temporary, 'w') as stream:
+            json.dump({'written': self.started, 'files': self.files}, stream,
+                      separators=(',', ':'))
+        os.replace(temporary, self.path)
+        self.racy = self.started
+        self.dirty = False
+
+
+class Cache:
+    """The index and the hashes of the steps that passed, in one directory
+
+    Indexes are shared by all caches of the same directory in a process, so
+    a batch or a daemon only loads them once.
+
+    Args:
+      directory (str): defaults to ``$BKYML_CACHE_DIR`` or ``.bkyml-cache``
+    """
+
+    INDEXES = {}
+
+    def __init__(self, directory=None):
+        self.directory = directory or default_cache_dir()
+        path = os.path.abspath(os.path.join(self.directory, INDEX))
+        if path not in Cache.INDEXES:
+            Cache.INDEXES[path] = Index(path)
+        self.index = Cache.INDEXES[path]
+
+    def hash(self, patterns, step=None):
+        """Hash of ``step`` and of the paths and contents of the files matching ``patterns``
+
+        Args:
+          patterns ([str]): globs, see :func:`bkyml.globbing.scan`
+          step: anything JSON can serialize that identifies the step
+        """
+        digests = self.index.digests(expand(patterns))
+        self.index.save()
+        combined = hashlib.sha256(json.dumps(step).encode('utf-8'))
+        combined.update(''.join('\0%s\0%s' % pair for pair in digests)
+                        .encode('utf-8', 'surrogateescape'))
+        return combined.hexdigest()
+
+    def record(self, digest):
+        """Remember that the step with hash ``digest`` passed"""
+        directory = os.path.join(self.directory, PASSED)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, digest), 'w'):
+            pass
+
+    def passed(self, digest):
+        return os.path.exists(os.path.join(self.directory, PASSED, digest))
@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+'''
+    Run the command steps of a pipeline on this machine
+
+    :class:`Runner` runs up to a number of jobs at once, each in a shell of
+    its own, and writes their output as it comes, every line prefixed with
+    the name of its job. Steps start in the order Buildkite would start
+    them: once the ``wait`` and ``block`` steps before them and the steps
+    they depend on finished (see :mod:`bkyml.critical`), the highest
+    ``priority`` first. A command step runs a job per ``parallelism``,
+    telling it apart by ``BUILDKITE_PARALLEL_JOB``, and only
+    ``concurrency`` jobs of a ``concurrency_group`` run at once. Jobs get
+    the ``env`` of the pipeline and of their step, fail after their
+    ``timeout_in_minutes`` and are retried by their ``retry: automatic``
+    rules; failures matching ``soft_fail`` do not fail the step.
+
+    A failed step stops the steps after the next ``wait``, unless it
+    continues on failure, and the steps depending on it, unless they allow
+    it to fail. ``block`` steps are unblocked right away; trigger steps,
+    plugins and conditions are not run.
+
+    Example::
+
+        from bkyml import local, simulation
+
+        runner = local.Runner(simulation.load('pipeline.yml'), jobs=4)
+        results = runner.run()
+'''
+from __future__ import division, print_function, absolute_import
+
+import heapq
+import itertools
+import os
+import queue
+import shlex
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+
+from bkyml import chunks
+from bkyml import graph
+from bkyml import incremental
+from bkyml import simulation
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+DEFAULT_SHELL = '/bin/bash -e -c'
+
+PASSED = 'passed'
+SOFT_FAILED = 'soft failed'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+# not run as a step it waits for failed
+NOT_RUN = 'not run'
+# outcomes the steps waiting for a step go on after
+GOOD = (PASSED, SOFT_FAILED, SKIPPED)
+
+
+def name(step):
+    """What the lines of the jobs of a step are prefixed with"""
+    for found in ('label', 'key', 'name', 'trigger'):
+        if isinstance(step.get(found), str):
+            return step[found]
+    return script(step).split('\n', 1)[0] or incremental.identity(step)
+
+
+def script(step):
+    """The commands of a step, one per line"""
+    commands = step.get('command', step.get('commands'))
+    if isinstance(commands, list):
+        return '\n'.join(str(command) for command in commands)
+    return '' if commands is None else str(commands)
+
+
+def matches(exit_status, rule):
+    """Whether an ``exit_status`` of a ``retry`` or ``soft_fail`` rule matches"""
+    if rule == '*':
+        return True
+    if isinstance(rule, list):
+        return any(matches(exit_status, found) for found in rule)
+    try:
+        return int(rule) == exit_status
+    except (TypeError, ValueError):
+        return False
+
+
+def retries(step, exit_status):
+    """How often a job of a step that failed with ``exit_status`` is retried"""
+    retry = step.get('retry')
+    automatic = retry.get('automatic') if isinstance(retry, dict) else None
+    if automatic is True:
+        return simulation.DEFAULT_RETRY_LIMIT
+    if isinstance(automatic, dict):
+        automatic = [automatic]
+    for rule in automatic if isinstance(automatic, list) else ():
+        if isinstance(rule, dict) and matches(exit_status, rule.get('exit_status', '*')):
+            return int(rule.get('limit', simulation.DEFAULT_RETRY_LIMIT))
+    return 0
+
+
+def soft_fails(step, exit_status):
+    """Whether a job of a step failing with ``exit_status`` does not fail the step"""
+    soft_fail = step.get('soft_fail')
+    if isinstance(soft_fail, list):
+        return any(isinstance(rule, dict) and matches(exit_status, rule.get('exit_status'))
+                   for rule in soft_fail)
+    return bool(soft_fail)
+
+
+def requirements(steps):
+    """Per step ``(position, allowed to fail or not run)`` of the steps it waits for"""
+    keys = {step['key']: index for index, step in enumerate(steps)
+            if isinstance(step, dict) and 'key' in step}
+    found = []
+    barrier, since = None, []
+    for index, step in enumerate(steps):
+        before = [] if barrier is None else [(barrier, False)]
+        if chunks.is_barrier(step):
+            allowed = isinstance(step, dict) and bool(step.get('continue_on_failure'))
+            before.extend((other, allowed) for other in since)
+            barrier, since = index, []
+        else:
+            since.append(index)
+        if isinstance(step, dict):
+            depends = step.get('depends_on')
+            for dependency in [depends] if isinstance(depends, (str, dict)) else depends or ():
+                if isinstance(dependency, dict):
+                    before.append((keys[dependency['step']],
+                                   bool(dependency.get('allow_failure'))))
+                else:
+                    before.append((keys[dependency], False))
+        found.append(before)
+    return found
+
+
+class Job:
+    """A run of a job of a step"""
+
+    def __init__(self, index, number, count, attempt=0):
+        self.index = index
+        self.number = number
+        self.count = count
+        self.attempt = attempt
+        self.process = None
+        self.deadline = None
+        self.timed_out = False
+
+
+class Result:
+    """What became of a step
+
+    Attributes:
+      outcome (str): one of :data:`PASSED`, :data:`SOFT_FAILED`,
+        :data:`FAILED`, :data:`SKIPPED` or :data:`NOT_RUN`
+      duration (float): seconds from the start of its first job to the end of its last
+      attempts (int): the number of jobs run, retries included
+      exit_status (int): the exit status of the last failed job
+    """
+
+    def __init__(self):
+        self.outcome = None
+        self.started = None
+        self.finished = None
+        self.attempts = 0
+        self.exit_status = None
+        self.remaining = 0
+
+    @property
+    def duration(self):
+        if self.started is None:
+            return 0.0
+        return self.finished - self.started
+
+
+class Runner:
+    """Run the command steps of a pipeline, up to ``jobs`` at once
+
+    Args:
+      steps ([dict or str]): the steps of a pipeline
+      env (dict): the ``env`` of the pipeline
+      jobs (int): how many jobs run at once, defaults to the number of CPUs
+      shell (str): the command running the commands of a job, which are
+        passed as its last argument
+      output: the stream the output of the jobs is written to
+
+    Raises:
+      ValueError: if steps depend on unknown keys or go round in a circle
+
+    Attributes:
+      duration (float): the seconds :meth:`run` took
+    """
+
+    def __init__(self, steps, env=None, jobs=None, shell=DEFAULT_SHELL, output=None):
+        graph.validate(steps)
+        self.steps = steps
+        self.env = env or {}
+        self.jobs = jobs or os.cpu_count() or 1
+        self.shell = shlex.split(shell)
+        self.output = output or sys.stdout
+        self.lock = threading.Lock()
+        self.finished = queue.Queue()
+        self.results = [Result() for _ in steps]
+        self.before = requirements(steps)
+        self.pending = [len(found) for found in self.before]
+        self.after = [[] for _ in steps]
+        for index, found in enumerate(self.before):
+            for other, _ in found:
+                self.after[other].append(index)
+        # (-priority, order, job) of the jobs that can start
+        self.ready = []
+        self.order = itertools.count()
+        self.groups = {}
+        self.running = []
+        self.duration = 0.0
+
+    def write(self, prefix, line):
+        with self.lock:
+            self.output.write('[{prefix}] {line}\n'.format(prefix=prefix, line=line))
+            self.output.flush()
+
+    def prefix(self, job):
+        prefix = name(self.steps[job.index])
+        if job.count > 1:
+            prefix += ' #%d' % job.number
+        return prefix
+
+    def run(self):
+        """Run every step
+
+        Returns:
+          [:obj:`Result`]: what became of every step
+        """
+        started = time.monotonic()
+        try:
+            self.release([index for index, count in enumerate(self.pending) if not count])
+            self.start()
+            while self.running:
+                try:
+                    job, exit_status = self.finished.get(timeout=self.timeout())
+                except queue.Empty:
+                    pass
+                else:
+                    self.running.remove(job)
+                    self.finish(job, exit_status)
+                    self.start()
+                # other jobs finishing all the time must not keep overdue ones alive
+                self.expire()
+        finally:
+            for job in self.running:
+                self.kill(job)
+            self.duration = time.monotonic() - started
+        return self.results
+
+    def timeout(self):
+        deadlines = [job.deadline for job in self.running if job.deadline is not None]
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.monotonic())
+
+    def expire(self):
+        now = time.monotonic()
+        for job in self.running:
+            if job.deadline is not None and job.deadline <= now and not job.timed_out:
+                job.timed_out = True
+                self.write(self.prefix(job), 'timed out after %s minutes'
+                           % self.steps[job.index]['timeout_in_minutes'])
+                self.kill(job)
+
+    @staticmethod
+    def kill(job):
+        try:
+            os.killpg(job.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def release(self, released):
+        """Start the steps in ``released``, which wait for nothing anymore, in order"""
+        released = deque(released)
+        while released:
+            index = released.popleft()
+            step = self.steps[index]
+            result = self.results[index]
+            if not all(allowed or self.results[other].outcome in GOOD
+                       for other, allowed in self.before[index]):
+                result.outcome = NOT_RUN
+            elif chunks.is_barrier(step):
+                result.outcome = PASSED
+            elif not isinstance(step, dict) or step.get('skip') or 'trigger' in step or \
+                    not script(step):
+                result.outcome = SKIPPED
+                if isinstance(step, dict) and not step.get('skip'):
+                    self.write(name(step), 'skipped, not run locally')
+            else:
+                count = int(step.get('parallelism') or 1)
+                result.remaining = count
+                for number in range(count):
+                    self.enqueue(Job(index, number, count))
+                continue
+            released.extend(self.unblocked(index))
+
+    def unblocked(self, index):
+        """The steps that wait for nothing anymore now that step ``index`` finished"""
+        found = []
+        for following in self.after[index]:
+            self.pending[following] -= 1
+            if not self.pending[following]:
+                found.append(following)
+        return found
+
+    def group(self, job):
+        step = self.steps[job.index]
+        group = step.get('concurrency_group')
+        if group is None:
+            return None
+        if group not in self.groups:
+            self.groups[group] = simulation.Group(max(1, int(step.get('concurrency') or 1)))
+        return self.groups[group]
+
+    def enqueue(self, job):
+        group = self.group(job)
+        if group is not None:
+            if group.running >= group.limit:
+                group.waiting.append(job)
+                return
+            group.running += 1
+        heapq.heappush(self.ready, (-int(self.steps[job.index].get('priority') or 0),
+                                    next(self.order), job))
+
+    def start(self):
+        while self.ready and len(self.running) < self.jobs:
+            _, _, job = heapq.heappop(self.ready)
+            self.launch(job)
+
+    def environment(self, job):
+        step = self.steps[job.index]
+        env = dict(os.environ)
+        env.update({'BUILDKITE': 'true', 'CI': 'true', 'BUILDKITE_LABEL': name(step),
+                    'BUILDKITE_RETRY_COUNT': str(job.attempt)})
+        if 'key' in step:
+            env['BUILDKITE_STEP_KEY'] = str(step['key'])
+        if step.get('parallelism'):
+            env['BUILDKITE_PARALLEL_JOB'] = str(job.number)
+            env['BUILDKITE_PARALLEL_JOB_COUNT'] = str(job.count)
+        for variables in (self.env, step.get('env')):
+            if isinstance(variables, dict):
+                env.update((str(key), '' if value is None else str(value))
+                           for key, value in variables.items())
+        return env
+
+    def launch(self, job):
+        step = self.steps[job.index]
+        result = self.results[job.index]
+        if result.started is None:
+            result.started = time.monotonic()
+        result.attempts += 1
+        prefix = self.prefix(job)
+        self.write(prefix, 'started' if not job.attempt else 'retry %d started' % job.attempt)
+        job.process = subprocess.Popen(self.shell + [script(step)], env=self.environment(job),
+                                       stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT, start_new_session=True)
+        if step.get('timeout_in_minutes'):
+            job.deadline = time.monotonic() + float(step['timeout_in_minutes']) * 60
+        self.running.append(job)
+        threading.Thread(target=self.forward, args=(job, prefix), daemon=True).start()
+
+    def forward(self, job, prefix):
+        """Write the output of a job as it comes and report its exit status"""
+        for line in job.process.stdout:
+            self.write(prefix, line.decode('utf-8', 'replace').rstrip('\r\n'))
+        job.process.stdout.close()
+        self.finished.put((job, job.process.wait()))
+
+    def finish(self, job, exit_status):
+        step = self.steps[job.index]
+        result = self.results[job.index]
+        result.finished = time.monotonic()
+        group = self.group(job)
+        if group is not None:
+            group.running -= 1
+            if group.waiting:
+                self.enqueue(group.waiting.popleft())
+        prefix = self.prefix(job)
+        if exit_status:
+            if job.timed_out:
+                # like an agent, which reports a job it had to stop as exit status -1
+                exit_status = -1
+            self.write(prefix, 'exited with status %d' % exit_status)
+            if job.attempt < retries(step, exit_status):
+                self.enqueue(Job(job.index, job.number, job.count, job.attempt + 1))
+                return
+            result.exit_status = exit_status
+            if soft_fails(step, exit_status):
+                result.outcome = result.outcome or SOFT_FAILED
+            else:
+                result.outcome = FAILED
+        else:
+            self.write(prefix, 'passed')
+        result.remaining -= 1
+        if not result.remaining:
+            result.outcome = result.outcome or PASSED
+            self.release(self.unblocked(job.index))
+
+
+def summary(steps, results, duration):
+    """A line per step that was not skipped and the counts of every outcome"""
+    lines = []
+    counts = OrderedDict((outcome, 0) for outcome in (PASSED, SOFT_FAILED, FAILED, NOT_RUN))
+    for step, result in zip(steps, results):
+        if chunks.is_barrier(step) or result.outcome == SKIPPED:
+            continue
+        counts[result.outcome] += 1
+        line = '{outcome:<12} {duration:8.1f}s  {name}'.format(
+            outcome=result.outcome, duration=result.duration,
+            name=incremental.identity(step))
+        if result.exit_status is not None:
+            line += ' (exit status %d)' % result.exit_status
+        lines.append(line)
+    lines.append(', '.join('%d %s' % (count, outcome) for outcome, count in counts.items()) +
+                 ' in %.1fs' % duration)
+    return '\n'.join(lines)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+'''
+    Cache whole rendered pipelines, keyed by everything they are rendered from
+
+    Rendering is deterministic: steps are emitted in the order they are
+    given and the keys of every step in a fixed order, so the same input
+    always produces the same bytes. A key hashes the input in a canonical
+    form together with the versions of bkyml, ruamel.yaml and Python, a
+    digest of the sources of bkyml (a checkout changes them without changing
+    the version) and the output options, and a hit returns the stored bytes
+    without parsing or rendering anything. Entries are files in a directory
+    whose total size is bounded, evicting the least recently used ones first.
+
+    What rendering writes to stderr, e.g. the steps ``--watch`` pruned, is
+    stored with the output by :func:`pack`, so a hit can write it again.
+
+    Example::
+
+        from bkyml.outputs import OutputCache, key, pack, recorded, unpack
+
+        cache = OutputCache('.bkyml-cache')
+        pipeline_key = key('yaml', steps)
+        entry = cache.get(pipeline_key)
+        if entry is None:
+            output, messages = recorded(lambda: render(steps))
+            cache.put(pipeline_key, pack(output.encode(), messages.encode()))
+        else:
+            output, messages = unpack(entry)
+            sys.stderr.write(messages.decode())
+'''
+from __future__ import division, print_function, absolute_import
+
+import contextlib
+import hashlib
+import io
+import json
+import os
+import sys
+from functools import lru_cache
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+DIRECTORY = 'outputs'
+DEFAULT_MAX_BYTES = 64 << 20
+# distributions whose version can change the rendered bytes
+DISTRIBUTIONS = ('bkyml', 'ruamel.yaml')
+
+
+def sources():
+    """Digest of the modules of bkyml"""
+    package = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(package)):
+        if name.endswith('.py'):
+            with open(os.path.join(package, name), 'rb') as stream:
+                digest.update(name.encode('utf-8') + b'\0' + stream.read() + b'\0')
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=1)
+def versions():
+    """Versions of Python and of the distributions rendering the output, and
+    the digest of the :func:`sources` of bkyml"""
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:  # pragma: no cover
+        from pkg_resources import get_distribution, DistributionNotFound \
+            as PackageNotFoundError
+
+        def version(name):
+            return get_distribution(name).version
+    found = [sys.version]
+    for name in DISTRIBUTIONS:
+        try:
+            found.append(version(name))
+        except PackageNotFoundError:  # pragma: no cover
+            found.append(None)
+    found.append(sources())
+    return found
+
+
+def key(*parts):
+    """Canonical hash of ``parts`` and of :func:`versions`
+
+    Args:
+      *parts: anything JSON can serialize, e.g. the format name and the input
+
+    Returns:
+      str: hexadecimal SHA-256
+    """
+    canonical = json.dumps([versions()] + list(parts), separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8', 'surrogateescape')).hexdigest()
+
+
+def recorded(render):
+    """Call ``render`` and record what it writes to stderr
+
+    The messages are passed on to stderr as well, also if ``render`` fails.
+
+    Returns:
+      (object, str): what ``render`` returned and the messages
+    """
+    messages = io.StringIO()
+    try:
+        with contextlib.redirect_stderr(messages):
+            return render(), messages.getvalue()
+    finally:
+        sys.stderr.write(messages.getvalue())
+
+
+def pack(output, messages=b''):
+    """A cache entry of an ``output`` and the ``messages`` (both bytes) rendering it wrote"""
+    return str(len(messages)).encode('ascii') + b'\n' + messages + output
+
+
+def unpack(entry):
+    """``(output, messages)`` of an entry made by :func:`pack`"""
+    length, _, rest = entry.partition(b'\n')
+    length = int(length)
+    return rest[length:], rest[:length]
+
+
+class OutputCache:
+    """A directory of rendered outputs bounded in size
+
+    Args:
+      directory (str): the cache directory, the outputs go into its
+        ``outputs`` subdirectory; defaults to ``$BKYML_CACHE_DIR`` or
+        ``.bkyml-cache``
+      max_bytes (int): evict the least recently used outputs beyond this size
+    """
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        if directory is None:
+            from bkyml import inputs
+            directory = inputs.default_cache_dir()
+        self.directory = os.path.join(directory, DIRECTORY)
+        self.max_bytes = max_bytes
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def get(self, digest):
+        """The cached output, None on a miss
+
+        A hit marks the output as recently used.
+        """
+        try:
+            with open(self.path(digest), 'rb') as stream:
+                output = stream.read()
+            os.utime(self.path(digest))
+        except OSError:
+            return None
+        return output
+
+    def put(self, digest, output):
+        """Store ``output`` (bytes) and evict old outputs until the cache fits"""
+        if len(output) > self.max_bytes:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        temporary = '{path}.{pid}.tmp'.format(path=self.path(digest), pid=os.getpid())
+        with open(temporary, 'wb') as stream:
+            stream.write(output)
+        os.replace(temporary, self.path(digest))
+        self.evict()
+
+    def entries(self):
+        """``(last used, size, path)`` of every output, oldest first"""
+        found = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            found.append((info.st_mtime_ns, info.st_size, path))
+        return sorted(found)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+'''
+    Build pipelines from Python without going through the command line
+
+    Example::
+
+        from bkyml import Pipeline
+
+        pipeline = Pipeline()
+        pipeline.comment('Run all tests')
+        for test_dir in ('a', 'b'):
+            pipeline.command('run_tests ' + test_dir, label='Tests for ' + test_dir)
+        pipeline.wait()
+        print(pipeline.dump(), end='')
+'''
+from __future__ import division, print_function, absolute_import
+
+import argparse
+import sys
+
+from bkyml import barriers
+from bkyml import changes
+from bkyml import critical
+from bkyml import emitter
+from bkyml import formats
+from bkyml import graph
+from bkyml import outputs
+from bkyml import simulation
+from bkyml import skeleton
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+# options holding lists of lists of words on the command line
+NESTED_LISTS = ('command', 'artifact_paths', 'cache_inputs', 'depends_on', 'needs_artifact')
+# options holding KEY VALUE pairs on the command line
+PAIRS = ('env', 'agents', 'build_env', 'build_meta_data')
+
+
+# keyword arguments named differently than the option they stand for
+ALIASES = {'plugins': 'plugin'}
+DESTINATIONS = {}
+
+
+def destinations(subcommand):
+    """Names of the options the parser of ``subcommand`` stores"""
+    if subcommand not in DESTINATIONS:
+        action = argparse.ArgumentParser().add_subparsers()
+        subcommand.install(action)
+        subparser, = action.choices.values()
+        # pylint: disable=protected-access
+        DESTINATIONS[subcommand] = {
+            parser_action.dest for parser_action in subparser._actions
+        } - {'help'}
+    return DESTINATIONS[subcommand]
+
+
+def check_options(method, subcommand, options):
+    """Reject keyword arguments the command line would reject as well
+
+    Raises:
+      TypeError: for an option ``subcommand`` does not have
+    """
+    known = destinations(subcommand)
+    for name in options:
+        if ALIASES.get(name, name) not in known:
+            raise TypeError("{method}() got an unexpected keyword argument '{name}'".format(
+                method=method, name=name))
+
+
+class ParserErrors:
+    """Stands in for the parser in ``assert_post_parse`` and raises instead of exiting"""
+
+    @staticmethod
+    def error(message):
+        raise argparse.ArgumentTypeError(message)
+
+
+def words(value):
+    if isinstance(value, str):
+        return [value]
+    return list(value)
+
+
+def plugin_list(plugins):
+    """Convert ``{name: {key: value} or None}`` into the shape of ``--plugin``"""
+    ret = []
+    for name, config in plugins.items():
+        ret.append([name] + [[key, value] for key, value in (config or {}).items()])
+    return ret
+
+
+def namespace(**options):
+    """Turn Python values into the namespace the argument parser would produce"""
+    for name in NESTED_LISTS:
+        if options.get(name) is not None:
+            options[name] = [words(options[name])]
+    for name in PAIRS:
+        if options.get(name) is not None:
+            options[name] = [list(pair) for pair in options[name].items()]
+    if options.get('branches') is not None:
+        options['branches'] = words(options['branches'])
+    if options.get('plugins') is not None:
+        options['plugin'] = plugin_list(options.pop('plugins'))
+    if options.get('matrix') is not None:
+        options['matrix'] = [(name, words(values)) for name, values in options['matrix'].items()]
+    if options.get('for_each_glob') is not None:
+        options['for_each_glob'] = words(options['for_each_glob'])
+    if options.get('watch') is not None:
+        options['watch'] = words(options['watch'])
+    return argparse.Namespace(**options)
+
+
+def select_field(key, label, hint, required, default, options):
+    return [key, label, hint, required, default] + [
+        '{value}={label}'.format(value=value, label=option_label)
+        for value, option_label in options.items()
+    ]
+
+
+class Pipeline:
+    """Collects steps in memory and serializes the whole document once
+
+    Every method mirrors the subcommand of the same name. Options use the
+    names of the command line flags with underscores (``--build-env`` is
+    ``build_env``), maps are passed as dicts and flags taking several words
+    accept a string or a list. Methods return the pipeline, so calls can be
+    chained.
+
+    Args:
+      changed_files ([str]): the changed paths, like ``--changed-files``;
+        command steps whose ``watch`` matches none of them are left out
+      branch (str): the branch being built, like ``--resolve-branches``;
+        steps whose ``branches`` filter does not match it are left out
+      anchors (bool): like ``--anchors``, write repeated ``env``, ``agents``
+        and ``plugins`` maps once and alias them after; equal maps are
+        shared in memory as well. Needs the ``yaml`` format
+    """
+
+    def __init__(self, changed_files=None, branch=None, anchors=False):
+        self.document = formats.Document()
+        # the --needs-artifact of every step, see eliminate_waits
+        self.needs = []
+        # the --estimate of every step, see critical_path
+        self.estimates = []
+        self.anchors = emitter.Anchors() if anchors else None
+        self.branch = branch or None
+        self.changes = None
+        if changed_files is not None:
+            self.changes = changes.ChangeIndex(changed_files)
+
+    def __len__(self):
+        return len(self.document.steps)
+
+    def add(self, subcommand, parsed):
+        for step in skeleton.expanded(subcommand, parsed, self.changes, self.branch):
+            data = subcommand.data(step)
+            if subcommand.kind == 'step' and data is not None:
+                if self.anchors is not None:
+                    data = self.anchors.intern_step(data)
+                self.needs.append(skeleton.Command.needs(step))
+                self.estimates.append(getattr(step, 'estimate', None))
+            self.document.add(subcommand.kind, data)
+        return self
+
+    def eliminate_waits(self):
+        """Replace the waits after which every step up to the next barrier declared
+        ``needs_artifact`` by dependencies on the steps uploading those artifacts
+
+        See :mod:`bkyml.barriers`.
+
+        Returns:
+          int: the number of waits removed
+        """
+        gone = barriers.removable(self.document.steps, self.needs)
+        self.estimates = [estimate for index, estimate in enumerate(self.estimates)
+                          if index not in gone]
+        self.document.steps, self.needs, removed = barriers.eliminate(self.document.steps,
+                                                                      self.needs)
+        return removed
+
+    def critical_path(self, timings=None, default_duration=None):
+        """The earliest start and the slack of every step and the critical path
+
+        See :mod:`bkyml.critical`.
+
+        Args:
+          timings (dict): step key, label or name to seconds; steps without
+            take their ``estimate``
+          default_duration (float): seconds of the steps with neither,
+            defaults to the mean of the others
+
+        Returns:
+          :obj:`bkyml.critical.Analysis`
+        """
+        durations, _, _ = critical.durations(self.document.steps, timings or {},
+                                             self.estimates, default_duration)
+        return critical.Analysis(self.document.steps, durations)
+
+    def prioritize(self, timings=None, default_duration=None, max_slack=0.0,
+                   priority=critical.PRIORITY):
+        """Give the command steps with at most ``max_slack`` seconds of slack a
+        ``priority`` and order the steps between barriers longest first
+
+        Takes the arguments of :meth:`critical_path`, whose analysis it returns.
+        """
+        analysis = self.critical_path(timings, default_duration)
+        self.document.steps, order = critical.prioritize(self.document.steps, analysis,
+                                                         max_slack, priority)
+        self.needs = [self.needs[index] for index in order]
+        self.estimates = [self.estimates[index] for index in order]
+        return analysis
+
+    def simulate(self, agents, timings=None, default_duration=None, failure_rate=0.0, seed=0):
+        """Run the jobs of the pipeline on ``agents``, a dict of queue name to agents
+
+        Takes the timings like :meth:`critical_path`; see
+        :mod:`bkyml.simulation` for the other arguments.
+
+        Returns:
+          :obj:`bkyml.simulation.Simulation`
+        """
+        durations, _, _ = critical.durations(self.document.steps, timings or {},
+                                             self.estimates, default_duration)
+        return simulation.Simulation(self.document.steps, durations, agents, failure_rate,
+                                     seed)
+
+    def format(self, fmt):
+        """The format to serialize with, anchoring mappings if the pipeline does"""
+        found = skeleton.FORMATS[fmt]()
+        if self.anchors is None:
+            return found
+        if fmt != 'yaml':
+            raise ValueError('anchors need the yaml format, not %s' % fmt)
+        return found.anchored(self.anchors.copy())
+
+    def validate(self):
+        """Check the ``depends_on`` of every step is on a known key and none go round in a circle
+
+        Raises:
+          ValueError: naming the offending steps, see :mod:`bkyml.graph`
+        """
+        graph.validate(self.document.steps)
+
+    def comment(self, *lines):
+        return self.add(skeleton.Comment, namespace(str=list(lines)))
+
+    def env(self, variables):
+        return self.add(skeleton.Env, namespace(var=list(variables.items())))
+
+    def steps(self):
+        """Emit the ``steps:`` key even if no steps follow"""
+        return self.add(skeleton.Steps, None)
+
+    def command(self, command, **options):
+        """Add a command step
+
+        Args:
+          command (str or [str]): the shell command/s to run
+          **options: the remaining ``command`` flags, e.g. ``label``,
+            ``env`` (dict), ``plugins`` (dict of plugin name to config),
+            ``retry``, ``retry_automatic_tuple`` (list of pairs), ``matrix``
+            (dict of dimension name to values), ``matrix_exclude`` (list
+            of dicts of dimension name to value), ``for_each_glob`` (a
+            pattern or a list of them), ``watch`` (a path, a glob or a
+            list of them), ``cache_inputs`` (a glob or a list of them), ``key``,
+            ``depends_on`` (a key or a list of them), ``needs_artifact`` (a
+            path, a glob or a list of them, see :meth:`eliminate_waits`) or
+            ``estimate`` (seconds, see :meth:`critical_path`)
+        """
+        check_options('command', skeleton.Command, options)
+        options.setdefault('retry_manual_allowed', skeleton.RETRY_MANUAL_ALLOWED_DEFAULT)
+        options.setdefault('retry_manual_permit_on_passed',
+                           skeleton.RETRY_MANUAL_PERMIT_ON_PASSED_DEFAULT)
+        parsed = namespace(command=command, **options)
+        skeleton.Command.assert_post_parse(parsed, ParserErrors)
+        return self.add(skeleton.Command, parsed)
+
+    def plugin(self, plugins, name=None):
+        """Add a plugin step
+
+        Args:
+          plugins (dict): plugin name to its configuration dict or None
+          name (str): name of the step
+        """
+        return self.add(skeleton.Plugin, namespace(plugins=plugins, name=name))
+
+    def wait(self, continue_on_failure=False):
+        return self.add(skeleton.Wait, namespace(continue_on_failure=continue_on_failure))
+
+    def trigger(self, pipeline, **options):
+        """Add a trigger step
+
+        Args:
+          pipeline (str): name of the pipeline to trigger
+          **options: the remaining ``trigger`` flags, e.g. ``label``,
+            ``is_async``, ``build_message``, ``build_env`` (dict), ``key`` or
+            ``depends_on`` (a key or a list of them)
+        """
+        check_options('trigger', skeleton.Trigger, options)
+        return self.add(skeleton.Trigger, namespace(pipeline=pipeline, **options))
+
+    def block(self, label, prompt=None, branches=None, text_fields=(), select_fields=(),
+              key=None, depends_on=None):
+        """Add a block step
+
+        Args:
+          label (str): label of the block step
+          prompt (str): message displayed in the dialog box
+          branches (str or [str]): branch patterns
+          text_fields ([tuple]): ``(key, label, hint, required, default)``
+          select_fields ([tuple]): ``(key, label, hint, required, default, options)``
+            where options maps values to their labels
+          key (str): key other steps can depend on
+          depends_on (str or [str]): keys of the steps this one waits for
+        """
+        fields = {}
+        if text_fields:
+            fields['field_text'] = [
+                [key, field_label, hint, str(required).lower(), default]
+                for key, field_label, hint, required, default in text_fields
+            ]
+        if select_fields:
+            fields['field_select'] = [
+                select_field(key, field_label, hint, str(required).lower(), default, options)
+                for key, field_label, hint, required, default, options in select_fields
+            ]
+        return self.add(skeleton.Block,
+                        namespace(label=label, prompt=prompt, branches=branches, key=key,
+                                  depends_on=depends_on, **fields))
+
+    def dump(self, fmt='yaml', cache=None):
+        """Serialize the pipeline
+
+        Args:
+          fmt (str): one of the ``--format`` choices
+          cache (:obj:`bkyml.outputs.OutputCache`): return the output of an
+            identical pipeline serialized before and keep the output otherwise
+
+        Returns:
+          str: the whole document
+
+        Raises:
+          ValueError: see :meth:`validate`
+        """
+        self.validate()
+        if cache is None:
+            return self.format(fmt).document(self.document)
+        document = self.document
+        digest = outputs.key(fmt, self.anchors is not None, document.comments, document.env,
+                             document.has_steps, document.steps)
+        entry = cache.get(digest)
+        if entry is None:
+            output, messages = outputs.recorded(lambda: self.format(fmt).document(document))
+            cache.put(digest, outputs.pack(output.encode('utf-8'), messages.encode('utf-8')))
+            return output
+        output, messages = outputs.unpack(entry)
+        sys.stderr.write(messages.decode('utf-8'))
+        return output.decode('utf-8')
+
+    def write(self, stream, fmt='yaml', cache=None):
+        stream.write(self.dump(fmt, cache))
+
+
+class PipelineWriter(Pipeline):
+    """Writes every part to a stream as soon as it is added
+
+    Memory use stays constant no matter how many steps are written, apart
+    from the names of the steps with a ``key`` or ``depends_on``, which are
+    checked when the writer is closed. Parts are written in the order they
+    are added and ``steps:`` is written before the first step unless
+    :meth:`steps` was called. ``json`` and ``yaml-flow`` need ``env`` before
+    the first step and comments before everything else.
+
+    Example::
+
+        with PipelineWriter('pipeline.yml', flush_every=1000) as pipeline:
+            for test in tests:
+                pipeline.command('run_tests ' + test)
+
+    Args:
+      stream: a writable text stream or the path of a file to write,
+        defaults to stdout
+      fmt (str): one of the ``--format`` choices
+      flush_every (int): flush after this many steps, 0 to leave it to the stream
+      changed_files ([str]): the changed paths, like ``--changed-files``
+      branch (str): the branch being built, like ``--resolve-branches``
+      anchors (bool): like ``--anchors``, needs the ``yaml`` format
+    """
+
+    def __init__(self, stream=None, fmt='yaml', flush_every=0, changed_files=None,
+                 branch=None, anchors=False):
+        super().__init__(changed_files, branch, anchors)
+        self.path = stream if isinstance(stream, str) else None
+        self.stream = None if self.path else stream
+        self.writer = None
+        self.graph = graph.Graph()
+        self.fmt = fmt
+        self.flush_every = flush_every
+
+    def __enter__(self):
+        if self.path is not None:
+            self.stream = open(self.path, 'w')
+        elif self.stream is None:
+            self.stream = sys.stdout
+        self.writer = self.format(self.fmt).writer(self.stream, flush_every=self.flush_every)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.graph.validate()
+                self.writer.close()
+        finally:
+            if self.path is not None:
+                self.stream.close()
+
+    def __len__(self):
+        return self.writer.count
+
+    def add(self, subcommand, parsed):
+        if self.writer is None:
+            raise RuntimeError('PipelineWriter has to be used as a context manager')
+        for data in skeleton.items(subcommand, parsed, self.changes, self.branch):
+            self.writer.add(subcommand.kind, data)
+            if subcommand.kind == 'step' and data is not None:
+                self.graph.add(data)
+        return self
+
+    def validate(self):
+        self.graph.validate()
+
+    def dump(self, fmt='yaml', cache=None):
+        raise TypeError('PipelineWriter writes its steps as they are added')
+
+    def eliminate_waits(self):
+        raise TypeError('PipelineWriter can not change the steps it wrote already')
+
+    def prioritize(self, *args, **kwargs):
+        raise TypeError('PipelineWriter can not change the steps it wrote already')
+
+    def critical_path(self, *args, **kwargs):
+        raise TypeError('PipelineWriter does not keep the steps it wrote')
+
+    def simulate(self, *args, **kwargs):
+        raise TypeError('PipelineWriter does not keep the steps it wrote')
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+'''
+    Balance test files across shards by their historical durations
+
+    Timings files hold one ``PATH<TAB>SECONDS`` line per test file or a JSON
+    object mapping paths to seconds. Files without history are estimated from
+    their size, at the rate the files with history run at.
+'''
+from __future__ import division, print_function, absolute_import
+
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import sys
+from collections import OrderedDict
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+# rate for files without history when no file with history exists either
+DEFAULT_SECONDS_PER_KB = 1.0
+# number of files with history the rate of the files without history is taken from
+RATE_SAMPLE = 1000
+
+
+# the PATH<TAB>SECONDS lines of a timings file, skipping blank lines and comments;
+# PATH is empty for lines without a tab
+TIMING = re.compile(br'^(?!#|[ \t\r]*$)(?:([^\n]*)\t)?([^\t\n]*)$', re.M)
+
+
+def parse_timings(data):
+    """Parse the contents of a timings file
+
+    Args:
+      data (bytes): the ``PATH<TAB>SECONDS`` lines or the JSON object
+
+    Raises:
+      ValueError: for lines that are not ``PATH<TAB>SECONDS``
+
+    Returns:
+      dict: path as bytes to seconds
+    """
+    if data.lstrip().startswith(b'{'):
+        return {path.encode('utf-8'): float(seconds)
+                for path, seconds in json.loads(data.decode('utf-8')).items()}
+    try:
+        timings = {path: float(seconds) for path, seconds in TIMING.findall(data)}
+    except ValueError:
+        timings = {b'': None}
+    if b'' in timings:
+        # find the offending line only once the fast path failed
+        for number, line in enumerate(data.splitlines(), 1):
+            match = TIMING.match(line)
+            if match is None:
+                continue
+            try:
+                float(match.group(2))
+                if match.group(1):
+                    continue
+            except ValueError:
+                pass
+            raise ValueError('timings line {number}: expected PATH<TAB>SECONDS, got {line!r}'
+                             .format(number=number, line=line.decode('utf-8', 'replace')))
+    return timings
+
+
+def load_timings(stream):
+    """Read a timings file from a text stream
+
+    Returns:
+      dict: path to seconds
+    """
+    return {path.decode('utf-8'): seconds
+            for path, seconds in parse_timings(stream.read().encode('utf-8')).items()}
+
+
+def read_paths(stream):
+    """Non-blank lines of ``stream``, without duplicates, in order"""
+    paths = OrderedDict.fromkeys(line.strip() for line in stream)
+    paths.pop('', None)
+    return list(paths)
+
+
+def size(path):
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+def estimate(paths, timings, seconds_per_kb=None):
+    """Expected duration of every path
+
+    Args:
+      paths ([str]): the test files
+      timings (dict): path to seconds from previous builds
+      seconds_per_kb (float): rate for files without history, defaults to the
+        rate of a sample of the files with history
+
+    Returns:
+      [float]: seconds, in the order of ``paths``
+    """
+    sizes = {path: size(path) for path in paths if path not in timings}
+    if seconds_per_kb is None and sizes:
+        known = [path for path in paths if path in timings]
+        known = known[::len(known) // RATE_SAMPLE + 1]
+        known_bytes = sum(size(path) for path in known)
+        seconds_per_kb = DEFAULT_SECONDS_PER_KB
+        if known_bytes:
+            seconds_per_kb = sum(timings[path] for path in known) * 1024 / known_bytes
+    return [timings[path] if path in timings else sizes[path] * seconds_per_kb / 1024
+            for path in paths]
+
+
+def shard_count(durations, shards=None, target_duration=None):
+    """Number of shards, given directly or derived from a target duration"""
+    if shards is not None:
+        return shards
+    return max(1, int(math.ceil(sum(durations) / target_duration)))
+
+
+def partition(paths, durations, count):
+    """Longest processing time first: assign each file to the least loaded shard
+
+    Ties are broken by path and shard index, so the result only depends on
+    the input and never on the order of ``paths``.
+
+    Returns:
+      ([[str]], [float]): the sorted paths of every non-empty shard and the
+        predicted duration of each of them
+    """
+    heap = [(0.0, shard) for shard in range(count)]
+    shards = [[] for _ in range(count)]
+    for negative, path in sorted(zip([-duration for duration in durations], paths)):
+        load, shard = heap[0]
+        shards[shard].append(path)
+        heapq.heapreplace(heap, (load - negative, shard))
+    loads = [0.0] * count
+    for load, shard in heap:
+        loads[shard] = load
+    used = [shard for shard in range(count) if shards[shard]]
+    return [sorted(shards[shard]) for shard in used], [loads[shard] for shard in used]
+
+
+def read_lines(path):
+    """Non-blank lines of the file at ``path``, or of stdin for ``-``, as bytes
+
+    Files are memory-mapped and split in one go, which keeps reading lists of
+    millions of lines cheap. Lines are kept as bytes as decoding them would
+    cost more than the selection itself.
+    """
+    if path == '-':
+        stdin = getattr(sys.stdin, 'buffer', None)
+        data = stdin.read() if stdin is not None else sys.stdin.read().encode('utf-8')
+    else:
+        with open(path, 'rb') as stream:
+            try:
+                with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    data = mapped[:]
+            except ValueError:
+                # empty files can not be mapped
+                data = b''
+    return [line for line in map(bytes.strip, data.splitlines()) if line]
+
+
+def select(paths, timings, index, total):
+    """The paths job ``index`` of ``total`` parallel jobs runs
+
+    Every job computes the same longest processing time first partition as
+    :func:`partition`, but only collects its own shard. Paths without timings
+    are expected to take the mean duration of the paths with timings, so the
+    result only depends on the paths and the timings and every job agrees on
+    it without coordination.
+
+    Args:
+      paths ([bytes]): the test files or ids, in any order
+      timings (dict): path as bytes to seconds
+      index (int): the 0-based number of the job
+      total (int): the number of jobs
+
+    Returns:
+      [bytes]: the sorted paths of job ``index``
+    """
+    paths = sorted(paths)
+    durations = list(map(timings.get, paths))
+    known = [duration for duration in durations if duration is not None]
+    default = sum(known) / len(known) if known else 1.0
+    if len(known) < len(durations):
+        durations = [default if duration is None else duration for duration in durations]
+    # a stable sort keeps the paths of equal duration sorted
+    order = sorted(range(len(paths)), key=durations.__getitem__, reverse=True)
+    heap = [(0.0, shard) for shard in range(total)]
+    mine = []
+    for position in order:
+        load, shard = heap[0]
+        if shard == index:
+            mine.append(position)
+        heapq.heapreplace(heap, (load + durations[position], shard))
+    return [paths[position] for position in sorted(mine)]
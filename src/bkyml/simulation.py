@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+'''
+    Simulate how long a pipeline takes on a given number of agents
+
+    Every command step creates a job per ``parallelism`` once the steps it
+    waits for finished (see :mod:`bkyml.critical`). Jobs wait for an agent
+    of the ``queue`` of their ``agents``, ``default`` if they name none;
+    agents pick up the job of the highest ``priority`` first and the oldest
+    job among equals. Jobs of a ``concurrency_group`` only queue for an
+    agent while fewer than its ``concurrency`` of them are queued or
+    running. Trigger steps run without an agent, barriers take no time and
+    ``block`` steps are unblocked right away.
+
+    With a failure rate every run of a job fails at random and is retried
+    up to the ``limit`` of its ``retry: automatic`` rules. Jobs failing for
+    good are counted, and the steps after them run as if they had passed.
+
+    :class:`Simulation` is an event-driven simulation: a heap of the times
+    jobs finish and one heap of queued jobs per queue, so it takes time in
+    the order of ``n log n`` for ``n`` jobs.
+
+    Example::
+
+        from bkyml import critical, simulation
+
+        steps = simulation.load('pipeline.yml')
+        durations, _, _ = critical.durations(steps, timings)
+        result = simulation.Simulation(steps, durations, {'default': 10})
+'''
+from __future__ import division, print_function, absolute_import
+
+import heapq
+import itertools
+import json
+import random
+from collections import OrderedDict, deque
+
+from bkyml import chunks
+from bkyml import critical
+from bkyml import graph
+from bkyml import incremental
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+DEFAULT_QUEUE = 'default'
+# the limit of ``retry: automatic`` rules that do not give one
+DEFAULT_RETRY_LIMIT = 2
+
+
+def read(path):
+    """A rendered pipeline, read with libyaml if PyYAML has it
+
+    Returns:
+      dict: the document, a pipeline of nothing but steps as ``{'steps': steps}``
+
+    Raises:
+      OSError: if it can not be read
+      ValueError: if it is not JSON or YAML
+    """
+    with open(path, encoding='utf-8', errors='surrogateescape') as stream:
+        text = stream.read()
+    if text.lstrip().startswith('{'):
+        document = json.loads(text)
+    else:
+        try:
+            import yaml
+            from yaml import CSafeLoader
+        except ImportError:
+            from ruamel.yaml import YAMLError
+            try:
+                document = incremental.load_yaml(text)
+            except YAMLError as error:
+                raise ValueError(str(error))
+        else:
+            try:
+                document = yaml.load(text, Loader=CSafeLoader)
+            except yaml.YAMLError as error:
+                raise ValueError(str(error))
+    if not isinstance(document, dict):
+        document = {'steps': document}
+    return document
+
+
+def load(path):
+    """The steps of a rendered pipeline, see :func:`read`"""
+    return list(read(path).get('steps') or ())
+
+
+def queue(step):
+    """The queue of the agents running a step"""
+    agents = step.get('agents')
+    if isinstance(agents, dict):
+        return str(agents.get('queue', DEFAULT_QUEUE))
+    for agent in agents if isinstance(agents, list) else ():
+        if isinstance(agent, str) and agent.startswith('queue='):
+            return agent[len('queue='):]
+    return DEFAULT_QUEUE
+
+
+def retry_limit(step):
+    """How often a failed job of a step is retried automatically"""
+    retry = step.get('retry')
+    automatic = retry.get('automatic') if isinstance(retry, dict) else None
+    if automatic is True:
+        return DEFAULT_RETRY_LIMIT
+    if isinstance(automatic, dict):
+        automatic = [automatic]
+    if not isinstance(automatic, list):
+        return 0
+    return max((int(rule.get('limit', DEFAULT_RETRY_LIMIT)) for rule in automatic
+                if isinstance(rule, dict)), default=0)
+
+
+def runs_on_agent(step):
+    return isinstance(step, dict) and not chunks.is_barrier(step) and 'trigger' not in step
+
+
+class Queue:
+    """The agents of a queue and the jobs they ran
+
+    Attributes:
+      agents (int): the number of agents
+      jobs (int): the number of jobs run, retries included
+      busy (float): the seconds the agents were running jobs
+      waited (float): the seconds the jobs waited to start once they could
+      longest_wait (float): the longest a job waited
+    """
+
+    def __init__(self, agents):
+        self.agents = agents
+        self.free = agents
+        # (-priority, order, step, ready since, attempt) of the jobs waiting for an agent
+        self.ready = []
+        self.jobs = 0
+        self.busy = 0.0
+        self.waited = 0.0
+        self.longest_wait = 0.0
+
+    def utilization(self, duration):
+        """The share of the time the agents were busy"""
+        if not duration or not self.agents:
+            return 0.0
+        return self.busy / (self.agents * duration)
+
+    def mean_wait(self):
+        return self.waited / self.jobs if self.jobs else 0.0
+
+
+class Group:
+    """The jobs of a concurrency group, of which only ``limit`` are queued or running"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.running = 0
+        self.waiting = deque()
+
+
+class Simulation:
+    """Run the jobs of a pipeline on a number of agents per queue
+
+    Args:
+      steps ([dict or str]): the steps of a pipeline
+      durations ([float]): seconds every job of every step takes
+      agents (dict): queue name to the number of its agents
+      failure_rate (float): the probability every run of a job fails
+      seed: seed of the random failures
+
+    Raises:
+      ValueError: if steps depend on unknown keys or go round in a circle,
+        or run on a queue without agents
+
+    Attributes:
+      duration (float): the seconds the build takes
+      queues (OrderedDict): queue name to its :class:`Queue`
+      retries (int): the number of jobs retried
+      failed (int): the number of jobs that failed for good
+    """
+
+    def __init__(self, steps, durations, agents, failure_rate=0.0, seed=0):
+        graph.validate(steps)
+        self.steps = steps
+        self.durations = durations
+        self.queues = OrderedDict((name, Queue(count)) for name, count in agents.items())
+        self.step_queues = []
+        self.groups = {}
+        self.step_groups = []
+        for step in steps:
+            self.step_queues.append(self.queue_of(step))
+            self.step_groups.append(self.group_of(step))
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.retries = self.failed = 0
+        self.duration = 0.0
+        self.order = itertools.count()
+        # (time, order, step, attempt) of the running jobs and triggered builds
+        self.events = []
+        self.touched = set()
+        before = critical.predecessors(steps)
+        self.pending = [len(found) for found in before]
+        self.after = [[] for _ in steps]
+        for index, found in enumerate(before):
+            for other in found:
+                self.after[other].append(index)
+        self.remaining = [0] * len(steps)
+        self.run()
+
+    def queue_of(self, step):
+        if not runs_on_agent(step):
+            return None
+        name = queue(step)
+        found = self.queues.get(name)
+        if found is None or not found.agents:
+            raise ValueError('{step} runs on the queue {queue!r}, which has no agents'.format(
+                step=incremental.identity(step), queue=name))
+        return found
+
+    def group_of(self, step):
+        if not runs_on_agent(step) or step.get('concurrency_group') is None:
+            return None
+        name = step['concurrency_group']
+        if name not in self.groups:
+            self.groups[name] = Group(max(1, int(step.get('concurrency') or 1)))
+        return self.groups[name]
+
+    def run(self):
+        self.release([index for index, count in enumerate(self.pending) if not count], 0.0)
+        self.dispatch(0.0)
+        events = self.events
+        while events:
+            now = events[0][0]
+            while events and events[0][0] == now:
+                _, _, index, attempt = heapq.heappop(events)
+                self.finish(index, attempt, now)
+            self.dispatch(now)
+            self.duration = now
+
+    def release(self, released, now):
+        """Start the steps in ``released``, which wait for nothing anymore, in order"""
+        released = deque(released)
+        while released:
+            index = released.popleft()
+            step = self.steps[index]
+            if runs_on_agent(step):
+                jobs = int(step.get('parallelism') or 1)
+                self.remaining[index] = jobs
+                for _ in range(jobs):
+                    self.enqueue(index, now, 0)
+            elif isinstance(step, dict) and not chunks.is_barrier(step):
+                # a triggered build, it needs no agent
+                self.remaining[index] = 1
+                heapq.heappush(self.events, (now + self.durations[index], next(self.order),
+                                             index, 0))
+            else:
+                released.extend(self.unblocked(index))
+
+    def unblocked(self, index):
+        """The steps that wait for nothing anymore now that step ``index`` finished"""
+        found = []
+        for following in self.after[index]:
+            self.pending[following] -= 1
+            if not self.pending[following]:
+                found.append(following)
+        return found
+
+    def enqueue(self, index, since, attempt):
+        group = self.step_groups[index]
+        if group is not None:
+            if group.running >= group.limit:
+                group.waiting.append((index, since, attempt))
+                return
+            group.running += 1
+        found = self.step_queues[index]
+        heapq.heappush(found.ready, (-int(self.steps[index].get('priority') or 0),
+                                     next(self.order), index, since, attempt))
+        self.touched.add(found)
+
+    def dispatch(self, now):
+        for found in self.touched:
+            while found.free and found.ready:
+                _, _, index, since, attempt = heapq.heappop(found.ready)
+                found.free -= 1
+                found.jobs += 1
+                found.busy += self.durations[index]
+                found.waited += now - since
+                found.longest_wait = max(found.longest_wait, now - since)
+                heapq.heappush(self.events, (now + self.durations[index], next(self.order),
+                                             index, attempt))
+        self.touched = set()
+
+    def finish(self, index, attempt, now):
+        found = self.step_queues[index]
+        if found is not None:
+            found.free += 1
+            self.touched.add(found)
+            group = self.step_groups[index]
+            if group is not None:
+                group.running -= 1
+                if group.waiting:
+                    self.enqueue(*group.waiting.popleft())
+            if self.failure_rate and self.random.random() < self.failure_rate:
+                if attempt < retry_limit(self.steps[index]):
+                    self.retries += 1
+                    self.enqueue(index, now, attempt + 1)
+                    return
+                self.failed += 1
+        self.remaining[index] -= 1
+        if not self.remaining[index]:
+            self.release(self.unblocked(index), now)
@@ -7,13 +7,18 @@
 from __future__ import division, print_function, absolute_import
 
 import argparse
+import io
+import itertools
+import os
+import shlex
 import sys
 import logging
-from ruamel.yaml import YAML as RuamelYaml
-from ruamel.yaml.compat import StringIO
-from ruamel.yaml.comments import CommentedMap
+from collections import OrderedDict
 
-from bkyml import __version__
+import bkyml
+from bkyml import emitter
+from bkyml import formats
+from bkyml import stages
 
 __author__ = "Joscha Feth"
 __copyright__ = "Joscha Feth"
@@ -22,15 +27,291 @@ __license__ = "mit"
 LOGGER = logging.getLogger(__name__)
 
 
-class MyYAML(RuamelYaml):
+class MyYAML(formats.Format):
+    """YAML emitter using the fast path of :mod:`bkyml.emitter` where it is
+    byte-identical and ruamel.yaml, imported on first use, everywhere else"""
+
+    name = 'yaml'
+
+    def __init__(self):
+        self._yaml = None
+        self.indentation = {}
+        self.fast = True
+        self.anchors = None
+
+    def anchored(self, anchors=None):
+        """A copy writing repeated mappings of steps once and aliases after
+
+        Args:
+          anchors (:obj:`bkyml.emitter.Anchors`): defaults to new ones
+        """
+        copy = MyYAML()
+        copy.indentation = dict(self.indentation)
+        copy.fast = self.fast
+        copy.anchors = anchors or emitter.Anchors()
+        return copy
+
+    @property
+    def yaml(self):
+        if self._yaml is None:
+            from ruamel.yaml import YAML as RuamelYaml
+            self._yaml = RuamelYaml()
+            self._yaml.default_flow_style = False
+            if self.indentation:
+                self._yaml.indent(**self.indentation)
+        return self._yaml
+
+    def indent(self, **kwargs):
+        self.indentation.update(kwargs)
+        if self._yaml is not None:
+            self._yaml.indent(**kwargs)
+
     def to_string(self, data):
-        stream = StringIO()
-        RuamelYaml.dump(self, data, stream)
+        if self.fast:
+            try:
+                return emitter.dump(data, anchors=self.anchors, **self.indentation)
+            except emitter.Unsupported:
+                pass
+        return self.ruamel_string(data)
+
+    def document(self, document):
+        """Render a whole document in a single pass of one fast emitter"""
+        try:
+            fast = emitter.Emitter(anchors=self.anchors, **self.indentation)
+        except emitter.Unsupported:
+            fast = None
+        if not self.fast or fast is None:
+            return super().document(document)
+        lines = []
+        for part in self.parts(document):
+            if isinstance(part, str):
+                lines.append(part)
+                continue
+            mark = len(lines)
+            try:
+                fast.lines(part, lines)
+            except emitter.Unsupported:
+                del lines[mark:]
+                lines.append(self.ruamel_string(part)[:-1])
+            lines.append('')
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def ruamel_string(self, data):
+        stream = io.StringIO()
+        self.yaml.dump(self.commented(data), stream)
         return stream.getvalue()
 
+    @staticmethod
+    def commented(data):
+        """Convert ordered mappings into ruamel's round-trip CommentedMap"""
+        if isinstance(data, dict):
+            from ruamel.yaml.comments import CommentedMap
+            ret = CommentedMap()
+            for key, value in data.items():
+                ret[key] = MyYAML.commented(value)
+            return ret
+        if isinstance(data, list):
+            return [MyYAML.commented(item) for item in data]
+        return data
+
 
 YAML = MyYAML()
-YAML.default_flow_style = False
+YAML.indent(sequence=4, offset=2)
+
+FORMATS = OrderedDict([
+    ('yaml', lambda: YAML),
+    ('yaml-c', lambda: formats.CYamlFormat.load(fallback=YAML)),
+    ('json', formats.JsonFormat),
+    ('yaml-flow', formats.FlowYamlFormat),
+])
+FORMAT = YAML
+# the changed paths --watch patterns are matched against, None keeps every step
+CHANGES = None
+# the branch --branches filters are resolved for, None leaves them to Buildkite
+BRANCH = None
+# the parser of every subcommand the lines of batches are parsed with
+PARSER = None
+
+
+# formats that can only express a whole document, not a fragment of one
+DOCUMENT_FORMATS = ('json', 'yaml-flow')
+
+
+def assert_format(parsed, parser):
+    if getattr(parsed, 'format', None) in DOCUMENT_FORMATS \
+       and getattr(parsed, 'func', None) not in (None, Batch.batch, Analyze.critical_path):
+        parser.error('--format %s renders whole pipelines only, use it with batch.'
+                     % parsed.format)
+    if getattr(parsed, 'anchors', False) and getattr(parsed, 'format', None) != 'yaml':
+        parser.error('--anchors needs --format yaml.')
+    if getattr(parsed, 'anchors', False) and getattr(parsed, 'incremental', None):
+        parser.error('--anchors can not be used with --incremental.')
+    if getattr(parsed, 'anchors', False) and (getattr(parsed, 'max_steps_per_file', None) or
+                                              getattr(parsed, 'max_bytes_per_file', None)):
+        parser.error('--anchors can not be used when splitting the pipeline into files.')
+
+
+def use_format(name):
+    """Select the output format all subcommands emit
+
+    Args:
+      name (str): one of :data:`FORMATS`
+    """
+    global FORMAT  # pylint: disable=global-statement
+    FORMAT = FORMATS[name]()
+    return FORMAT
+
+
+def use_anchors(enabled):
+    """Write repeated ``env``, ``agents`` and ``plugins`` mappings of steps once
+    and alias them after, see :class:`bkyml.emitter.Anchors`
+
+    Every call starts a new document, so the first mappings are anchored again.
+
+    Args:
+      enabled (bool): whether to anchor the mappings of :data:`FORMAT`
+    """
+    global FORMAT  # pylint: disable=global-statement
+    if enabled:
+        FORMAT = FORMAT.anchored()
+    return FORMAT
+
+
+def use_changes(path):
+    """Prune the steps whose ``--watch`` patterns match none of the changed paths
+
+    Args:
+      path (str): file listing one changed path per line, ``-`` for stdin or
+        None to keep every step
+
+    Raises:
+      OSError: if the file can not be read
+    """
+    global CHANGES  # pylint: disable=global-statement
+    CHANGES = None
+    if path is not None:
+        # imported here to keep the index off the startup path
+        from bkyml import changes
+        CHANGES = changes.ChangeIndex.load(path)
+    return CHANGES
+
+
+def use_changed_paths(paths):
+    """Like :func:`use_changes`, for paths that have been read already
+
+    Args:
+      paths ([str]): the changed paths or None to keep every step
+    """
+    global CHANGES  # pylint: disable=global-statement
+    CHANGES = None
+    if paths is not None:
+        from bkyml import changes
+        CHANGES = changes.ChangeIndex(paths)
+    return CHANGES
+
+
+def use_branch(branch):
+    """Omit the steps whose ``--branches`` filter does not match ``branch``
+
+    Args:
+      branch (str): the branch being built, None or empty to keep every step
+    """
+    global BRANCH  # pylint: disable=global-statement
+    BRANCH = branch or None
+    return BRANCH
+
+
+def use_parser(parser):
+    """Parse the lines of batches with ``parser``, e.g. the warm parser of a daemon
+
+    Args:
+      parser (:obj:`argparse.ArgumentParser`): from :func:`build_parser`
+        with every subcommand, None to build one on first use
+    """
+    global PARSER  # pylint: disable=global-statement
+    PARSER = parser
+    return PARSER
+
+
+def full_parser():
+    """The parser of every subcommand, built once per process"""
+    if PARSER is None:
+        use_parser(build_parser())
+    return PARSER
+
+
+def close_files(namespace):
+    """Close the files ``argparse.FileType`` opened for a parsed command line"""
+    for value in vars(namespace).values():
+        if isinstance(value, io.IOBase) and value not in (sys.stdin, sys.stdout, sys.stderr):
+            value.close()
+
+
+def step_name(namespace):
+    """The label of a step, falling back to what it triggers or runs"""
+    if ns_hasattr(namespace, 'label'):
+        return namespace.label
+    if ns_hasattr(namespace, 'pipeline'):
+        return namespace.pipeline
+    return sum(namespace.command, [])[0]
+
+
+def watched(namespace, changes=None):
+    """Whether a step is kept, reporting it on stderr if it is pruned
+
+    Steps without ``--watch`` are always kept, as is every step if no
+    changed paths are known.
+
+    Args:
+      namespace (:obj:`argparse.Namespace`): the parsed step
+      changes (:obj:`bkyml.changes.ChangeIndex`): defaults to :data:`CHANGES`
+    """
+    changes = CHANGES if changes is None else changes
+    patterns = getattr(namespace, 'watch', None)
+    if changes is None or not patterns or changes.watched(patterns) is not None:
+        return True
+    sys.stderr.write('pruned step {name!r}: none of the {count} changed paths matches --watch {patterns}\n'.format( # NOQA
+        name=step_name(namespace), count=len(changes), patterns=' '.join(patterns)))
+    return False
+
+
+def resolved(namespace, branch=None):
+    """Whether a step runs on the branch, reporting it on stderr if it does not
+
+    Args:
+      namespace (:obj:`argparse.Namespace`): the parsed step
+      branch (str): defaults to :data:`BRANCH`
+    """
+    branch = BRANCH if branch is None else branch
+    patterns = getattr(namespace, 'branches', None)
+    if branch is None or not patterns:
+        return True
+    # imported here as only --resolve-branches needs it
+    from bkyml import branches
+    patterns = ' '.join(patterns)
+    if branches.matches(patterns, branch):
+        return True
+    sys.stderr.write('omitted step {name!r}: branch {branch!r} does not match --branches {patterns}\n'.format( # NOQA
+        name=step_name(namespace), branch=branch, patterns=patterns))
+    return False
+
+
+def kept(namespace, changes=None, branch=None):
+    """Whether a step is emitted, see :func:`resolved` and :func:`watched`"""
+    return resolved(namespace, branch) and watched(namespace, changes)
+
+
+def dependencies(step, namespace):
+    """Add the ``key`` and ``depends_on`` of a step"""
+    if ns_hasattr(namespace, 'key'):
+        step['key'] = namespace.key
+    if ns_hasattr(namespace, 'depends_on'):
+        step['depends_on'] = singlify(sum(namespace.depends_on, []))
+
+
+def emit(data):
+    return FORMAT.to_string(data)
+
 
 RETRY_MANUAL_ALLOWED_DEFAULT = True
 RETRY_MANUAL_PERMIT_ON_PASSED_DEFAULT = False
@@ -51,6 +332,24 @@ def check_positive(value):
     return ivalue
 
 
+def check_positive_float(value):
+    fvalue = float(value)
+    if fvalue <= 0:
+        raise argparse.ArgumentTypeError(
+            "%s is an invalid positive value" % value
+        )
+    return fvalue
+
+
+def check_non_negative_float(value):
+    fvalue = float(value)
+    if fvalue < 0:
+        raise argparse.ArgumentTypeError(
+            "%s is an invalid non-negative value" % value
+        )
+    return fvalue
+
+
 def bool_or_string(value):
     if value.lower() == 'true':
         return True
@@ -69,12 +368,78 @@ def int_or_star(value):
             raise argparse.ArgumentTypeError("%s is an invalid value" % value)
 
 
+def matrix_dimension(value):
+    name, _, values = value.partition('=')
+    if not name or not values:
+        raise argparse.ArgumentTypeError("%s is not NAME=VALUE[,VALUE...]" % value)
+    return name, values.split(',')
+
+
+def agent_counts(value):
+    name, _, counts = value.partition('=')
+    try:
+        counts = [int(count) for count in counts.split(',')]
+    except ValueError:
+        counts = None
+    if not name or not counts or min(counts) <= 0:
+        raise argparse.ArgumentTypeError("%s is not QUEUE=COUNT[,COUNT...]" % value)
+    return name, counts
+
+
+def matrix_rule(value):
+    rule = OrderedDict()
+    for pair in value.split(','):
+        name, equals, pair_value = pair.partition('=')
+        if not name or not equals:
+            raise argparse.ArgumentTypeError("%s is not NAME=VALUE[,NAME=VALUE...]" % value)
+        rule[name] = pair_value
+    return rule
+
+
+def substitute(value, combination):
+    """Replace ``{NAME}`` placeholders in strings and nested lists, tuples and dicts"""
+    if isinstance(value, str):
+        for name, replacement in combination.items():
+            value = value.replace('{' + name + '}', replacement)
+        return value
+    if isinstance(value, (list, tuple)):
+        return type(value)(substitute(item, combination) for item in value)
+    if isinstance(value, dict):
+        return type(value)((key, substitute(item, combination)) for key, item in value.items())
+    return value
+
+
+def items(subcommand, namespace, changes=None, branch=None):
+    """The data of a parsed subcommand, one item per step for expanding ones
+
+    Steps pruned by their ``--watch`` patterns or omitted by their
+    ``--branches`` filter are left out.
+
+    Args:
+      changes (:obj:`bkyml.changes.ChangeIndex`): defaults to :data:`CHANGES`
+      branch (str): defaults to :data:`BRANCH`
+
+    Returns:
+      iterable: the results of ``subcommand.data``
+    """
+    return (subcommand.data(step) for step in expanded(subcommand, namespace, changes, branch))
+
+
+def expanded(subcommand, namespace, changes=None, branch=None):
+    """The namespaces :func:`items` passes to ``subcommand.data``"""
+    if hasattr(subcommand, 'expand'):
+        return (step for step in subcommand.expand(namespace) if kept(step, changes, branch))
+    if not kept(namespace, changes, branch):
+        return ()
+    return (namespace,)
+
+
 def ns_hasattr(namespace, attr):
     return hasattr(namespace, attr) and getattr(namespace, attr) is not None
 
 
 def tuples_to_dict(tuples):
-    ret = CommentedMap()
+    ret = OrderedDict()
     for tpl in tuples:
         ret[tpl[0]] = tpl[1]
     return ret
@@ -88,7 +453,7 @@ def singlify(a_list):
 
 def plugins_section(step, namespace):
     if ns_hasattr(namespace, 'plugin') and namespace.plugin:
-        plugins = CommentedMap()
+        plugins = OrderedDict()
 
         for plugin in namespace.plugin:
             name, tuples = plugin[0], plugin[1:]
@@ -101,6 +466,8 @@ def plugins_section(step, namespace):
 
 class Block:
 
+    kind = 'step'
+
     @staticmethod
     def install(action):
         parser = action.add_parser('block')
@@ -114,6 +481,18 @@ class Block:
             help="The instructional message displayed in the dialog box when the unblock step is activated.", # NOQA
             type=str,
             metavar="PROMPT")
+        parser.add_argument(
+            '--key',
+            help="A unique key other steps can depend on with --depends-on.",
+            type=str,
+            metavar="KEY")
+        parser.add_argument(
+            '--depends-on',
+            help="Keys of the steps this step waits for, in addition to the wait and block steps before it.", # NOQA
+            type=str,
+            nargs='+',
+            action='append',
+            metavar="KEY")
         parser.add_argument(
             '--branches',
             help="The branch pattern defining which branches will include this step in their builds.", # NOQA
@@ -154,10 +533,15 @@ class Block:
 
     @staticmethod
     def block(namespace):
+        if not resolved(namespace):
+            return None
+        return emit([Block.data(namespace)])
+
+    @staticmethod
+    def data(namespace):
         assert ns_hasattr(namespace, 'label')
-        step = CommentedMap({
-            'block': namespace.label
-        })
+        step = OrderedDict([('block', namespace.label)])
+        dependencies(step, namespace)
 
         # prompt
         if ns_hasattr(namespace, 'prompt'):
@@ -193,14 +577,13 @@ class Block:
                     options = field['options'] = []
                     for pair in pairs:
                         [value, label] = pair.split('=', 1)
-                        p = CommentedMap()
+                        p = OrderedDict()
                         p['label'] = label
                         p['value'] = value
                         options.append(p)
                     fields.append(field)
 
-        YAML.indent(sequence=4, offset=2)
-        return YAML.to_string([step])
+        return step
 
     @staticmethod
     def gen_field(type, key, label, hint, required, default):
@@ -208,7 +591,7 @@ class Block:
             raise argparse.ArgumentTypeError("'%s' is an invalid key" % key)
         if label is None or label.strip() == '':
             raise argparse.ArgumentTypeError("'%s' is an invalid label" % label)
-        field = CommentedMap()
+        field = OrderedDict()
         field[type] = label
         field['key'] = key
 
@@ -223,6 +606,8 @@ class Block:
 
 class Trigger:
 
+    kind = 'step'
+
     @staticmethod
     def install(action):
         parser = action.add_parser('trigger')
@@ -237,6 +622,18 @@ class Trigger:
             help="The label that will be displayed in the pipeline visualisation in Buildkite. Supports emoji.", # NOQA
             type=str,
             metavar="LABEL")
+        parser.add_argument(
+            '--key',
+            help="A unique key other steps can depend on with --depends-on.",
+            type=str,
+            metavar="KEY")
+        parser.add_argument(
+            '--depends-on',
+            help="Keys of the steps this step waits for, in addition to the wait and block steps before it.", # NOQA
+            type=str,
+            nargs='+',
+            action='append',
+            metavar="KEY")
         parser.add_argument(
             '--async',
             dest="is_async",
@@ -285,14 +682,19 @@ class Trigger:
 
     @staticmethod
     def trigger(namespace):
+        if not resolved(namespace):
+            return None
+        return emit([Trigger.data(namespace)])
+
+    @staticmethod
+    def data(namespace):
         assert ns_hasattr(namespace, 'pipeline')
-        step = CommentedMap({
-            'trigger': namespace.pipeline
-        })
+        step = OrderedDict([('trigger', namespace.pipeline)])
 
         # label
         if ns_hasattr(namespace, 'label'):
             step['label'] = namespace.label
+        dependencies(step, namespace)
 
         # async
         if ns_hasattr(namespace, 'is_async') and namespace.is_async:
@@ -313,7 +715,7 @@ class Trigger:
            or has_build_message \
            or has_build_env \
            or has_build_meta_data:
-            build = step['build'] = CommentedMap()
+            build = step['build'] = OrderedDict()
 
             if has_build_branch:
                 build['branch'] = namespace.build_branch
@@ -326,12 +728,13 @@ class Trigger:
             if has_build_meta_data:
                 build['meta_data'] = tuples_to_dict(namespace.build_meta_data)
 
-        YAML.indent(sequence=4, offset=2)
-        return YAML.to_string([step])
+        return step
 
 
 class Plugin:
 
+    kind = 'step'
+
     @staticmethod
     def install(action):
         parser = action.add_parser('plugin')
@@ -355,23 +758,29 @@ class Plugin:
 
     @staticmethod
     def plugin(namespace):
-        step = CommentedMap()
+        step = Plugin.data(namespace)
+        if step is None:
+            return ''
+        return emit([step])
+
+    @staticmethod
+    def data(namespace):
+        step = OrderedDict()
 
         if ns_hasattr(namespace, 'name') and namespace.name:
             step['name'] = namespace.name
 
         plugins = plugins_section(step, namespace)
-        if plugins:
-            step['plugins'] = plugins
-        else:
-            return ''
-
-        YAML.indent(sequence=4, offset=2)
-        return YAML.to_string([step])
+        if not plugins:
+            return None
+        step['plugins'] = plugins
+        return step
 
 
 class Comment:
 
+    kind = 'comment'
+
     @staticmethod
     def install(action):
         parser = action.add_parser('comment')
@@ -385,6 +794,10 @@ class Comment:
 
     @staticmethod
     def comment(namespace):
+        return Comment.data(namespace)
+
+    @staticmethod
+    def data(namespace):
         assert ns_hasattr(namespace, 'str')
         lines = "\n# ".join(["\n# ".join(line.splitlines()) for line in namespace.str])
         return "# {lines}".format(lines=lines)
@@ -392,6 +805,8 @@ class Comment:
 
 class Steps:
 
+    kind = 'steps'
+
     @staticmethod
     def install(action):
         parser = action.add_parser('steps')
@@ -400,11 +815,18 @@ class Steps:
     @staticmethod
     # pylint: disable=unused-argument
     def steps(namespace):
-        return YAML.to_string({'steps': None})
+        return emit({'steps': None})
+
+    @staticmethod
+    # pylint: disable=unused-argument
+    def data(namespace):
+        return None
 
 
 class Env:
 
+    kind = 'env'
+
     @staticmethod
     def install(action):
         parser = action.add_parser('env')
@@ -421,13 +843,19 @@ class Env:
 
     @staticmethod
     def env(namespace):
-        return YAML.to_string({
-            'env': tuples_to_dict(namespace.var),
+        return emit({
+            'env': Env.data(namespace),
         })
 
+    @staticmethod
+    def data(namespace):
+        return tuples_to_dict(namespace.var)
+
 
 class Command:
 
+    kind = 'step'
+
     # pylint: disable=line-too-long
     @staticmethod
     def install(action):
@@ -445,6 +873,18 @@ class Command:
             help="The label that will be displayed in the pipeline visualisation in Buildkite. Supports emoji.", # NOQA
             type=str,
             metavar="LABEL")
+        parser.add_argument(
+            '--key',
+            help="A unique key other steps can depend on with --depends-on.",
+            type=str,
+            metavar="KEY")
+        parser.add_argument(
+            '--depends-on',
+            help="Keys of the steps this step waits for, in addition to the wait and block steps before it.", # NOQA
+            type=str,
+            nargs='+',
+            action='append',
+            metavar="KEY")
         parser.add_argument(
             '--branches',
             help="The branch pattern defining which branches will include this step in their builds.", # NOQA
@@ -476,6 +916,20 @@ class Command:
             type=str,
             metavar="GLOB_OR_PATH"
         )
+        parser.add_argument(
+            '--needs-artifact',
+            help="The artifacts this step downloads from the steps before it. Only read by batch --eliminate-waits, give it without paths for a step that needs nothing from the steps before it.", # NOQA
+            nargs='*',
+            action='append',
+            type=str,
+            metavar="GLOB_OR_PATH"
+        )
+        parser.add_argument(
+            '--estimate',
+            help="How many seconds this step takes. Only read by analyze critical-path, for steps without --timings.", # NOQA
+            type=check_non_negative_float,
+            metavar="SECONDS"
+        )
         parser.add_argument(
             '--parallelism',
             help="The number of parallel jobs that will be created based on this step.",
@@ -580,10 +1034,69 @@ class Command:
             metavar=('PLUGIN', 'KEY_VALUE_PAIR')
         )
 
+        parser.add_argument(
+            '--matrix',
+            help="Emit the step once per value, replacing {NAME} in the label, key, --depends-on keys, commands, env, agents, plugins, artifact paths and watched paths. Repeat for the cartesian product of several dimensions.", # NOQA
+            type=matrix_dimension,
+            action='append',
+            metavar="NAME=VALUE[,VALUE...]"
+        )
+        parser.add_argument(
+            '--matrix-exclude',
+            help="Skip the combinations matching all of the given values.",
+            type=matrix_rule,
+            action='append',
+            metavar="NAME=VALUE[,NAME=VALUE...]"
+        )
+        parser.add_argument(
+            '--for-each-glob',
+            help="Emit the step once per path matching PATTERN, replacing {path}. Matches are sorted, ** recurses and a trailing / only matches directories. Combines with --matrix.", # NOQA
+            type=str,
+            action='append',
+            metavar="PATTERN"
+        )
+        parser.add_argument(
+            '--watch',
+            help="Only emit the step if one of the paths given with --changed-files is PATH, is below it or matches the glob. * and ? stay within a directory, ** crosses them. Steps without --watch are always emitted.", # NOQA
+            type=str,
+            action='append',
+            metavar="PATH_OR_GLOB"
+        )
+        parser.add_argument(
+            '--cache-inputs',
+            help="Hash the step and the files matching the globs (a directory stands for all files below it) and skip the step if it passed with the same hash before. The hash is passed to the step as $BKYML_INPUTS_HASH, record it with bkyml cache record once the step passed.", # NOQA
+            nargs='+',
+            action='append',
+            type=str,
+            metavar="GLOB"
+        )
+        parser.add_argument(
+            '--cache-dir',
+            help="Directory keeping the file digests and the hashes of passed steps. Defaults to $BKYML_CACHE_DIR or .bkyml-cache.", # NOQA
+            type=str,
+            metavar="DIR"
+        )
+
         parser.set_defaults(func=Command.command)
 
     @staticmethod
     def assert_post_parse(parsed, parser):
+        if Command.expands(parsed):
+            names = [name for name, _ in getattr(parsed, 'matrix', None) or ()]
+            if len(set(names)) != len(names):
+                parser.error('--matrix dimensions have to be unique.')
+            if ns_hasattr(parsed, 'for_each_glob'):
+                if Command.GLOB_DIMENSION in names:
+                    parser.error('--matrix %s is taken by --for-each-glob.'
+                                 % Command.GLOB_DIMENSION)
+                names.append(Command.GLOB_DIMENSION)
+            for rule in getattr(parsed, 'matrix_exclude', None) or ():
+                unknown = [name for name in rule if name not in names]
+                if unknown:
+                    parser.error('--matrix-exclude: unknown dimension %s.' % unknown[0])
+        elif ns_hasattr(parsed, 'matrix_exclude'):
+            parser.error('--matrix-exclude requires --matrix or --for-each-glob.')
+
         if ns_hasattr(parsed, 'concurrency') and not ns_hasattr(parsed, 'concurrency_group'):
             parser.error("--concurrency requires --concurrency-group.")
 
@@ -620,12 +1133,98 @@ class Command:
 
     @staticmethod
     def command(namespace):
-        step = CommentedMap()
+        if not Command.expands(namespace):
+            if not kept(namespace):
+                return None
+            return emit([Command.data(namespace)])
+        # one fragment per combination, as if the step was rendered once per
+        # combination; the combinations themselves are generated lazily
+        stream = io.StringIO()
+        writer = FORMAT.writer(stream, implicit_steps=False)
+        for step in items(Command, namespace):
+            writer.add(Command.kind, step)
+        return stream.getvalue()[:-1]
+
+    MATRIX_FIELDS = ('label', 'key', 'depends_on', 'command', 'env', 'agents', 'plugin', 'watch',
+                     'cache_inputs', 'artifact_paths', 'needs_artifact')
+    GLOB_DIMENSION = 'path'
+
+    @staticmethod
+    def needs(namespace):
+        """The ``--needs-artifact`` paths of a step, None if it did not declare them"""
+        if getattr(namespace, 'needs_artifact', None) is None:
+            return None
+        return sum(namespace.needs_artifact, [])
+
+    @staticmethod
+    def expands(namespace):
+        return ns_hasattr(namespace, 'matrix') or ns_hasattr(namespace, 'for_each_glob')
+
+    @staticmethod
+    def dimensions(namespace):
+        """The ``--matrix`` dimensions, led by ``path`` for ``--for-each-glob``"""
+        dimensions = list(getattr(namespace, 'matrix', None) or ())
+        if ns_hasattr(namespace, 'for_each_glob'):
+            # imported here to keep the thread pool off the startup path
+            from bkyml import globbing
+            dimensions.insert(0, (Command.GLOB_DIMENSION,
+                                  globbing.scan_all(namespace.for_each_glob)))
+        return dimensions
+
+    @staticmethod
+    def combinations(namespace):
+        """Lazily generate the matrix combinations that are not excluded
+
+        Returns:
+          generator: an OrderedDict of dimension name to value per combination
+        """
+        dimensions = Command.dimensions(namespace)
+        names = [name for name, _ in dimensions]
+        excludes = getattr(namespace, 'matrix_exclude', None) or ()
+        for values in itertools.product(*[values for _, values in dimensions]):
+            combination = OrderedDict(zip(names, values))
+            if not any(all(combination[name] == value for name, value in rule.items())
+                       for rule in excludes):
+                yield combination
+
+    @staticmethod
+    def expand(namespace):
+        """Yield one namespace per matrix combination, or just ``namespace``"""
+        if not Command.expands(namespace):
+            yield namespace
+            return
+        for combination in Command.combinations(namespace):
+            expanded = argparse.Namespace(**vars(namespace))
+            for field in Command.MATRIX_FIELDS:
+                if ns_hasattr(namespace, field):
+                    setattr(expanded, field, substitute(getattr(namespace, field), combination))
+            yield expanded
+
+    @staticmethod
+    def cached(namespace):
+        """The step with the hash of its inputs in its env, skipped if it passed with it before"""
+        from bkyml import inputs
+        plain = argparse.Namespace(**vars(namespace))
+        plain.cache_inputs = None
+        cache = inputs.Cache(getattr(namespace, 'cache_dir', None))
+        digest = cache.hash(sum(namespace.cache_inputs, []), Command.data(plain))
+        plain.env = list(getattr(namespace, 'env', None) or ()) + [(inputs.HASH_ENV, digest)]
+        if not getattr(namespace, 'skip', None) and cache.passed(digest):
+            plain.skip = 'inputs unchanged (hash %s)' % digest[:12]
+        return plain
+
+    @staticmethod
+    def data(namespace):
+        if ns_hasattr(namespace, 'cache_inputs'):
+            namespace = Command.cached(namespace)
+        step = OrderedDict()
 
         # label
         if ns_hasattr(namespace, 'label'):
             step['label'] = namespace.label
 
+        dependencies(step, namespace)
+
         # command (required)
         assert ns_hasattr(namespace, 'command')
         command = sum(namespace.command, [])
@@ -680,8 +1279,8 @@ class Command:
 
         # retry
         if ns_hasattr(namespace, 'retry'):
-            retry = CommentedMap()
-            retry[namespace.retry] = CommentedMap()
+            retry = OrderedDict()
+            retry[namespace.retry] = OrderedDict()
 
             if namespace.retry == 'automatic':
                 if ns_hasattr(namespace, 'retry_automatic_exit_status'):
@@ -692,7 +1291,7 @@ class Command:
                     if namespace.retry_automatic_tuple:
                         retry[namespace.retry] = []
                         for tpl in namespace.retry_automatic_tuple:
-                            t = CommentedMap()
+                            t = OrderedDict()
                             t['exit_status'] = int_or_star(tpl[0])
                             t['limit'] = min(10, check_positive(tpl[1]))
                             retry[namespace.retry].append(t)
@@ -718,12 +1317,13 @@ class Command:
         if plugins:
             step['plugins'] = plugins
 
-        YAML.indent(sequence=4, offset=2)
-        return YAML.to_string([step])
+        return step
 
 
 class Wait:
 
+    kind = 'step'
+
     @staticmethod
     def install(action):
         parser = action.add_parser('wait')
@@ -736,46 +1336,1178 @@ class Wait:
 
     @staticmethod
     def wait(namespace):
+        return emit([Wait.data(namespace)])
+
+    @staticmethod
+    def data(namespace):
         step = 'wait'
 
         if ns_hasattr(namespace, 'continue_on_failure') and namespace.continue_on_failure:
-            step = CommentedMap()
+            step = OrderedDict()
             step['wait'] = None
             step['continue_on_failure'] = True
 
-        YAML.indent(sequence=4, offset=2)
-        return YAML.to_string([step])
+        return step
 
 
-def parse_args(args):
-    """Parse command line parameters
+class Shard:
+
+    kind = 'step'
+
+    @staticmethod
+    def install(action):
+        parser = action.add_parser('shard')
+        parser.add_argument(
+            '--files',
+            help="Read one test file per line from FILE instead of stdin.",
+            type=argparse.FileType('r'),
+            default='-',
+            metavar="FILE")
+        parser.add_argument(
+            '--timings',
+            help="Durations from previous builds, one PATH<TAB>SECONDS line per test file or a JSON object of path to seconds.", # NOQA
+            type=argparse.FileType('r'),
+            metavar="FILE")
+        count = parser.add_mutually_exclusive_group(required=True)
+        count.add_argument(
+            '--shards',
+            help="Number of command steps to spread the test files over.",
+            type=check_positive,
+            metavar="N")
+        count.add_argument(
+            '--target-duration',
+            help="Use as many command steps as needed for each to take about SECONDS.",
+            type=check_positive_float,
+            metavar="SECONDS")
+        parser.add_argument(
+            '--command',
+            help="Command of every shard. {files} is replaced by the shell-quoted test files of the shard, they are appended if it is missing.", # NOQA
+            type=str,
+            required=True,
+            metavar="COMMAND")
+        parser.add_argument(
+            '--label',
+            help="Label of every shard. {index} is replaced by the number of the shard, {total} by the number of shards.", # NOQA
+            type=str,
+            metavar="LABEL")
+        parser.add_argument(
+            '--seconds-per-kb',
+            help="Expected duration per KiB of test files without timings. Defaults to the rate of the test files with timings.", # NOQA
+            type=check_positive_float,
+            metavar="SECONDS")
+        parser.set_defaults(func=Shard.shard)
+
+    @staticmethod
+    def shard(namespace):
+        try:
+            shards, loads = Shard.plan(namespace)
+        except ValueError as error:
+            sys.exit('bkyml shard: %s' % error)
+        sys.stderr.write('predicted makespan: {makespan:.1f}s ({count} shards, {total:.1f}s in total)\n'.format( # NOQA
+            makespan=max(loads, default=0.0), count=len(loads), total=sum(loads)))
+        stream = io.StringIO()
+        writer = FORMAT.writer(stream, implicit_steps=False)
+        for expanded in Shard.commands(namespace, shards):
+            writer.add(Shard.kind, Shard.data(expanded))
+        return stream.getvalue()[:-1]
+
+    @staticmethod
+    def plan(namespace):
+        """Read the test files and timings and balance the shards
+
+        Returns:
+          ([[str]], [float]): see :func:`bkyml.sharding.partition`
+        """
+        from bkyml import sharding
+        paths = sharding.read_paths(namespace.files)
+        timings = {}
+        if ns_hasattr(namespace, 'timings'):
+            timings = sharding.load_timings(namespace.timings)
+        durations = sharding.estimate(paths, timings, getattr(namespace, 'seconds_per_kb', None))
+        count = sharding.shard_count(durations, getattr(namespace, 'shards', None),
+                                     getattr(namespace, 'target_duration', None))
+        return sharding.partition(paths, durations, count)
+
+    @staticmethod
+    def commands(namespace, shards):
+        """Yield the namespace of a ``command`` step per shard"""
+        template = namespace.command
+        if '{files}' not in template:
+            template += ' {files}'
+        for index, files in enumerate(shards, 1):
+            combination = OrderedDict([('index', str(index)), ('total', str(len(shards))),
+                                       ('files', ' '.join(shlex.quote(path) for path in files))])
+            yield argparse.Namespace(
+                command=[[substitute(template, combination)]],
+                label=substitute(getattr(namespace, 'label', None), combination))
+
+    @staticmethod
+    def expand(namespace):
+        shards, _ = Shard.plan(namespace)
+        return Shard.commands(namespace, shards)
+
+    @staticmethod
+    def data(namespace):
+        return Command.data(namespace)
+
+
+class Split:
+
+    @staticmethod
+    def install(action):
+        parser = action.add_parser('split')
+        parser.add_argument(
+            '--index',
+            help="0-based number of this job. Defaults to $BUILDKITE_PARALLEL_JOB.",
+            type=int,
+            metavar="INDEX")
+        parser.add_argument(
+            '--total',
+            help="Number of parallel jobs. Defaults to $BUILDKITE_PARALLEL_JOB_COUNT.",
+            type=check_positive,
+            metavar="TOTAL")
+        parser.add_argument(
+            '--files',
+            help="Read one test file per line from FILE instead of stdin.",
+            type=str,
+            default='-',
+            metavar="FILE")
+        parser.add_argument(
+            '--timings',
+            help="Durations from previous builds, one PATH<TAB>SECONDS line per test file or a JSON object of path to seconds.", # NOQA
+            type=str,
+            metavar="FILE")
+        parser.set_defaults(func=Split.split)
+
+    @staticmethod
+    def split(namespace):
+        from bkyml import sharding
+        # read when the command runs, a daemon builds its parser once for many jobs
+        index, total = namespace.index, namespace.total
+        try:
+            if index is None and os.environ.get('BUILDKITE_PARALLEL_JOB'):
+                index = int(os.environ['BUILDKITE_PARALLEL_JOB'])
+            if total is None and os.environ.get('BUILDKITE_PARALLEL_JOB_COUNT'):
+                total = check_positive(os.environ['BUILDKITE_PARALLEL_JOB_COUNT'])
+        except (ValueError, argparse.ArgumentTypeError) as error:
+            sys.exit('bkyml split: %s' % error)
+        if index is None or total is None:
+            sys.exit('bkyml split: --index and --total are required outside of parallel jobs.')
+        if not 0 <= index < total:
+            sys.exit('bkyml split: --index has to be at least 0 and less than --total.')
+        try:
+            timings = {}
+            if namespace.timings:
+                with open(namespace.timings, 'rb') as stream:
+                    timings = sharding.parse_timings(stream.read())
+            paths = sharding.read_lines(namespace.files)
+        except (OSError, ValueError) as error:
+            sys.exit('bkyml split: %s' % error)
+        mine = sharding.select(paths, timings, index, total)
+        if not mine:
+            return None
+        return b'\n'.join(mine).decode('utf-8', 'surrogateescape')
+
+
+class Timings:
+
+    @staticmethod
+    def install(action):
+        from bkyml import timings
+        parser = action.add_parser('timings')
+        actions = parser.add_subparsers(dest='action', metavar='{ingest,export}')
+        actions.required = True
+
+        ingest = actions.add_parser(
+            'ingest',
+            help="Add the test cases of JUnit XML reports to the database.")
+        ingest.add_argument(
+            dest="reports",
+            help="JUnit XML reports. Reports ingested before are skipped unless they changed.",
+            type=str,
+            nargs='+',
+            metavar="JUNIT_XML")
+        ingest.add_argument(
+            '--alpha',
+            help="Weight of the newest duration in the average of a test. Defaults to %(default)s.", # NOQA
+            type=check_positive_float,
+            default=timings.DEFAULT_ALPHA,
+            metavar="ALPHA")
+        ingest.set_defaults(func=Timings.ingest)
+
+        export = actions.add_parser(
+            'export',
+            help="Print the durations, one PATH<TAB>SECONDS line per file or test.")
+        export.add_argument(
+            '--by',
+            help="Sum up the tests of each file or print every test on its own.",
+            choices=sorted(timings.GROUPS),
+            default='file')
+        export.add_argument(
+            '--failures',
+            help="Print the number of failures instead of the durations.",
+            action='store_true')
+        export.set_defaults(func=Timings.export)
+
+        for subparser in (ingest, export):
+            subparser.add_argument(
+                '--db',
+                help="The SQLite database. Defaults to %(default)s.",
+                type=str,
+                default=timings.DEFAULT_DATABASE,
+                metavar="FILE")
+
+    @staticmethod
+    def ingest(namespace):
+        from bkyml import timings
+        if not 0 < namespace.alpha <= 1:
+            sys.exit('bkyml timings: --alpha has to be greater than 0 and at most 1.')
+        try:
+            with timings.Database(namespace.db) as database:
+                reports, cases, skipped = database.ingest(namespace.reports, namespace.alpha)
+        except (OSError, SyntaxError, timings.sqlite3.Error) as error:
+            # ElementTree raises a SyntaxError subclass for malformed XML
+            sys.exit('bkyml timings: %s' % error)
+        return 'ingested {reports} reports with {cases} test cases, skipped {skipped} unchanged reports'.format( # NOQA
+            reports=reports, cases=cases, skipped=skipped)
+
+    @staticmethod
+    def export(namespace):
+        from bkyml import timings
+        try:
+            with timings.Database(namespace.db) as database:
+                values = database.values('failures' if namespace.failures else 'duration',
+                                         namespace.by)
+        except timings.sqlite3.Error as error:
+            sys.exit('bkyml timings: %s' % error)
+        if not values:
+            return None
+        template = '{key}\t{value:d}' if namespace.failures else '{key}\t{value:.3f}'
+        return '\n'.join(template.format(key=key, value=value) for key, value in values.items())
+
+
+class Cache:
+
+    @staticmethod
+    def install(action):
+        from bkyml import inputs
+        parser = action.add_parser('cache')
+        actions = parser.add_subparsers(dest='action', metavar='{record}')
+        actions.required = True
+
+        record = actions.add_parser(
+            'record',
+            help="Remember that the steps with the given hashes passed.")
+        record.add_argument(
+            dest="hashes",
+            help="The $%s of a step passed to it by --cache-inputs." % inputs.HASH_ENV,
+            type=Cache.check_hash,
+            nargs='+',
+            metavar="HASH")
+        record.add_argument(
+            '--cache-dir',
+            help="Directory keeping the hashes of passed steps. Defaults to $%s or %s." % (
+                inputs.CACHE_DIR_ENV, inputs.DEFAULT_CACHE_DIR),
+            type=str,
+            metavar="DIR")
+        record.set_defaults(func=Cache.record)
+
+    @staticmethod
+    def check_hash(value):
+        from bkyml import inputs
+        if not inputs.HASH.match(value):
+            raise argparse.ArgumentTypeError("%s is not a hash of --cache-inputs" % value)
+        return value
+
+    @staticmethod
+    def record(namespace):
+        from bkyml import inputs
+        cache = inputs.Cache(namespace.cache_dir)
+        try:
+            for digest in namespace.hashes:
+                cache.record(digest)
+        except OSError as error:
+            sys.exit('bkyml cache: %s' % error)
+        return None
+
+
+class Batch:
+
+    PROGRAM_NAMES = ('bkyml', 'bkyaml')
+    # steps whose output depends on files, not just on their line
+    UNCACHEABLE_SUBCOMMANDS = ('shard',)
+    UNCACHEABLE_OPTIONS = ('--for-each-glob', '--cache-inputs')
+    DEFAULT_CACHE_SIZE = 64
+
+    @staticmethod
+    def install(action):
+        parser = action.add_parser('batch')
+        parser.add_argument(
+            '--file',
+            help="Read one shell-quoted subcommand per line from FILE instead of stdin.",
+            type=argparse.FileType('r'),
+            default='-',
+            metavar="FILE")
+        parser.add_argument(
+            '--cache',
+            help="Print the output of an identical batch rendered before instead of rendering it again. Batches with shard steps, --for-each-glob or --cache-inputs are always rendered.", # NOQA
+            action='store_true')
+        parser.add_argument(
+            '--cache-dir',
+            help="Directory keeping the outputs in its outputs directory. Defaults to $BKYML_CACHE_DIR or .bkyml-cache.", # NOQA
+            type=str,
+            metavar="DIR")
+        parser.add_argument(
+            '--cache-size',
+            help="Evict the least recently used outputs beyond this many MiB. Defaults to %(default)s.", # NOQA
+            type=check_positive,
+            default=Batch.DEFAULT_CACHE_SIZE,
+            metavar="MIB")
+        parser.add_argument(
+            '--incremental',
+            help="Write the output to FILE and an index of its steps to FILE.index, and on the next run copy the steps that did not change from there instead of rendering them again. Needs a streamable format.", # NOQA
+            type=str,
+            metavar="FILE")
+        parser.add_argument(
+            '--max-steps-per-file',
+            help="Split the pipeline into fragment files of at most N steps each, written to --output-dir together with a manifest.txt listing them in upload order.", # NOQA
+            type=check_positive,
+            metavar="N")
+        parser.add_argument(
+            '--max-bytes-per-file',
+            help="Split the pipeline into fragment files of at most BYTES each, written to --output-dir together with a manifest.txt listing them in upload order.", # NOQA
+            type=check_positive,
+            metavar="BYTES")
+        parser.add_argument(
+            '--output-dir',
+            help="Directory the fragments and their manifest are written to. Defaults to the current directory.", # NOQA
+            type=str,
+            default='.',
+            metavar="DIR")
+        parser.add_argument(
+            '--eliminate-waits',
+            help="Replace the wait steps after which every step up to the next wait or block declares --needs-artifact by dependencies on the steps uploading those artifacts with --artifact-paths.", # NOQA
+            action='store_true')
+        parser.add_argument(
+            '--stage-steps',
+            help="Print the lines up to the first N steps or the first wait or block step, and a step uploading the rest, which is written to the --plan file. Upload the plan as an artifact before the pipeline.", # NOQA
+            type=check_positive,
+            metavar="N")
+        parser.add_argument(
+            '--plan',
+            help="File the lines left for the next stage are written to. Defaults to %(default)s.", # NOQA
+            type=str,
+            default=stages.DEFAULT_PLAN,
+            metavar="FILE")
+        parser.add_argument(
+            '--stage-command',
+            help="Command of the step uploading the next stage, {plan} is replaced with the path of the plan. Defaults to '%(default)s'.", # NOQA
+            type=str,
+            default=stages.DEFAULT_COMMAND,
+            metavar="COMMAND")
+        parser.add_argument(
+            '--stage-label',
+            help="Label of the step uploading the next stage. Defaults to '%(default)s'.", # NOQA
+            type=str,
+            default=stages.DEFAULT_LABEL,
+            metavar="LABEL")
+        parser.set_defaults(func=Batch.batch)
+
+    @staticmethod
+    def lines(stream):
+        """Split a batch stream into subcommand argument lists
+
+        Blank lines and lines starting with ``#`` are skipped, a trailing
+        backslash continues the line and a leading ``bkyml`` is dropped so
+        existing generator scripts can be piped in unchanged.
+        """
+        pending, start = '', None
+        for number, line in enumerate(stream, 1):
+            line = line.rstrip('\n')
+            start = start or number
+            if line.endswith('\\'):
+                pending += line[:-1]
+                continue
+            argv = Batch.split(pending + line, start)
+            pending, start = '', None
+            if argv:
+                yield argv
+        argv = Batch.split(pending, start)
+        if argv:
+            yield argv
+
+    @staticmethod
+    def split(line, number):
+        """Split one logical line, starting at line ``number``, into arguments
+
+        Raises:
+          ValueError: if the line can not be split, e.g. for an unbalanced quote
+        """
+        if not line.strip() or line.lstrip().startswith('#'):
+            return []
+        try:
+            argv = shlex.split(line)
+        except ValueError as error:
+            raise ValueError('line {number}: {error}'.format(number=number, error=error))
+        if argv and argv[0] in Batch.PROGRAM_NAMES:
+            argv = argv[1:]
+        return argv
+
+    @staticmethod
+    def cacheable(argv):
+        """Whether a line always renders the same, no matter which files exist"""
+        name = chosen_subcommand(argv)
+        if not hasattr(SUBCOMMANDS.get(name), 'kind') or name in Batch.UNCACHEABLE_SUBCOMMANDS:
+            return False
+        for arg in argv:
+            # argparse accepts any unambiguous prefix of an option
+            name = arg.split('=', 1)[0]
+            if name.startswith('--') and len(name) > 2 and \
+               any(option.startswith(name) for option in Batch.UNCACHEABLE_OPTIONS):
+                return False
+        return True
+
+    @staticmethod
+    def write(parser, argv, writer, graph=None):
+        """Parse a line of a batch, add what it renders to ``writer`` and its steps to ``graph``"""
+        if argv[0] == 'batch':
+            parser.error('batch can not be nested.')
+        subcommand = SUBCOMMANDS.get(chosen_subcommand(argv))
+        if not hasattr(subcommand, 'kind'):
+            parser.error('%s can not be used in a batch.' % argv[0])
+        for data in items(subcommand, parse_line(parser, argv)):
+            writer.add(subcommand.kind, data)
+            if graph is not None and subcommand.kind == 'step' and data is not None:
+                graph.add(data)
+
+    @staticmethod
+    def render(lines, stream, graph=None):
+        """Render the argument lists of a batch to ``stream``
+
+        Formats that can not stream are rendered into a buffer first, so
+        nothing is written to ``stream`` if the batch turns out to be invalid.
+
+        Raises:
+          ValueError: if the dependencies of the steps do not add up, see
+            :mod:`bkyml.graph`, or the lines come in an order the format can
+            not write; the steps of streamable formats have been written by then
+        """
+        from bkyml import graph as dependencies
+        graph = dependencies.Graph() if graph is None else graph
+        parser = full_parser()
+        if FORMAT.streamable:
+            output = stream
+            writer = FORMAT.writer(output, implicit_steps=False)
+        else:
+            output = io.StringIO()
+            writer = FORMAT.writer(output)
+        for argv in lines:
+            if argv[0] == 'batch':
+                parser.error('batch can not be nested.')
+            if FORMAT.streamable and not hasattr(SUBCOMMANDS.get(chosen_subcommand(argv)), 'kind'):
+                output = render(parser, argv)
+                if output is not None:
+                    stream.write(output + '\n')
+                continue
+            Batch.write(parser, argv, writer, graph)
+        graph.validate()
+        writer.close()
+        if output is not stream:
+            stream.write(output.getvalue())
+
+    @staticmethod
+    def cached(namespace):
+        """Print the output of an identical batch or render the batch and keep its output
+
+        Outputs are keyed by the output format, the changed paths and branch
+        steps are filtered by and the lines of the batch, split into
+        arguments, so comments, blank lines and quoting do not matter. They
+        are stored under a key of the exact input as well, so running the
+        same batch again does not even split its lines. What rendering wrote
+        to stderr is stored with the output and written again on a hit.
+        """
+        from bkyml import outputs
+        text = namespace.file.read()
+        cache = outputs.OutputCache(namespace.cache_dir, namespace.cache_size << 20)
+        options = [FORMAT.name, FORMAT.anchors is not None, BRANCH, CHANGES and CHANGES.paths]
+        exact = outputs.key(options, text)
+        entry = cache.get(exact)
+        if entry is None:
+            lines = list(Batch.lines(io.StringIO(text)))
+            if not all(Batch.cacheable(argv) for argv in lines):
+                LOGGER.info('batch reads files, rendering it without the cache')
+                Batch.render(lines, sys.stdout)
+                return
+            canonical = outputs.key(options, lines)
+            entry = cache.get(canonical)
+            if entry is None:
+                stream = io.StringIO()
+                _, messages = outputs.recorded(lambda: Batch.render(lines, stream))
+                sys.stdout.write(stream.getvalue())
+                entry = outputs.pack(stream.getvalue().encode('utf-8', 'surrogateescape'),
+                                     messages.encode('utf-8', 'surrogateescape'))
+                Batch.store(cache, [canonical, exact], entry)
+                return
+            Batch.store(cache, [exact], entry)
+        output, messages = outputs.unpack(entry)
+        sys.stderr.write(messages.decode('utf-8', 'surrogateescape'))
+        sys.stdout.write(output.decode('utf-8', 'surrogateescape'))
+
+    @staticmethod
+    def store(cache, digests, entry):
+        try:
+            for digest in digests:
+                cache.put(digest, entry)
+        except OSError as error:
+            LOGGER.warning('can not cache the output of the batch: %s', error)
+
+    @staticmethod
+    def incremental(lines, path):
+        """Render a batch to ``path``, splicing in what did not change since the last render
+
+        Lines that always render the same are copied as a whole, the steps
+        of the other lines whenever one with the same content was rendered
+        before; see :mod:`bkyml.incremental`.
+        """
+        from bkyml import graph, incremental, outputs
+        parser = full_parser()
+        if not FORMAT.streamable:
+            parser.error('--incremental can not be used with --format %s.' % FORMAT.name)
+        fmt = outputs.key(FORMAT.name)
+        options = outputs.key(FORMAT.name, BRANCH, CHANGES and CHANGES.paths)
+        target = incremental.Render(FORMAT, incremental.Previous.load(path, fmt, options),
+                                    graph.Graph())
+        for argv in lines:
+            if argv[0] == 'batch':
+                parser.error('batch can not be nested.')
+            cacheable = Batch.cacheable(argv)
+            if cacheable and target.splice_line(argv):
+                continue
+            target.begin_line(argv, cacheable)
+            Batch.write(parser, argv, target)
+            target.end_line()
+        target.graph.validate()
+        try:
+            target.save(path, fmt, options)
+        except OSError as error:
+            sys.exit('bkyml batch: can not write %s: %s' % (path, error))
+        sys.stderr.write('copied {spliced} parts from the last render, rendered {rendered}\n'.format( # NOQA
+            spliced=target.spliced, rendered=target.rendered))
+
+    @staticmethod
+    def chunked(lines, namespace):
+        """Render a batch into fragment files, printing the path of each once it is written
+
+        See :mod:`bkyml.chunks`.
+        """
+        from bkyml import chunks, graph
+        parser = full_parser()
+        if namespace.cache or namespace.incremental:
+            parser.error('--max-steps-per-file and --max-bytes-per-file write files of their own, '
+                         'they can not be used with --cache or --incremental.')
+
+        def written(path):
+            print(path, flush=True)
+
+        chunker = chunks.Chunker(FORMAT, namespace.output_dir, namespace.max_steps_per_file,
+                                 namespace.max_bytes_per_file, written)
+        checked = graph.Graph()
+        try:
+            os.makedirs(namespace.output_dir, exist_ok=True)
+            for argv in lines:
+                Batch.write(parser, argv, chunker, checked)
+            checked.validate()
+            chunker.close()
+        except OSError as error:
+            sys.exit('bkyml batch: %s' % error)
+
+    @staticmethod
+    def staged(lines, namespace):
+        """Render the first steps of a batch and a step uploading the rest
+
+        The lines after the first stage are written to the plan without
+        being parsed; see :mod:`bkyml.stages`.
+        """
+        parser = full_parser()
+        if namespace.cache or namespace.incremental or namespace.max_steps_per_file or \
+           namespace.max_bytes_per_file:
+            parser.error('--stage-steps can not be used with --cache, --incremental or when '
+                         'splitting the pipeline into files.')
+        from bkyml import graph
+        output = sys.stdout if FORMAT.streamable else io.StringIO()
+        writer = FORMAT.writer(output)
+        checked = graph.Graph()
+        lines = iter(lines)
+        header, rest = [], []
+        for argv in lines:
+            name = chosen_subcommand(argv)
+            if name in stages.HEADER_SUBCOMMANDS:
+                header.append(argv)
+            elif writer.count >= namespace.stage_steps or \
+                    (writer.count and name in stages.BARRIER_SUBCOMMANDS):
+                rest.append(argv)
+                break
+            Batch.write(parser, argv, writer, checked)
+        rest.extend(lines)
+        if not rest:
+            checked.validate()
+        else:
+            # the rest may depend on any step of this stage, but not the other way round
+            checked.known.update(checked.keys)
+            for name, key in checked.unknown():
+                raise ValueError('{name} depends on the key {key!r} of a step of a later stage'
+                                 .format(name=name, key=key))
+            checked.validate()
+            plan = stages.Plan(header + rest, FORMAT.name, BRANCH,
+                               None if CHANGES is None else CHANGES.paths,
+                               FORMAT.anchors is not None, sorted(checked.known))
+            try:
+                plan.save(namespace.plan)
+            except OSError as error:
+                sys.exit('bkyml batch: can not write %s: %s' % (namespace.plan, error))
+            Batch.write(parser, stages.follow_up(namespace.stage_command, namespace.stage_label,
+                                                 namespace.plan), writer)
+        writer.close()
+        if output is not sys.stdout:
+            sys.stdout.write(output.getvalue())
+
+    @staticmethod
+    def collect(parser, lines):
+        """Render a whole batch into a :class:`bkyml.formats.Document`
+
+        Returns:
+          (:obj:`bkyml.formats.Document`, [:obj:`argparse.Namespace`]): the
+            document and the namespace every one of its steps was rendered from
+        """
+        document, found = formats.Document(), []
+        for argv in lines:
+            if argv[0] == 'batch':
+                parser.error('batch can not be nested.')
+            subcommand = SUBCOMMANDS.get(chosen_subcommand(argv))
+            if not hasattr(subcommand, 'kind'):
+                parser.error('%s can not be used in a batch.' % argv[0])
+            for step in expanded(subcommand, parse_line(parser, argv)):
+                data = subcommand.data(step)
+                document.add(subcommand.kind, data)
+                if subcommand.kind == 'step' and data is not None:
+                    found.append(step)
+        return document, found
+
+    @staticmethod
+    def optimized(lines, namespace):
+        """Render a batch with the waits :mod:`bkyml.barriers` can remove replaced by dependencies
+
+        The whole pipeline is collected before it is written.
+        """
+        from bkyml import barriers, graph
+        parser = full_parser()
+        if namespace.cache or namespace.incremental or namespace.max_steps_per_file or \
+           namespace.max_bytes_per_file or namespace.stage_steps:
+            parser.error('--eliminate-waits can not be used with --cache, --incremental, '
+                         '--stage-steps or when splitting the pipeline into files.')
+        document, found = Batch.collect(parser, lines)
+        needs = [Command.needs(step) for step in found]
+        waits = sum(1 for step in document.steps if barriers.is_wait(step))
+        document.steps, _, removed = barriers.eliminate(document.steps, needs)
+        graph.validate(document.steps)
+        sys.stderr.write('removed {removed} of {waits} waits\n'.format(
+            removed=removed, waits=waits))
+        sys.stdout.write(FORMAT.document(document))
+
+    @staticmethod
+    def batch(namespace):
+        assert ns_hasattr(namespace, 'file')
+        try:
+            if getattr(namespace, 'eliminate_waits', False):
+                Batch.optimized(Batch.lines(namespace.file), namespace)
+            elif getattr(namespace, 'stage_steps', None):
+                Batch.staged(Batch.lines(namespace.file), namespace)
+            elif (getattr(namespace, 'max_steps_per_file', None) or
+                  getattr(namespace, 'max_bytes_per_file', None)):
+                Batch.chunked(Batch.lines(namespace.file), namespace)
+            elif getattr(namespace, 'incremental', None):
+                Batch.incremental(Batch.lines(namespace.file), namespace.incremental)
+            elif getattr(namespace, 'cache', False):
+                Batch.cached(namespace)
+            else:
+                Batch.render(Batch.lines(namespace.file), sys.stdout)
+        except ValueError as error:
+            full_parser().error(str(error))
+        return None
+
+
+class Stage:
+
+    @staticmethod
+    def install(action):
+        parser = action.add_parser('stage')
+        parser.add_argument(
+            dest="plan",
+            help="The plan written by batch --stage-steps. It is rendered with the --format, --anchors, --resolve-branches and --changed-files the batch was rendered with.", # NOQA
+            metavar="PLAN")
+        parser.set_defaults(func=Stage.stage)
+
+    @staticmethod
+    def stage(namespace):
+        try:
+            plan = stages.Plan.load(namespace.plan)
+        except (OSError, ValueError) as error:
+            sys.exit('bkyml stage: %s' % error)
+        use_format(plan.format)
+        use_anchors(plan.anchors)
+        use_branch(plan.branch)
+        use_changed_paths(plan.changed_files)
+        from bkyml import graph
+        parser = full_parser()
+        output = sys.stdout if FORMAT.streamable else io.StringIO()
+        writer = FORMAT.writer(output)
+        checked = graph.Graph(plan.keys)
+        try:
+            for argv in plan.lines:
+                Batch.write(parser, argv, writer, checked)
+            checked.validate()
+        except ValueError as error:
+            parser.error(str(error))
+        writer.close()
+        if output is not sys.stdout:
+            sys.stdout.write(output.getvalue())
+        return None
+
+
+class Diff:
+
+    @staticmethod
+    def install(action):
+        parser = action.add_parser('diff')
+        parser.add_argument(
+            dest="old",
+            help="The pipeline as rendered before.",
+            metavar="OLD")
+        parser.add_argument(
+            dest="new",
+            help="The pipeline as rendered now. Steps of pipelines rendered by batch --incremental are compared by the hashes in their index.", # NOQA
+            metavar="NEW")
+        parser.set_defaults(func=Diff.diff)
+
+    @staticmethod
+    def diff(namespace):
+        from bkyml import incremental
+        from ruamel.yaml import YAMLError
+        try:
+            found, unchanged = incremental.diff(incremental.steps(namespace.old),
+                                                incremental.steps(namespace.new))
+        except (OSError, YAMLError) as error:
+            sys.exit('bkyml diff: %s' % error)
+        if not found:
+            return None
+        counts = OrderedDict((sign, 0) for sign in '+-~')
+        lines = []
+        for sign, name, keys in found:
+            counts[sign] += 1
+            lines.append('%s %s' % (sign, name) + (' (%s)' % ', '.join(keys) if keys else ''))
+        lines.append('{added} added, {removed} removed, {changed} changed, {unchanged} unchanged'
+                     .format(added=counts['+'], removed=counts['-'], changed=counts['~'],
+                             unchanged=unchanged))
+        return '\n'.join(lines)
+
+
+class Analyze:
+
+    @staticmethod
+    def install(action):
+        from bkyml import critical
+        parser = action.add_parser('analyze')
+        actions = parser.add_subparsers(dest='action', metavar='{critical-path}')
+        actions.required = True
+
+        path = actions.add_parser(
+            'critical-path',
+            help="Print the earliest start and the slack of every step of a batch, its critical path and the least time the build takes.") # NOQA
+        path.add_argument(
+            '--file',
+            help="Read one shell-quoted subcommand per line from FILE instead of stdin.",
+            type=argparse.FileType('r'),
+            default='-',
+            metavar="FILE")
+        path.add_argument(
+            '--timings',
+            help="Durations from previous builds, one NAME<TAB>SECONDS line per step or a JSON object of name to seconds. Steps are looked up by their key, label, trigger and then the name diff prints. Steps without timings take their --estimate.", # NOQA
+            type=argparse.FileType('r'),
+            metavar="FILE")
+        path.add_argument(
+            '--default-duration',
+            help="Seconds of the steps without timings and without --estimate. Defaults to the mean of the other steps.", # NOQA
+            type=check_non_negative_float,
+            metavar="SECONDS")
+        path.add_argument(
+            '--prioritize',
+            help="Print the pipeline instead, with a priority on the command steps with at most --max-slack and the steps between two barriers ordered by how long the build takes from their start on, longest first. The analysis goes to stderr.", # NOQA
+            action='store_true')
+        path.add_argument(
+            '--max-slack',
+            help="Seconds of slack a step may have to get a priority. Defaults to %(default)s, only the steps on a critical path.", # NOQA
+            type=check_non_negative_float,
+            default=0.0,
+            metavar="SECONDS")
+        path.add_argument(
+            '--priority',
+            help="The priority given. Defaults to %(default)s.",
+            type=int,
+            default=critical.PRIORITY,
+            metavar="PRIORITY")
+        path.set_defaults(func=Analyze.critical_path)
+
+    @staticmethod
+    def report(analysis, missing, default):
+        from bkyml import chunks, incremental
+        steps = analysis.steps
+        lines = ['{:>10} {:>10} {:>10}  {}'.format('START', 'DURATION', 'SLACK', 'STEP')]
+        for index, step in enumerate(steps):
+            if chunks.is_barrier(step):
+                continue
+            lines.append('{start:10.1f} {duration:10.1f} {slack:10.1f}  {name}'.format(
+                start=analysis.start[index], duration=analysis.durations[index],
+                slack=analysis.slack[index], name=incremental.identity(step)))
+        if missing:
+            lines.append('{missing} of {total} steps had no timings or --estimate and took {default:.1f}s' # NOQA
+                         .format(missing=missing, total=len(lines) - 1, default=default))
+        path = [incremental.identity(steps[index]) for index in analysis.path
+                if not chunks.is_barrier(steps[index])]
+        lines.append('critical path: %s' % (' -> '.join(path) or 'none'))
+        lines.append('least build time: %.1fs' % analysis.duration)
+        return '\n'.join(lines)
+
+    @staticmethod
+    def critical_path(namespace):
+        from bkyml import critical, sharding
+        parser = full_parser()
+        timings = {}
+        try:
+            if namespace.timings is not None:
+                timings = sharding.load_timings(namespace.timings)
+            document, found = Batch.collect(parser, Batch.lines(namespace.file))
+        except ValueError as error:
+            sys.exit('bkyml analyze: %s' % error)
+        durations, missing, default = critical.durations(
+            document.steps, timings, [getattr(step, 'estimate', None) for step in found],
+            namespace.default_duration)
+        try:
+            analysis = critical.Analysis(document.steps, durations)
+        except ValueError as error:
+            sys.exit('bkyml analyze: %s' % error)
+        report = Analyze.report(analysis, missing, default)
+        if not namespace.prioritize:
+            return report
+        document.steps, _ = critical.prioritize(document.steps, analysis, namespace.max_slack,
+                                                namespace.priority)
+        sys.stderr.write(report + '\n')
+        sys.stdout.write(FORMAT.document(document))
+        return None
+
+
+class Simulate:
+
+    @staticmethod
+    def install(action):
+        parser = action.add_parser('simulate')
+        parser.add_argument(
+            dest="pipeline",
+            help="The rendered pipeline, YAML or JSON.",
+            metavar="PIPELINE")
+        parser.add_argument(
+            '--agents',
+            help="The number of agents of a queue, steps without a queue run on the default queue. Several counts simulate every combination with the counts of the other queues.", # NOQA
+            type=agent_counts,
+            action='append',
+            required=True,
+            metavar="QUEUE=COUNT[,COUNT...]")
+        parser.add_argument(
+            '--timings',
+            help="Seconds every job of a step takes, one NAME<TAB>SECONDS line per step or a JSON object of name to seconds, looked up like analyze critical-path does.", # NOQA
+            type=argparse.FileType('r'),
+            metavar="FILE")
+        parser.add_argument(
+            '--default-duration',
+            help="Seconds of the steps without timings. Defaults to the mean of the other steps.", # NOQA
+            type=check_non_negative_float,
+            metavar="SECONDS")
+        parser.add_argument(
+            '--failure-rate',
+            help="The probability every run of a job fails, failed jobs are retried up to their retry automatic limit. Defaults to %(default)s.", # NOQA
+            type=check_non_negative_float,
+            default=0.0,
+            metavar="RATE")
+        parser.add_argument(
+            '--seed',
+            help="Seed of the random failures. Defaults to %(default)s.",
+            type=int,
+            default=0,
+            metavar="SEED")
+        parser.set_defaults(func=Simulate.simulate)
+
+    @staticmethod
+    def report(result):
+        lines = ['build time: %.1fs' % result.duration,
+                 '{:<20} {:>7} {:>8} {:>12} {:>12} {:>10} {:>10}'.format(
+                     'QUEUE', 'AGENTS', 'JOBS', 'BUSY', 'UTILIZATION', 'MEAN WAIT', 'MAX WAIT')]
+        for name, found in result.queues.items():
+            lines.append('{name:<20} {agents:>7d} {jobs:>8d} {busy:>11.1f}s {utilization:>11.1%} '
+                         '{mean:>9.1f}s {longest:>9.1f}s'.format(
+                             name=name, agents=found.agents, jobs=found.jobs, busy=found.busy,
+                             utilization=found.utilization(result.duration),
+                             mean=found.mean_wait(), longest=found.longest_wait))
+        if result.failure_rate:
+            lines.append('{retries} retries, {failed} jobs failed'.format(
+                retries=result.retries, failed=result.failed))
+        return '\n'.join(lines)
+
+    @staticmethod
+    def simulate(namespace):
+        from bkyml import critical, sharding, simulation
+        if namespace.failure_rate >= 1:
+            sys.exit('bkyml simulate: --failure-rate has to be less than 1.')
+        agents = OrderedDict(namespace.agents)
+        sweep = any(len(counts) > 1 for counts in agents.values())
+        try:
+            timings = {}
+            if namespace.timings is not None:
+                timings = sharding.load_timings(namespace.timings)
+            steps = simulation.load(namespace.pipeline)
+            durations, _, _ = critical.durations(steps, timings,
+                                                 default=namespace.default_duration)
+            reports = []
+            for counts in itertools.product(*agents.values()):
+                configuration = OrderedDict(zip(agents, counts))
+                result = simulation.Simulation(steps, durations, configuration,
+                                               namespace.failure_rate, namespace.seed)
+                report = Simulate.report(result)
+                if sweep:
+                    report = 'agents: %s\n%s' % (' '.join(
+                        '%s=%d' % pair for pair in configuration.items()), report)
+                reports.append(report)
+        except (OSError, ValueError) as error:
+            sys.exit('bkyml simulate: %s' % error)
+        return '\n\n'.join(reports)
+
+
+class RunLocal:
+
+    @staticmethod
+    def install(action):
+        from bkyml import local
+        parser = action.add_parser('run-local')
+        parser.add_argument(
+            dest="pipeline",
+            help="The rendered pipeline, YAML or JSON.",
+            metavar="PIPELINE")
+        parser.add_argument(
+            '--jobs',
+            help="How many jobs run at once. Defaults to the number of CPUs.",
+            type=check_positive,
+            metavar="N")
+        parser.add_argument(
+            '--shell',
+            help="The command running the commands of a job, which are passed as its last argument. Defaults to '%(default)s'.", # NOQA
+            type=str,
+            default=local.DEFAULT_SHELL,
+            metavar="SHELL")
+        parser.set_defaults(func=RunLocal.run_local)
+
+    @staticmethod
+    def run_local(namespace):
+        from bkyml import local, simulation
+        try:
+            document = simulation.read(namespace.pipeline)
+            steps = list(document.get('steps') or ())
+            runner = local.Runner(steps, document.get('env'), namespace.jobs, namespace.shell)
+            results = runner.run()
+        except (OSError, ValueError) as error:
+            sys.exit('bkyml run-local: %s' % error)
+        sys.stdout.write(local.summary(steps, results, runner.duration) + '\n')
+        failed = sum(1 for result in results if result.outcome == local.FAILED)
+        if failed:
+            sys.exit('bkyml run-local: {count} {steps} failed'.format(
+                count=failed, steps='step' if failed == 1 else 'steps'))
+        return None
+
+
+class Serve:
+
+    @staticmethod
+    def install(action):
+        from bkyml import daemon
+        parser = action.add_parser('serve')
+        parser.add_argument(
+            '--socket',
+            help="Path of the Unix socket to listen on. Defaults to $%s or bkyml.sock in $XDG_RUNTIME_DIR or in a private per-user directory in the temp directory." % daemon.SOCKET_ENV, # NOQA
+            type=str,
+            metavar="PATH")
+        parser.add_argument(
+            '--idle-timeout',
+            help="Exit after this many seconds without a request.",
+            type=float,
+            default=daemon.DEFAULT_IDLE_TIMEOUT,
+            metavar="SECONDS")
+        parser.add_argument(
+            '--stats',
+            help="Print the latency histogram of a running daemon and exit.",
+            action='store_true')
+        parser.add_argument(
+            '--stop',
+            help="Stop a running daemon.",
+            action='store_true')
+        parser.set_defaults(func=Serve.serve)
+
+    @staticmethod
+    def serve(namespace):
+        from bkyml import daemon
+        path = namespace.socket or daemon.default_socket_path()
+        if namespace.stats or namespace.stop:
+            if not daemon.listening(path):
+                sys.exit('no bkyml daemon listening on %s' % path)
+            if namespace.stop:
+                daemon.request({'shutdown': True}, path, autospawn=False)
+                return None
+            response = daemon.request({'stats': True}, path, autospawn=False)
+            return daemon.LatencyHistogram.format(response['stats'])
+
+        parser = use_parser(build_parser(prog='bkyml'))
+        daemon.Server(path, lambda argv: Serve.handle(parser, argv),
+                      namespace.idle_timeout).serve_forever()
+        return None
+
+    @staticmethod
+    def handle(parser, argv):
+        """Run a forwarded command line with the warm ``parser`` of the daemon"""
+        if argv and argv[0] == 'serve':
+            parser.error('serve can not be forwarded to a daemon.')
+        parsed = parse_line(parser, argv)
+        try:
+            use_format(parsed.format)
+            use_anchors(parsed.anchors)
+            use_filters(parser, parsed)
+            return parsed.func(parsed)
+        finally:
+            # the daemon lives on, the files of its requests must not
+            close_files(parsed)
+
+
+def parse_line(parser, argv):
+    """Parse a single subcommand line with an existing parser
 
     Args:
-      args ([str]): command line parameters as list of strings
+      parser (:obj:`argparse.ArgumentParser`): parser from :func:`build_parser`
+      argv ([str]): command line parameters as list of strings
 
     Returns:
       :obj:`argparse.Namespace`: command line parameters namespace
     """
+    parsed = parser.parse_args(argv)
+    if not ns_hasattr(parsed, 'func'):
+        parser.error('missing subcommand: %s' % ' '.join(argv))
+    assert_format(parsed, parser)
+    Command.assert_post_parse(parsed, parser)
+    return parsed
+
+
+def render(parser, argv):
+    """Parse a single subcommand line with an existing parser and render it
+
+    Returns:
+      str: the rendered output or None if the subcommand wrote it itself
+    """
+    parsed = parse_line(parser, argv)
+    return parsed.func(parsed)
+
+
+SUBCOMMANDS = OrderedDict([
+    ('comment', Comment),
+    ('steps', Steps),
+    ('env', Env),
+    ('command', Command),
+    ('plugin', Plugin),
+    ('wait', Wait),
+    ('trigger', Trigger),
+    ('block', Block),
+    ('shard', Shard),
+    ('split', Split),
+    ('timings', Timings),
+    ('cache', Cache),
+    ('batch', Batch),
+    ('stage', Stage),
+    ('diff', Diff),
+    ('analyze', Analyze),
+    ('simulate', Simulate),
+    ('run-local', RunLocal),
+    ('serve', Serve),
+])
+
+
+class VersionAction(argparse.Action):
+    """Like argparse's version action, but only looks the version up when used"""
+
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, default=argparse.SUPPRESS,
+                 help="show program's version number and exit"):
+        super(VersionAction, self).__init__(
+            option_strings=option_strings,
+            dest=dest,
+            default=default,
+            nargs=0,
+            help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        # pylint: disable=protected-access
+        parser._print_message('bkyml {ver}\n'.format(ver=bkyml.__version__), sys.stdout)
+        parser.exit()
+
+
+# options before the subcommand that take a value, like in bkyml.daemon
+OPTIONS_WITH_VALUE = ('--format', '--changed-files', '--resolve-branches')
+
+
+def chosen_subcommand(args):
+    """Name of the subcommand a command line invokes, if any
+
+    Args:
+      args ([str]): command line parameters as list of strings
+    """
+    args = iter(args)
+    for arg in args:
+        if arg in OPTIONS_WITH_VALUE:
+            next(args, None)
+        elif not arg.startswith('-'):
+            return arg if arg in SUBCOMMANDS else None
+    return None
+
+
+def build_parser(prog=None, only=None):
+    """Build the command line parser
+
+    Args:
+      prog (str): program name used in usage messages, defaults to argv[0]
+      only (str): only fully build this subcommand, the others get a bare
+        placeholder parser so they are still listed in the help
+
+    Returns:
+      :obj:`argparse.ArgumentParser`: the top-level parser
+    """
     parser = argparse.ArgumentParser(
+        prog=prog,
         description="Generate pipeline YAML for Buildkite")
 
     subparsers = parser.add_subparsers(title='subcommands',
                                        description='valid subcommands',
                                        help='additional help')
 
-    Comment.install(subparsers)
-    Steps.install(subparsers)
-    Env.install(subparsers)
-    Command.install(subparsers)
-    Plugin.install(subparsers)
-    Wait.install(subparsers)
-    Trigger.install(subparsers)
-    Block.install(subparsers)
+    for name, subcommand in SUBCOMMANDS.items():
+        if only is None or name == only:
+            subcommand.install(subparsers)
+        else:
+            subparsers.add_parser(name)
 
     parser.add_argument(
         '--version',
-        action='version',
-        version='bkyml {ver}'.format(ver=__version__))
+        action=VersionAction)
     parser.add_argument(
         '-v',
         '--verbose',
@@ -790,16 +2522,67 @@ def parse_args(args):
         help="set loglevel to DEBUG",
         action='store_const',
         const=logging.DEBUG)
+    parser.add_argument(
+        '--format',
+        help="output format (default: yaml). yaml-c needs PyYAML with libyaml, \
+            json and yaml-flow render a single document in batch mode",
+        choices=list(FORMATS),
+        default='yaml')
+    parser.add_argument(
+        '--changed-files',
+        help="file listing the changed paths, one per line (- for stdin), e.g. from \
+            git diff --name-only. Steps whose --watch matches none of them are left out",
+        metavar="FILE")
+    parser.add_argument(
+        '--resolve-branches',
+        help="the branch being built, e.g. $BUILDKITE_BRANCH. Steps whose --branches \
+            filter does not match it are left out instead of being uploaded",
+        metavar="BRANCH")
+    parser.add_argument(
+        '--anchors',
+        help="write repeated env, agents and plugins maps of steps once as YAML \
+            anchors and aliases after. Needs --format yaml",
+        action='store_true')
+    parser.add_argument(
+        '--via-daemon',
+        help="forward this invocation to a bkyml daemon, starting one if needed \
+            (also enabled by setting $BKYML_SOCKET)",
+        action='store_true')
+    return parser
+
+
+def parse_args(args):
+    """Parse command line parameters
+
+    Args:
+      args ([str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = build_parser(only=chosen_subcommand(args))
 
     if len(sys.argv) == 1:
         parser.print_help(sys.stderr)
         sys.exit(1)
 
     parsed = parser.parse_args(args)
+    assert_format(parsed, parser)
     Command.assert_post_parse(parsed, parser)
+    use_filters(parser, parsed)
     return parsed
 
 
+def use_filters(parser, parsed):
+    """Apply ``--resolve-branches`` and load ``--changed-files``, failing with a
+    usage error if it can not be read"""
+    use_branch(parsed.resolve_branches)
+    try:
+        use_changes(parsed.changed_files)
+    except OSError as error:
+        parser.error('--changed-files: %s' % error)
+
+
 def setup_logging(loglevel):
     """Setup basic logging
 
@@ -814,6 +2597,8 @@ def setup_logging(loglevel):
 def parse_main(args):
     args = parse_args(args)
     setup_logging(args.loglevel)
+    use_format(args.format)
+    use_anchors(args.anchors)
     return args.func(args)
 
 
@@ -824,14 +2609,21 @@ def main(args):
       args ([str]): command line parameter list
     """
     LOGGER.debug("Calling function")
-    print(parse_main(args))
+    output = parse_main(args)
+    if output is not None:
+        print(output)
     LOGGER.info("Script ends here")
 
 
 def run():
     """Entry point for console_scripts
     """
-    main(sys.argv[1:])
+    args = sys.argv[1:]
+    if '--via-daemon' in args or os.environ.get('BKYML_SOCKET'):
+        from bkyml import daemon
+        if daemon.wants_daemon(args):
+            sys.exit(daemon.forward(args))
+    main(args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+'''
+    Upload a pipeline in stages, so the first jobs start before the rest is generated
+
+    ``batch --stage-steps N`` renders the first lines of a batch until they
+    produced N steps, followed by a command step that uploads the rest. The
+    lines that are left are not even parsed; they are written to a plan
+    together with the comments, ``env`` and ``steps`` lines and the global
+    options the batch was rendered with, and ``bkyml stage PLAN`` renders
+    them in the follow-up job.
+'''
+from __future__ import division, print_function, absolute_import
+
+import json
+import os
+import shlex
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+VERSION = 1
+DEFAULT_PLAN = '.bkyml-plan.json'
+DEFAULT_COMMAND = ('buildkite-agent artifact download {plan} . && '
+                   'bkyml stage {plan} | buildkite-agent pipeline upload')
+DEFAULT_LABEL = ':pipeline: Upload the rest of the pipeline'
+# subcommands whose lines every stage needs
+HEADER_SUBCOMMANDS = ('comment', 'env', 'steps')
+# a stage ends before these, so its follow-up step never waits for them
+BARRIER_SUBCOMMANDS = ('wait', 'block')
+
+
+class Plan:
+    """The lines of the batch left for the next stage and the options to render them with
+
+    Args:
+      lines ([[str]]): the arguments of every line, header lines first
+      fmt (str): the ``--format``
+      branch (str): the ``--resolve-branches`` branch
+      changed_files ([str]): the ``--changed-files`` paths, None for every step
+      anchors (bool): whether ``--anchors`` was given
+      keys ([str]): the keys of the steps of the stages before, which the
+        steps of this one may depend on
+    """
+
+    def __init__(self, lines, fmt='yaml', branch=None, changed_files=None, anchors=False,
+                 keys=()):
+        self.lines = lines
+        self.format = fmt
+        self.branch = branch
+        self.changed_files = changed_files
+        self.anchors = anchors
+        self.keys = list(keys)
+
+    def save(self, path):
+        temporary = '{path}.{pid}.tmp'.format(path=path, pid=os.getpid())
+        with open(temporary, 'w', encoding='utf-8', errors='surrogateescape') as stream:
+            json.dump({
+                'version': VERSION,
+                'format': self.format,
+                'branch': self.branch,
+                'changed_files': self.changed_files,
+                'anchors': self.anchors,
+                'keys': self.keys,
+                'lines': self.lines,
+            }, stream, separators=(',', ':'), ensure_ascii=False)
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read a plan
+
+        Raises:
+          OSError: if it can not be read
+          ValueError: if it is not a plan of this version of bkyml
+        """
+        with open(path, encoding='utf-8', errors='surrogateescape') as stream:
+            data = json.load(stream)
+        if not isinstance(data, dict) or data.get('version') != VERSION:
+            raise ValueError('%s is not a plan written by this version of bkyml' % path)
+        return cls(data['lines'], data['format'], data['branch'], data['changed_files'],
+                   data['anchors'], data['keys'])
+
+
+def follow_up(command, label, plan):
+    """The arguments of the ``command`` line uploading the next stage"""
+    return ['command', '--command', command.format(plan=shlex.quote(plan)), '--label', label]
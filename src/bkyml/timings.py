@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+'''
+    Per test durations and failure counts collected from JUnit XML reports
+
+    Reports are streamed with ``iterparse`` and ingested only once: the size
+    and modification time of every ingested report are stored next to the
+    tests in a SQLite database, which generators can query without going
+    back to the XML.
+
+    Example::
+
+        from bkyml.timings import Database
+
+        with Database('bkyml-timings.sqlite') as database:
+            durations = database.values(by='file')
+'''
+from __future__ import division, print_function, absolute_import
+
+import os
+import sqlite3
+from collections import OrderedDict
+from xml.etree.ElementTree import iterparse
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+DEFAULT_DATABASE = 'bkyml-timings.sqlite'
+# weight of the newest duration in the exponentially weighted average
+DEFAULT_ALPHA = 0.3
+SCHEMA = (
+    # without a rowid the tests are stored once, in the order of their id
+    'CREATE TABLE IF NOT EXISTS tests (id TEXT PRIMARY KEY, file TEXT NOT NULL, '
+    'duration REAL NOT NULL, runs INTEGER NOT NULL, failures INTEGER NOT NULL) '
+    'WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS reports (path TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+    'mtime INTEGER NOT NULL)',
+)
+# in KiB, enough to keep a million tests in memory while they are written
+CACHE_SIZE = 262144
+# what values() can sum up and group by
+COLUMNS = ('duration', 'failures', 'runs')
+GROUPS = {'file': 'file', 'test': 'id'}
+
+
+def seconds(value):
+    try:
+        return float((value or '0').replace(',', ''))
+    except ValueError:
+        return 0.0
+
+
+def testcases(source):
+    """Stream the test cases of a JUnit XML report, leaving out skipped ones
+
+    Every test case is cleared once it is read and every test suite once it
+    ends, so memory use does not grow with the size of the report.
+
+    Args:
+      source: path or binary file object of the report
+
+    Returns:
+      generator: ``(id, file, seconds, failed)`` per test case, ``id`` is
+        ``CLASSNAME::NAME`` and ``file`` the file attribute, falling back to
+        the class name
+    """
+    for _, element in iterparse(source):
+        if element.tag == 'testcase':
+            outcomes = {child.tag for child in element} if len(element) else ()
+            if 'skipped' not in outcomes:
+                classname = element.get('classname') or ''
+                name = element.get('name') or ''
+                yield (classname + '::' + name if classname else name,
+                       element.get('file') or classname or name,
+                       seconds(element.get('time')),
+                       'failure' in outcomes or 'error' in outcomes)
+            element.clear()
+        elif element.tag == 'testsuite':
+            element.clear()
+
+
+class Database:
+    """The timings database, created on first use
+
+    Args:
+      path (str): the SQLite file
+    """
+
+    def __init__(self, path=DEFAULT_DATABASE):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA cache_size = -%d' % CACHE_SIZE)
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def ingest(self, paths, alpha=DEFAULT_ALPHA):
+        """Add the test cases of the reports that changed since they were last ingested
+
+        A test case seen before updates the average of its durations with
+        weight ``alpha``, one seen for the first time starts at its duration.
+
+        Returns:
+          (int, int, int): the number of reports ingested, of test cases in them
+            and of unchanged reports skipped
+        """
+        ingested = dict(((path, (size, mtime)) for path, size, mtime in
+                         self.connection.execute('SELECT path, size, mtime FROM reports')))
+        reports = []
+        for path in paths:
+            stat = os.stat(path)
+            key = os.path.abspath(path)
+            if ingested.get(key) != (stat.st_size, stat.st_mtime_ns):
+                reports.append((path, key, stat.st_size, stat.st_mtime_ns))
+        if not reports:
+            return 0, 0, len(paths)
+
+        # fold the durations of every test in the reports into
+        # ``decay * previous + partial``, where previous is the stored average or,
+        # for a new test, its first duration; SQLite then merges them with the
+        # stored tests, so ingesting does not depend on the size of the database
+        batch = {}
+        cases = 0
+        for path, _, _, _ in reports:
+            for test, test_file, duration, failed in testcases(path):
+                cases += 1
+                row = batch.get(test)
+                if row is None:
+                    batch[test] = [test_file, duration, alpha * duration, 1 - alpha, 1, int(failed)]
+                else:
+                    row[0] = test_file
+                    row[2] = alpha * duration + (1 - alpha) * row[2]
+                    row[3] *= 1 - alpha
+                    row[4] += 1
+                    row[5] += failed
+        with self.connection:
+            self.connection.execute(
+                'CREATE TEMP TABLE batch (id TEXT PRIMARY KEY, file TEXT, first REAL, '
+                'partial REAL, decay REAL, runs INTEGER, failures INTEGER) WITHOUT ROWID')
+            self.connection.executemany(
+                'INSERT INTO batch VALUES (?, ?, ?, ?, ?, ?, ?)',
+                ([test] + batch[test] for test in sorted(batch)))
+            self.connection.execute(
+                'INSERT OR REPLACE INTO tests SELECT batch.id, batch.file, '
+                'batch.decay * COALESCE(tests.duration, batch.first) + batch.partial, '
+                'COALESCE(tests.runs, 0) + batch.runs, '
+                'COALESCE(tests.failures, 0) + batch.failures '
+                'FROM batch LEFT JOIN tests ON tests.id = batch.id')
+            self.connection.execute('DROP TABLE batch')
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO reports VALUES (?, ?, ?)',
+                (report[1:] for report in reports))
+        return len(reports), cases, len(paths) - len(reports)
+
+    def values(self, column='duration', by='file'):
+        """Sum up a column per file or per test
+
+        Args:
+          column (str): one of COLUMNS
+          by (str): ``file`` or ``test``
+
+        Returns:
+          OrderedDict: file or test id to the sum, sorted
+        """
+        if column not in COLUMNS or by not in GROUPS:
+            raise ValueError('can not sum up {column} by {by}'.format(column=column, by=by))
+        return OrderedDict(self.connection.execute(
+            'SELECT {group}, SUM({column}) FROM tests GROUP BY {group} ORDER BY {group}'
+            .format(group=GROUPS[by], column=column)))
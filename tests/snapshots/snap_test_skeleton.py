@@ -30,9 +30,11 @@ optional arguments:
 '''
 
 snapshots['test_help 4'] = '''usage:  command [-h] --command COMMAND [COMMAND ...] [--label LABEL]
+                [--key KEY] [--depends-on KEY [KEY ...]]
                 [--branches BRANCH_PATTERN [BRANCH_PATTERN ...]]
                 [--env KEY VALUE] [--agents KEY VALUE]
                 [--artifact-paths GLOB_OR_PATH [GLOB_OR_PATH ...]]
+                [--needs-artifact [GLOB_OR_PATH ...]] [--estimate SECONDS]
                 [--parallelism POSITIVE_NUMBER] [--concurrency POSITIVE_INT]
                 [--concurrency-group GROUP_NAME]
                 [--timeout-in-minutes TIMEOUT] [--skip BOOL_OR_STRING]
@@ -45,6 +47,10 @@ snapshots['test_help 4'] = '''usage:  command [-h] --command COMMAND [COMMAND ..
                 [--retry-manual-permit-on-passed]
                 [--no-retry-manual-permit-on-passed]
                 [--plugin PLUGIN [KEY_VALUE_PAIR ...]]
+                [--matrix NAME=VALUE[,VALUE...]]
+                [--matrix-exclude NAME=VALUE[,NAME=VALUE...]]
+                [--for-each-glob PATTERN] [--watch PATH_OR_GLOB]
+                [--cache-inputs GLOB [GLOB ...]] [--cache-dir DIR]
 
 optional arguments:
   -h, --help            show this help message and exit
@@ -52,6 +58,11 @@ optional arguments:
                         The shell command/s to run during this step.
   --label LABEL         The label that will be displayed in the pipeline
                         visualisation in Buildkite. Supports emoji.
+  --key KEY             A unique key other steps can depend on with --depends-
+                        on.
+  --depends-on KEY [KEY ...]
+                        Keys of the steps this step waits for, in addition to
+                        the wait and block steps before it.
   --branches BRANCH_PATTERN [BRANCH_PATTERN ...]
                         The branch pattern defining which branches will
                         include this step in their builds.
@@ -61,6 +72,13 @@ optional arguments:
   --artifact-paths GLOB_OR_PATH [GLOB_OR_PATH ...]
                         The glob path or paths where artifacts from this step
                         will be uploaded.
+  --needs-artifact [GLOB_OR_PATH ...]
+                        The artifacts this step downloads from the steps
+                        before it. Only read by batch --eliminate-waits, give
+                        it without paths for a step that needs nothing from
+                        the steps before it.
+  --estimate SECONDS    How many seconds this step takes. Only read by analyze
+                        critical-path, for steps without --timings.
   --parallelism POSITIVE_NUMBER
                         The number of parallel jobs that will be created based
                         on this step.
@@ -106,6 +124,32 @@ optional arguments:
   --plugin PLUGIN [KEY_VALUE_PAIR ...]
                         A plugin to run with this step. Optionally key/value
                         pairs for the plugin.
+  --matrix NAME=VALUE[,VALUE...]
+                        Emit the step once per value, replacing {NAME} in the
+                        label, key, --depends-on keys, commands, env, agents,
+                        plugins, artifact paths and watched paths. Repeat for
+                        the cartesian product of several dimensions.
+  --matrix-exclude NAME=VALUE[,NAME=VALUE...]
+                        Skip the combinations matching all of the given
+                        values.
+  --for-each-glob PATTERN
+                        Emit the step once per path matching PATTERN,
+                        replacing {path}. Matches are sorted, ** recurses and
+                        a trailing / only matches directories. Combines with
+                        --matrix.
+  --watch PATH_OR_GLOB  Only emit the step if one of the paths given with
+                        --changed-files is PATH, is below it or matches the
+                        glob. * and ? stay within a directory, ** crosses
+                        them. Steps without --watch are always emitted.
+  --cache-inputs GLOB [GLOB ...]
+                        Hash the step and the files matching the globs (a
+                        directory stands for all files below it) and skip the
+                        step if it passed with the same hash before. The hash
+                        is passed to the step as $BKYML_INPUTS_HASH, record it
+                        with bkyml cache record once the step passed.
+  --cache-dir DIR       Directory keeping the file digests and the hashes of
+                        passed steps. Defaults to $BKYML_CACHE_DIR or .bkyml-
+                        cache.
 '''
 
 snapshots['test_steps 1'] = '''steps:
@@ -384,8 +428,8 @@ snapshots['test_trigger_label 1'] = '''  - trigger: my-pipeline
     label: ':rocket: Deploy'
 '''
 
-snapshots['test_help 7'] = '''usage:  trigger [-h] [--label LABEL] [--async]
-                [--branches BRANCH_PATTERN [BRANCH_PATTERN ...]]
+snapshots['test_help 7'] = '''usage:  trigger [-h] [--label LABEL] [--key KEY] [--depends-on KEY [KEY ...]]
+                [--async] [--branches BRANCH_PATTERN [BRANCH_PATTERN ...]]
                 [--build-message MESSAGE] [--build-commit SHA]
                 [--build-branch BRANCH] [--build-env KEY VALUE]
                 [--build-meta-data KEY VALUE]
@@ -398,6 +442,11 @@ optional arguments:
   -h, --help            show this help message and exit
   --label LABEL         The label that will be displayed in the pipeline
                         visualisation in Buildkite. Supports emoji.
+  --key KEY             A unique key other steps can depend on with --depends-
+                        on.
+  --depends-on KEY [KEY ...]
+                        Keys of the steps this step waits for, in addition to
+                        the wait and block steps before it.
   --async               If given, the step will immediately continue,
                         regardless of the success of the triggered build.
   --branches BRANCH_PATTERN [BRANCH_PATTERN ...]
@@ -450,8 +499,11 @@ snapshots['test_trigger_build_meta_data 1'] = '''  - trigger: my-pipeline
         a: b
 '''
 
-snapshots['test_empty_command 1'] = '''usage:  [-h] [--version] [-v] [-vv]
-        {comment,steps,env,command,plugin,wait,trigger,block} ...
+snapshots['test_empty_command 1'] = '''usage:  [-h] [--version] [-v] [-vv] [--format {yaml,yaml-c,json,yaml-flow}]
+        [--changed-files FILE] [--resolve-branches BRANCH] [--anchors]
+        [--via-daemon]
+        {comment,steps,env,command,plugin,wait,trigger,block,shard,split,timings,cache,batch,stage,diff,analyze,simulate,run-local,serve}
+        ...
 
 Generate pipeline YAML for Buildkite
 
@@ -460,15 +512,31 @@ optional arguments:
   --version             show program's version number and exit
   -v, --verbose         set loglevel to INFO
   -vv, --very-verbose   set loglevel to DEBUG
+  --format {yaml,yaml-c,json,yaml-flow}
+                        output format (default: yaml). yaml-c needs PyYAML
+                        with libyaml, json and yaml-flow render a single
+                        document in batch mode
+  --changed-files FILE  file listing the changed paths, one per line (- for
+                        stdin), e.g. from git diff --name-only. Steps whose
+                        --watch matches none of them are left out
+  --resolve-branches BRANCH
+                        the branch being built, e.g. $BUILDKITE_BRANCH. Steps
+                        whose --branches filter does not match it are left out
+                        instead of being uploaded
+  --anchors             write repeated env, agents and plugins maps of steps
+                        once as YAML anchors and aliases after. Needs --format
+                        yaml
+  --via-daemon          forward this invocation to a bkyml daemon, starting
+                        one if needed (also enabled by setting $BKYML_SOCKET)
 
 subcommands:
   valid subcommands
 
-  {comment,steps,env,command,plugin,wait,trigger,block}
+  {comment,steps,env,command,plugin,wait,trigger,block,shard,split,timings,cache,batch,stage,diff,analyze,simulate,run-local,serve}
                         additional help
 '''
 
-snapshots['test_help 8'] = '''usage:  block [-h] [--prompt PROMPT]
+snapshots['test_help 8'] = '''usage:  block [-h] [--prompt PROMPT] [--key KEY] [--depends-on KEY [KEY ...]]
               [--branches BRANCH_PATTERN [BRANCH_PATTERN ...]]
               [--field-text KEY LABEL HINT REQUIRED DEFAULT]
               [--field-select KEY LABEL HINT REQUIRED DEFAULT KEY_VALUE_PAIRS [KEY_VALUE_PAIRS ...]
@@ -483,6 +551,11 @@ optional arguments:
   -h, --help            show this help message and exit
   --prompt PROMPT       The instructional message displayed in the dialog box
                         when the unblock step is activated.
+  --key KEY             A unique key other steps can depend on with --depends-
+                        on.
+  --depends-on KEY [KEY ...]
+                        Keys of the steps this step waits for, in addition to
+                        the wait and block steps before it.
   --branches BRANCH_PATTERN [BRANCH_PATTERN ...]
                         The branch pattern defining which branches will
                         include this step in their builds.
@@ -578,3 +651,72 @@ snapshots['test_block_field_multi_fields 1'] = '''  - block: ':rocket: Release'
           - label: Label2
             value: opt2
 '''
+
+snapshots['test_batch_cli 1'] = '''steps:
+
+  - wait
+
+'''
+
+snapshots['test_matrix_cli 1'] = '''  - label: ':linux: 3.6'
+    command: tox -e py3.6
+    env:
+      PY: '3.6'
+    agents:
+      os: linux
+    plugins:
+      docker#v1.0.0:
+        image: python:3.6
+
+  - label: ':linux: 3.7'
+    command: tox -e py3.7
+    env:
+      PY: '3.7'
+    agents:
+      os: linux
+    plugins:
+      docker#v1.0.0:
+        image: python:3.7
+
+  - label: ':windows: 3.7'
+    command: tox -e py3.7
+    env:
+      PY: '3.7'
+    agents:
+      os: windows
+    plugins:
+      docker#v1.0.0:
+        image: python:3.7
+
+'''
+
+snapshots['test_diff_cli 1'] = '''~ label: a (command)
++ label: b
+- wait
+1 added, 1 removed, 1 changed, 0 unchanged
+'''
+
+snapshots['test_diff_cli 2'] = ''
+
+snapshots['test_anchors_cli 1'] = '''steps:
+
+  - command: a
+    env: &env1
+      A: B
+    agents: &agents1
+      queue: q
+    plugins: &plugins1
+      docker#v1: &plugin1
+        image: x
+
+  - command: b
+    env: *env1
+    agents: &agents2
+      queue: r
+    plugins: *plugins1
+
+  - trigger: t
+    build:
+      env: *env1
+
+'''
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=unused-variable
+# pylint: disable=missing-docstring
+
+from collections import OrderedDict
+from bkyml import barriers, graph
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+CONTINUE = OrderedDict([('wait', None), ('continue_on_failure', True)])
+
+
+def step(label, artifacts=None, **extra):
+    found = OrderedDict([('label', label)])
+    found.update(extra)
+    found['command'] = label
+    if artifacts is not None:
+        found['artifact_paths'] = artifacts
+    return found
+
+
+def eliminate(pairs):
+    """Eliminate the waits of ``(step, needs)`` pairs and check the result is a valid graph"""
+    steps, needs, removed = barriers.eliminate([found for found, _ in pairs],
+                                               [need for _, need in pairs])
+    assert len(needs) == len(steps)
+    graph.validate(steps)
+    return steps, removed
+
+
+def describe_barriers():
+
+    def test_replaces_waits():
+        steps, removed = eliminate([
+            (step('build', 'dist/*.whl'), None),
+            (step('docs', ['docs.tar', 'site/']), None),
+            ('wait', None),
+            (step('test'), ['dist/app.whl']),
+            (step('lint'), []),
+        ])
+        assert removed == 1
+        assert steps == [
+            step('build', 'dist/*.whl', key='step-1'),
+            step('docs', ['docs.tar', 'site/']),
+            step('test', depends_on='step-1'),
+            step('lint'),
+        ]
+        assert list(steps[0]) == ['label', 'key', 'command', 'artifact_paths']
+
+    def test_keeps_waits_of_undeclared_steps():
+        pairs = [(step('build', 'a'), None), ('wait', None), (step('test'), ['a']),
+                 (step('deploy'), None), ('wait', None), (step('last'), None)]
+        steps, removed = eliminate(pairs)
+        assert (steps, removed) == ([found for found, _ in pairs], 0)
+        # nothing after it
+        assert eliminate([(step('build', 'a'), None), ('wait', None)])[1] == 0
+
+    def test_blocks_stay():
+        steps, removed = eliminate([
+            (step('build', 'a'), None), ({'block': 'Go'}, None), (step('test'), ['a']),
+            ('wait', None), (step('deploy'), ['a'])])
+        assert removed == 1
+        # the build is before the block, which the deploy still waits for
+        assert steps[-1] == step('deploy')
+
+    def test_continue_on_failure():
+        steps, removed = eliminate([
+            (step('build', 'a', key='build'), None),
+            (CONTINUE, None),
+            (step('report'), ['a']),
+            ('wait', None),
+            (step('publish'), ['a']),
+        ])
+        assert removed == 2
+        assert steps[1]['depends_on'] == [
+            OrderedDict([('step', 'build'), ('allow_failure', True)])]
+        # a wait stopping on failure is in between
+        assert steps[2]['depends_on'] == 'build'
+
+    def test_same_segment():
+        steps, removed = eliminate([
+            ('wait', None), (step('build', 'a'), []), (step('test'), ['a'])])
+        assert removed == 1
+        assert steps == [step('build', 'a'), step('test')]
+
+    def test_keys_and_dependencies():
+        steps, _ = eliminate([
+            (step('step-1'), None),
+            (OrderedDict([('trigger', 't'), ('label', 'x'), ('artifact_paths', 'a')]), None),
+            (step('other', key='other'), None),
+            ('wait', None),
+            (step('test', key='test', depends_on='other'), ['a']),
+        ])
+        assert list(steps[1].items())[:3] == [('trigger', 't'), ('label', 'x'),
+                                              ('key', 'step-2')]
+        assert steps[-1] == step('test', key='test', depends_on=['other', 'step-2'])
+
+    def test_artifacts():
+        artifacts = barriers.Artifacts()
+        assert artifacts.match('dist/app.whl', 'dist/*.whl')
+        assert artifacts.match('./dist/**/*.whl', 'dist/x/app.whl')
+        assert not artifacts.match('dist/app.whl', '*.whl')
+        assert not artifacts.match('docs.tar', 'dist/*')
+
+    def test_removable():
+        steps = ['wait', 'wait', step('a'), {'block': 'b'}, 'wait', step('b'), 'wait']
+        assert barriers.removable(steps, [None, None, [], None, None, None, None]) == {0, 1}
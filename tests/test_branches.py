@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=unused-variable
+# pylint: disable=missing-docstring
+
+import pytest
+from bkyml import branches
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+
+def describe_branches():
+
+    @pytest.mark.parametrize('patterns, branch, expected', [
+        ('master', 'master', True),
+        ('master', 'master-2', False),
+        ('master stable/*', 'stable/1.x', True),
+        ('features/*', 'features/a/b', True),
+        ('*-test', 'x-test', True),
+        ('*-test', 'x-test-2', False),
+        ('!master', 'feature', True),
+        ('!master', 'master', False),
+        ('* !release/*', 'release/1.0', False),
+        ('* !release/*', 'master', True),
+        ('release/* !release/old-*', 'release/old-1', False),
+        ('release/* !release/old-*', 'release/2', True),
+        ('a.b', 'axb', False),
+        ('feature/[x]', 'feature/[x]', True),
+        ('Master', 'master', False),
+    ])
+    def test_matches(patterns, branch, expected):
+        assert branches.matches(patterns, branch) is expected
+
+    def test_compiled_once():
+        branches.compile_filter.cache_clear()
+        for branch in ('a', 'b', 'c'):
+            branches.matches('a b !c', branch)
+        assert branches.compile_filter.cache_info().misses == 1
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=unused-variable
+# pylint: disable=missing-docstring
+
+import fnmatch
+import random
+import re
+from types import SimpleNamespace
+import pytest
+from bkyml import changes
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+CHANGED = [
+    './packages/a/setup.py',
+    'packages/a-b/README',
+    'packages/b/src/deep/module.py',
+    'docs/index.rst',
+    '.buildkite/pipeline.yml',
+    'Makefile',
+    '',
+]
+
+
+def fnmatch_watched(paths, pattern):
+    """The changed paths matching ``pattern`` the slow way, ``**`` only as a whole component"""
+    parts = changes.normalize(pattern).split('/')
+    found = []
+    for path in map(changes.normalize, paths):
+        names = path.split('/')
+        for length in range(1, len(names) + 1):
+            if matches(names[:length], parts):
+                found.append(path)
+                break
+    return sorted(found)
+
+
+def matches(names, parts):
+    if not parts:
+        return not names
+    if parts[0] == '**':
+        return any(matches(names[skip:], parts[1:]) for skip in range(len(names) + 1))
+    return bool(names) and fnmatch.fnmatchcase(names[0], parts[0]) \
+        and matches(names[1:], parts[1:])
+
+
+def describe_changes():
+
+    @pytest.fixture
+    def index():
+        return changes.ChangeIndex(CHANGED)
+
+    def test_normalize():
+        assert changes.normalize(' ./././a/b/ ') == 'a/b'
+
+    def test_sorted_and_unique():
+        assert changes.ChangeIndex(['b', './a', 'b/']).paths == ['a', 'b']
+
+    def describe_match():
+        def test_paths(index):
+            assert index.match('Makefile') == 'Makefile'
+            assert index.match('packages/a') == 'packages/a/setup.py'
+            assert index.match('./packages/a/') == 'packages/a/setup.py'
+            assert index.match('packages/a-b') == 'packages/a-b/README'
+            assert index.match('packages/c') is None
+            assert index.match('packages/a/setup') is None
+            assert index.match('Make') is None
+
+        def test_globs(index):
+            assert index.match('packages/*/src') == 'packages/b/src/deep/module.py'
+            assert index.match('packages/*') == 'packages/a-b/README'
+            assert index.match('**/*.py') == 'packages/a/setup.py'
+            assert index.match('packages/**/deep/*.py') == 'packages/b/src/deep/module.py'
+            assert index.match('docs/*.md') is None
+            assert index.match('*.yml') is None
+            assert index.match('.buildkite/*.yml') == '.buildkite/pipeline.yml'
+            assert index.match('packages/[ab]/setup.py') == 'packages/a/setup.py'
+            assert index.match('packages/[!a]/**') == 'packages/b/src/deep/module.py'
+            assert index.match('packages/?') == 'packages/a/setup.py'
+
+        def test_stays_on_one_line():
+            index = changes.ChangeIndex(['a', 'b', 'c/x'])
+            assert index.match('a[!x]b') is None
+            assert index.match('a*b') is None
+            assert index.match('a**b') is None
+            assert index.match('c/[]x]') == 'c/x'
+
+        def test_unbalanced_bracket():
+            assert changes.ChangeIndex(['a[b']).match('a[b') == 'a[b'
+            assert changes.ChangeIndex(['a[b']).match('*[b') == 'a[b'
+
+        def test_same_as_fnmatch():
+            rng = random.Random(11)
+            names = ['a', 'b', 'ab', 'x.py', 'y.txt']
+            paths = ['/'.join(rng.choice(names) for _ in range(rng.randint(1, 4)))
+                     for _ in range(300)]
+            index = changes.ChangeIndex(paths)
+            for pattern in ['a', 'a/b', '*', 'a/*', '*.py', '**/*.py', 'a/**', 'a/**/b',
+                            '**/ab/*.txt', '?', '[ab]/*', '[!a]*/b', 'b/**/x.py']:
+                found = index.match(pattern)
+                expected = fnmatch_watched(paths, pattern)
+                assert (found is not None) == bool(expected), pattern
+                if found is not None:
+                    assert found in expected, pattern
+
+        def test_cached(index):
+            index.match('**/*.py')
+            index.cache[changes.normalize('**/*.py')] = 'cached'
+            assert index.match('**/*.py') == 'cached'
+
+    def test_watched(index):
+        assert index.watched(['nothing', 'docs']) == 'docs/index.rst'
+        assert index.watched(['nothing']) is None
+        assert index.watched([]) is None
+
+    def test_load(tmpdir):
+        tmpdir.join('changes.txt').write('b.py\na.py\n\n')
+        assert changes.ChangeIndex.load(str(tmpdir.join('changes.txt'))).paths == ['a.py', 'b.py']
+
+    def test_searches_below_literal_directories(monkeypatch):
+        paths = ['packages/p%d/src/file%d.py' % (index % 2000, index) for index in range(50000)]
+        index = changes.ChangeIndex(paths)
+        scanned = []
+
+        class Counting:
+            def __init__(self, regexp):
+                self.regexp = regexp
+
+            def search(self, text, start, stop):
+                scanned.append(stop - start)
+                return self.regexp.search(text, start, stop)
+
+        monkeypatch.setattr(changes, 're', SimpleNamespace(
+            M=re.M, escape=re.escape, compile=lambda *args: Counting(re.compile(*args))))
+        for _ in range(2):
+            for package in range(5000):
+                index.watched(['packages/p%d/src/*.py' % package,
+                               'packages/p%d/setup.cfg' % package, 'lib/**/*.h'])
+        # one search per package with changes, each only over the paths of its package
+        assert len(scanned) == 2000
+        assert sum(scanned) < len(index.text)
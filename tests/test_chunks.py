@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=unused-variable
+# pylint: disable=missing-docstring
+
+import json
+import pytest
+from bkyml import chunks, formats
+from bkyml.skeleton import YAML
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+
+def split(directory, steps, fmt=YAML, **limits):
+    """The steps of every fragment written for ``steps``"""
+    chunker = chunks.Chunker(fmt, str(directory), **limits)
+    chunker.add('env', {'A': 'b'})
+    for step in steps:
+        chunker.add('step', step)
+    paths = chunker.close()
+    assert directory.join(chunks.MANIFEST).read() == ''.join(path + '\n' for path in paths)
+    fragments = []
+    for path in paths:
+        with open(path) as stream:
+            document = YAML.yaml.load(stream)
+        assert document['env'] == {'A': 'b'}
+        fragments.append([step if isinstance(step, str) else dict(step)
+                          for step in document['steps'] or ()])
+    return fragments
+
+
+def command(name):
+    return {'command': name}
+
+
+def describe_chunks():
+
+    def test_max_steps(tmpdir):
+        steps = [command(str(number)) for number in range(5)]
+        assert split(tmpdir, steps, max_steps=2) == [steps[0:2], steps[2:4], steps[4:]]
+
+    def test_barriers_start_fragments(tmpdir):
+        steps = [command('a'), command('b'), 'wait', command('c'),
+                 {'block': 'Release'}, {'wait': None, 'continue_on_failure': True},
+                 command('d')]
+        assert split(tmpdir, steps, max_steps=3) == [
+            [command('a'), command('b')],
+            ['wait', command('c')],
+            [{'block': 'Release'}, {'wait': None, 'continue_on_failure': True}, command('d')],
+        ]
+        # nothing but barriers go together
+        assert split(tmpdir, ['wait', 'wait', command('a')], max_steps=1) == [
+            ['wait'], ['wait'], [command('a')]]
+
+    def test_max_bytes(tmpdir):
+        steps = [command('x' * 20) for _ in range(10)]
+        split(tmpdir, steps, max_bytes=200)
+        sizes = [len(path.read_binary()) for path in tmpdir.listdir('pipeline-*')]
+        assert len(sizes) > 1 and max(sizes) <= 200
+        # the header alone, a step only fits into a fragment of its own
+        assert len(split(tmpdir, steps[:2], max_bytes=10)) == 2
+
+    def test_json(tmpdir):
+        steps = [command(str(number)) for number in range(4)]
+        assert split(tmpdir, steps, fmt=formats.JsonFormat(), max_bytes=62) == [
+            steps[0:2], steps[2:]]
+        for path in tmpdir.listdir('pipeline-*.json'):
+            assert len(path.read_binary()) <= 62
+            json.loads(path.read())
+
+    def test_written(tmpdir):
+        written = []
+        chunker = chunks.Chunker(YAML, str(tmpdir), max_steps=1, written=written.append)
+        chunker.add('step', 'wait')
+        chunker.add('step', command('a'))
+        assert written == [str(tmpdir.join('pipeline-0001.yml'))]
+        assert chunker.close() == written
+
+    def test_empty(tmpdir):
+        assert split(tmpdir, [], max_steps=1) == [[]]
+        assert tmpdir.join('pipeline-0001.yml').read() == 'env:\n  A: b\n\nsteps:\n\n'
+
+    def test_env_after_steps(tmpdir):
+        chunker = chunks.Chunker(YAML, str(tmpdir), max_steps=1)
+        chunker.add('step', 'wait')
+        with pytest.raises(ValueError):
+            chunker.add('env', {'A': 'b'})
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=unused-variable
+# pylint: disable=missing-docstring
+
+from collections import OrderedDict
+import pytest
+from bkyml import critical
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+
+def step(label, **extra):
+    found = OrderedDict([('label', label)])
+    found.update(extra)
+    found['command'] = label
+    return found
+
+
+def analyze(steps, seconds):
+    """The analysis of ``steps`` taking ``seconds`` by label"""
+    return critical.Analysis(steps, critical.durations(steps, seconds)[0])
+
+
+def describe_critical():
+
+    def test_durations():
+        steps = [step('a', key='k'), 'wait', step('b'), step('c'), {'trigger': 'deploy'}]
+        assert critical.durations(steps, {'k': 5, 'a': 1, 'b': 3, 'deploy': 10},
+                                  [7, None, 2, 4, None]) == ([5, 0.0, 3, 4, 10], 0, 5.5)
+        # the mean of the known steps for the others
+        assert critical.durations(steps, {'label: b': 3}, [1, None, None, None, None]) == \
+            ([1, 0.0, 3, 2.0, 2.0], 2, 2.0)
+        assert critical.durations(steps, {}, default=1.5) == ([1.5, 0.0, 1.5, 1.5, 1.5], 4, 1.5)
+        assert critical.durations([], {}) == ([], 0, 0.0)
+
+    def test_barriers():
+        steps = [step('a'), step('b'), 'wait', step('c'), step('d'),
+                 {'block': 'Release'}, step('e')]
+        analysis = analyze(steps, {'a': 10, 'b': 4, 'c': 1, 'd': 5, 'e': 2})
+        assert analysis.start == [0, 0, 10, 10, 10, 15, 15]
+        assert analysis.slack == [0, 6, 0, 4, 0, 0, 0]
+        assert analysis.duration == 17
+        assert analysis.path == [0, 2, 4, 5, 6]
+
+    def test_dependencies():
+        steps = [step('a', key='a'), step('b', key='b'), step('c', depends_on='a'),
+                 step('d', depends_on=['b', {'step': 'a', 'allow_failure': True}]),
+                 'wait', step('e')]
+        analysis = analyze(steps, {'a': 3, 'b': 1, 'c': 2, 'd': 4, 'e': 1})
+        assert analysis.start == [0, 0, 3, 3, 7, 7]
+        assert analysis.slack == [0, 2, 2, 0, 0, 0]
+        assert analysis.path == [0, 3, 4, 5]
+        assert analysis.critical_steps(2) == [0, 1, 2, 3, 4, 5]
+        assert analysis.critical_steps() == [0, 3, 4, 5]
+
+    def test_forward_dependencies():
+        steps = [step('a', depends_on='b'), step('b', key='b')]
+        analysis = analyze(steps, {'a': 1, 'b': 2})
+        assert analysis.start == [2, 0]
+        assert analysis.path == [1, 0]
+
+    def test_invalid():
+        with pytest.raises(ValueError, match='unknown key'):
+            analyze([step('a', depends_on='x')], {})
+        with pytest.raises(ValueError, match='cycle'):
+            analyze([step('a', key='a', depends_on='b'), step('b', key='b', depends_on='a')],
+                    {})
+
+    def test_empty():
+        analysis = analyze([], {})
+        assert analysis.duration == 0 and analysis.path == []
+
+    def test_prioritize():
+        steps = [step('a'), step('b'), step('c', priority=-1), {'trigger': 'x'}, 'wait',
+                 step('d'), step('e')]
+        analysis = analyze(steps, {'a': 1, 'b': 5, 'c': 9, 'x': 9, 'd': 1, 'e': 2})
+        found, order = critical.prioritize(steps, analysis)
+        assert order == [2, 3, 1, 0, 4, 6, 5]
+        assert [dict(item) if isinstance(item, dict) else item for item in found] == [
+            step('c', priority=-1), {'trigger': 'x'}, step('b'), step('a'), 'wait',
+            dict(step('e'), priority=1), step('d')]
+        found, _ = critical.prioritize(steps, analysis, max_slack=4, priority=3)
+        assert [item.get('priority') for item in found if isinstance(item, dict)] == \
+            [-1, None, 3, None, 3, 3]
+        # the steps passed in are not changed
+        assert 'priority' not in steps[6]
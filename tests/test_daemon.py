@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=unused-variable
+# pylint: disable=missing-docstring
+
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+import pytest
+from bkyml import daemon
+from bkyml import skeleton
+from bkyml.skeleton import Serve, build_parser, parse_main, render
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+
+class HangingStdin(io.StringIO):
+    """Stands in for a pipe whose writer never closes it"""
+
+    def isatty(self):
+        return False
+
+    def read(self, *args):
+        raise AssertionError('stdin must not be read')
+
+
+def wait_until(condition, timeout=10.0):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.05)
+
+
+def describe_daemon():
+
+    @pytest.fixture
+    def directory():
+        path = tempfile.mkdtemp()
+        yield path
+        shutil.rmtree(path)
+
+    @pytest.fixture
+    def server():
+        parser = build_parser(prog='bkyml')
+        return daemon.Server('unused', lambda argv: render(parser, argv))
+
+    def describe_latency_histogram():
+        def test_buckets():
+            histogram = daemon.LatencyHistogram()
+            histogram.add(0.0004)
+            histogram.add(0.0009)
+            histogram.add(0.001)
+            stats = histogram.as_dict()
+            assert stats['count'] == 3
+            assert stats['buckets'] == [(512, 1), (1024, 2)]
+
+        def test_format():
+            histogram = daemon.LatencyHistogram()
+            histogram.add(0.001)
+            text = daemon.LatencyHistogram.format(histogram.as_dict())
+            assert 'requests: 1' in text
+            assert '1.024 ms' in text
+
+    def describe_wants_daemon():
+        def test_flag():
+            with patch.dict(os.environ, {daemon.SOCKET_ENV: ''}):
+                assert daemon.wants_daemon(['--via-daemon', 'wait'])
+                assert not daemon.wants_daemon(['wait'])
+
+        def test_env():
+            with patch.dict(os.environ, {daemon.SOCKET_ENV: '/tmp/x.sock'}):
+                assert daemon.wants_daemon(['wait'])
+                assert not daemon.wants_daemon(['serve'])
+
+    def describe_reads_stdin():
+        def test_batch():
+            assert daemon.reads_stdin(['batch'])
+            assert daemon.reads_stdin(['--format', 'json', 'batch', '--file', '-'])
+            assert not daemon.reads_stdin(['batch', '--file', 'lines.txt'])
+            assert not daemon.reads_stdin(['batch', '--file=lines.txt'])
+            assert not daemon.reads_stdin(['comment', 'batch'])
+            assert not daemon.reads_stdin(['-v'])
+
+        def test_files():
+            assert daemon.reads_stdin(['split', '--index', '0', '--total', '2'])
+            assert daemon.reads_stdin(['shard', '--shards', '2', '--files', '-'])
+            assert not daemon.reads_stdin(['shard', '--files', 'tests.txt'])
+            assert not daemon.reads_stdin(['split', '--files=tests.txt'])
+
+        def test_changed_files():
+            assert daemon.reads_stdin(['--changed-files', '-', 'command', '--command', 'x'])
+            assert daemon.reads_stdin(['--changed-files=-', 'batch', '--file', 'lines.txt'])
+            assert not daemon.reads_stdin(['--changed-files', 'changes.txt', 'wait'])
+
+    def describe_private_directory():
+        def test_created_private(directory):
+            with patch.dict(os.environ, {'XDG_RUNTIME_DIR': ''}), \
+                    patch.object(tempfile, 'gettempdir', return_value=directory):
+                path = daemon.private_directory()
+                assert os.stat(path).st_mode & 0o777 == 0o700
+                assert daemon.default_socket_path().startswith(path)
+
+        def test_rejects_shared(directory):
+            shared = os.path.join(directory, 'bkyml-{uid}'.format(uid=os.getuid()))
+            os.mkdir(shared, 0o755)
+            os.chmod(shared, 0o755)
+            with patch.dict(os.environ, {'XDG_RUNTIME_DIR': ''}), \
+                    patch.object(tempfile, 'gettempdir', return_value=directory):
+                with pytest.raises(PermissionError):
+                    daemon.private_directory()
+
+        def test_runtime_dir():
+            with patch.dict(os.environ, {'XDG_RUNTIME_DIR': '/run/user/1', daemon.SOCKET_ENV: ''}):
+                assert daemon.default_socket_path() == '/run/user/1/bkyml.sock'
+
+    def describe_dispatch():
+        def test_dispatch(server):
+            response = server.dispatch({'argv': ['wait']})
+            assert response == {'status': 0, 'stdout': '  - wait\n\n', 'stderr': ''}
+
+        def test_dispatch_error(server):
+            response = server.dispatch({'argv': ['command']})
+            assert response['status'] == 2
+            assert 'the following arguments are required: --command' in response['stderr']
+
+        def test_dispatch_batch_stdin(server):
+            response = server.dispatch({'argv': ['batch'], 'stdin': 'steps\nwait\n'})
+            assert response['stdout'] == 'steps:\n\n  - wait\n\n'
+
+        def test_dispatch_env(server, directory):
+            response = server.dispatch({'argv': ['cache', 'record', '0' * 64],
+                                        'env': {'BKYML_CACHE_DIR': directory}})
+            assert response['status'] == 0
+            assert os.listdir(directory)
+            assert 'BKYML_CACHE_DIR' not in os.environ
+
+        def test_handle_reuses_parser(directory):
+            lines = os.path.join(directory, 'lines.txt')
+            with open(lines, 'w') as stream:
+                stream.write('steps\nwait\n')
+            opened = []
+            parser = skeleton.use_parser(build_parser(prog='bkyml'))
+            real_open = open
+
+            def tracked(*args, **kwargs):
+                opened.append(real_open(*args, **kwargs))
+                return opened[-1]
+
+            try:
+                with patch.object(skeleton, 'build_parser', side_effect=AssertionError), \
+                        patch('builtins.open', tracked):
+                    server = daemon.Server('unused', lambda argv: Serve.handle(parser, argv))
+                    response = server.dispatch({'argv': ['batch', '--file', lines]})
+            finally:
+                skeleton.use_parser(None)
+            assert response['stdout'] == 'steps:\n\n  - wait\n\n'
+            assert opened and all(stream.closed for stream in opened)
+
+        def test_dispatch_stats(server):
+            server.dispatch({'argv': ['wait']})
+            assert server.dispatch({'stats': True})['stats']['count'] == 1
+
+    def describe_socket():
+        @pytest.fixture
+        def running(server, directory):
+            server.path = os.path.join(directory, 'd.sock')
+            thread = threading.Thread(target=server.serve_forever, args=(server.bind(),))
+            thread.start()
+            yield server
+            if thread.is_alive():
+                daemon.request({'shutdown': True}, server.path, autospawn=False)
+            thread.join(5)
+            assert not thread.is_alive()
+            assert not os.path.exists(server.path)
+
+        def test_roundtrip(running):
+            response = daemon.request({'argv': ['wait']}, running.path, autospawn=False)
+            assert response['stdout'] == '  - wait\n\n'
+
+        def test_probe_then_request(running):
+            assert daemon.listening(running.path)
+            response = daemon.request({'argv': ['wait']}, running.path, autospawn=False)
+            assert response['stdout'] == '  - wait\n\n'
+
+        def test_early_disconnect(running):
+            sock = daemon.socket.socket(daemon.socket.AF_UNIX, daemon.socket.SOCK_STREAM)
+            sock.connect(running.path)
+            sock.sendall(b'{"argv": ["wait"]}')
+            sock.close()
+            response = daemon.request({'argv': ['wait']}, running.path, autospawn=False)
+            assert response['status'] == 0
+
+        def test_split_per_job(running, directory, capsys):
+            tests = os.path.join(directory, 'tests.txt')
+            with open(tests, 'w') as stream:
+                stream.write('a\nb\nc\nd\n')
+            for job, expected in (('0', 'a\nc\n'), ('1', 'b\nd\n')):
+                with patch.dict(os.environ, {'BUILDKITE_PARALLEL_JOB': job,
+                                             'BUILDKITE_PARALLEL_JOB_COUNT': '2'}):
+                    assert daemon.forward(['split', '--files', tests], running.path) == 0
+                assert capsys.readouterr().out == expected
+            # the daemon's own environment is left as it was
+            assert 'BUILDKITE_PARALLEL_JOB' not in os.environ
+
+        def test_foreign_owner(running):
+            with patch.object(daemon.os, 'getuid', return_value=os.getuid() + 1):
+                with pytest.raises(PermissionError):
+                    daemon.check_owner(running.path, None)
+
+    def describe_end_to_end():
+        @pytest.fixture
+        def path(directory):
+            path = os.path.join(directory, 'e.sock')
+            yield path
+            if daemon.listening(path):
+                daemon.request({'shutdown': True}, path, autospawn=False)
+
+        def test_spawn_stats_and_stop(path, capsys):
+            response = daemon.request({'argv': ['wait']}, path)
+            assert response['stdout'] == '  - wait\n\n'
+            assert 'requests: 1' in parse_main(['serve', '--socket', path, '--stats'])
+            assert parse_main(['serve', '--socket', path, '--stop']) is None
+            wait_until(lambda: not os.path.exists(path))
+            with pytest.raises(SystemExit) as sys_exit:
+                parse_main(['serve', '--socket', path, '--stats'])
+            assert 'no bkyml daemon listening' in str(sys_exit.value)
+
+        def test_forward_batch_file(path, directory, capsys):
+            lines = os.path.join(directory, 'lines.txt')
+            with open(lines, 'w') as stream:
+                stream.write('steps\nwait\n')
+            with patch.object(daemon.sys, 'stdin', HangingStdin()):
+                status = daemon.forward(['--via-daemon', 'batch', '--file', lines], path)
+            assert status == 0
+            assert capsys.readouterr().out == 'steps:\n\n  - wait\n\n'
+
+        def test_idle_shutdown(path):
+            daemon.spawn(path, idle_timeout=0.5)
+            wait_until(lambda: daemon.listening(path))
+            wait_until(lambda: not os.path.exists(path))
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=unused-variable
+# pylint: disable=missing-docstring
+
+import argparse
+import random
+import pytest
+from ruamel.yaml import YAML as RuamelYaml
+from bkyml import emitter
+from bkyml.skeleton import MyYAML, \
+                           YAML, \
+                           Block, \
+                           Command, \
+                           Plugin, \
+                           Trigger, \
+                           Wait
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+ROUNDS = 300
+
+PIECES = [
+    'a', 'Z', 'run_tests', '0', '1', ' ', '  ', ':', ': ', '#', ' #', '-', '- ',
+    '?', "'", '"', '\n', '\t', ',', '[', '{', '}', '&', '*', '!', '|', '>', '%',
+    '@', '`', '.', '...', '---', 'true', 'False', 'null', '~', '=', '<<', 'yes',
+    '1.5', '1e3', '2001-01-01', '0x1f', '0o7', '.inf', '/', '\\', '_', 'é', '☃',
+    ':rocket:', '\U0001F680', '\x85', ' ', '﻿', '\x07',
+]
+
+
+# around the line width and the simple key length limits
+LIMIT_LENGTHS = list(range(70, 90)) + list(range(115, 135))
+
+
+def random_string(rng):
+    value = ''.join(rng.choice(PIECES) for _ in range(rng.randint(0, 6)))
+    if rng.random() < 0.05:
+        value = value * rng.randint(10, 30)
+    elif rng.random() < 0.1:
+        length = rng.choice(LIMIT_LENGTHS)
+        value = (value + 'x' * length)[:length]
+    return value
+
+
+def random_words(rng):
+    """Plain text longer than a line, with words around the line width"""
+    lengths = [1, 2, 5, 10, 30, 76, 78, 79, 80, 81, 90]
+    words = [''.join(rng.choice('abc/._-') for _ in range(rng.choice(lengths)))
+             for _ in range(rng.randint(2, 20))]
+    return 'a' + ''.join(word + ' ' * rng.choice([1, 1, 1, 2, 3]) for word in words).strip()
+
+
+def random_pairs(rng):
+    return [[random_string(rng), random_string(rng)] for _ in range(rng.randint(1, 3))]
+
+
+def ruamel_dump(data, **indent):
+    yaml = MyYAML()
+    yaml.fast = False
+    yaml.indent(**indent)
+    return yaml.to_string(data)
+
+
+def both(handler, namespace):
+    YAML.fast = False
+    try:
+        expected = handler(namespace)
+    finally:
+        YAML.fast = True
+    return handler(namespace), expected
+
+
+def describe_emitter():
+
+    @pytest.fixture
+    def rng():
+        return random.Random(1234)
+
+    def describe_scalars():
+        def test_plain_and_quoted():
+            assert emitter.scalar('yarn test') == 'yarn test'
+            assert emitter.scalar(':rocket: Release') == "':rocket: Release'"
+            assert emitter.scalar('1') == "'1'"
+            assert emitter.scalar('1.0.0') == '1.0.0'
+            assert emitter.scalar('true') == "'true'"
+            assert emitter.scalar('') == "''"
+            assert emitter.scalar(True) == 'true'
+            assert emitter.scalar(3) == '3'
+
+        def test_long_keys():
+            for length in range(118, 130):
+                args = argparse.Namespace(command=[['x']],
+                                          plugin=[['p' * length, ['image', 'python']]])
+                fast, expected = both(Command.command, args)
+                assert fast == expected
+                with pytest.raises(emitter.Unsupported):
+                    emitter.dump({'p' * length: {'image': 'python'}})
+
+        def test_unsupported():
+            for value in ["it's: here", 'a\nb', 'x\ty', 1.5]:
+                with pytest.raises(emitter.Unsupported):
+                    emitter.scalar(value)
+
+        def test_differential_scalars(rng):
+            supported = 0
+            for _ in range(ROUNDS * 3):
+                data = [{random_string(rng) or 'k': random_string(rng)}, random_string(rng)]
+                try:
+                    fast = emitter.dump(data, sequence=4, offset=2)
+                except emitter.Unsupported:
+                    continue
+                supported += 1
+                assert fast == ruamel_dump(data, sequence=4, offset=2), repr(data)
+            assert supported > ROUNDS // 2
+
+        def test_differential_keys(rng):
+            supported = 0
+            for _ in range(ROUNDS * 3):
+                data = [{random_string(rng) or 'k': {random_string(rng) or 'k': 'v'}}]
+                try:
+                    fast = emitter.dump(data, sequence=4, offset=2)
+                except emitter.Unsupported:
+                    continue
+                supported += 1
+                assert fast == ruamel_dump(data, sequence=4, offset=2), repr(data)
+            assert supported > ROUNDS // 2
+
+    def describe_folding():
+        def test_rule_is_known():
+            assert emitter.folding() in emitter.FOLDING_RULES
+
+        def test_rules():
+            probe = 'x' * 70 + ' ' + 'y' * 20 + ' z'
+            assert [emitter.fold(probe, 3, 2, rule) for rule in emitter.FOLDING_RULES] == [
+                ['x' * 70 + ' ', '  ' + 'y' * 20 + ' z'],
+                ['x' * 70 + ' ' + 'y' * 20, '  z'],
+                ['x' * 70 + ' ', '  ' + 'y' * 20 + ' z'],
+                ['x' * 70 + ' ' + 'y' * 20, '  z'],
+            ]
+            assert emitter.fold('x' * 77 + ' y', 3, 2, (True, False)) == ['x' * 77, '  y']
+            assert emitter.fold('x' * 77 + ' y', 3, 2, (False, False)) == ['x' * 77 + ' y']
+
+        def test_differential_long_plain(rng):
+            supported = 0
+            for indent in [{}, {'sequence': 4, 'offset': 2}, {'mapping': 4, 'sequence': 6,
+                                                              'offset': 4}]:
+                for _ in range(ROUNDS):
+                    text = random_words(rng)
+                    key = 'k' * rng.choice([1, 40, 76, 78])
+                    data = rng.choice([{key: text}, [text], [{key: text, 'j': text}],
+                                       {'a': {key: text}}, {'a': [{key: text}]}])
+                    try:
+                        fast = emitter.dump(data, **indent)
+                    except emitter.Unsupported:
+                        continue
+                    supported += 1
+                    assert fast == ruamel_dump(data, **indent), repr(data)
+            assert supported > ROUNDS * 2
+
+    def describe_indentation():
+        def test_defaults():
+            data = {'steps': [{'a': [1, {'b': None, 'c': {}}]}, 'wait']}
+            assert emitter.dump(data) == ruamel_dump(data)
+
+        def test_offset():
+            data = [{'a': [1, {'b': [], 'c': {'d': 'e'}}]}]
+            assert emitter.dump(data, sequence=4, offset=2) == \
+                ruamel_dump(data, sequence=4, offset=2)
+
+    def describe_differential_steps():
+        def test_command(rng):
+            for _ in range(ROUNDS):
+                args = argparse.Namespace(
+                    label=random_string(rng),
+                    command=[[random_string(rng)] for _ in range(rng.randint(1, 3))],
+                    branches=[random_string(rng)],
+                    env=random_pairs(rng),
+                    agents=random_pairs(rng),
+                    artifact_paths=[[random_string(rng)]],
+                    parallelism=rng.randint(1, 4),
+                    skip=rng.choice([None, True, random_string(rng)]),
+                    soft_fail=rng.choice([None, '*', 1]),
+                    retry=rng.choice([None, 'automatic', 'manual']),
+                    retry_manual_reason=random_string(rng),
+                    retry_automatic_tuple=[['*', 2], [1, 3]],
+                    plugin=[[random_string(rng) or 'p'] + random_pairs(rng)],
+                )
+                fast, expected = both(Command.command, args)
+                assert fast == expected
+
+        def test_trigger(rng):
+            for _ in range(ROUNDS):
+                args = argparse.Namespace(
+                    pipeline=random_string(rng),
+                    label=random_string(rng),
+                    is_async=rng.random() < 0.5,
+                    build_message=random_string(rng),
+                    build_env=random_pairs(rng),
+                    build_meta_data=random_pairs(rng),
+                )
+                fast, expected = both(Trigger.trigger, args)
+                assert fast == expected
+
+        def test_block(rng):
+            for _ in range(ROUNDS):
+                args = argparse.Namespace(
+                    label=random_string(rng),
+                    prompt=random_string(rng),
+                    field_text=[['key', 'l' + random_string(rng), random_string(rng),
+                                 rng.choice(['true', 'false']), random_string(rng)]],
+                    field_select=[['key', 'label', random_string(rng), 'true', 'a',
+                                   'a=' + random_string(rng), 'b=' + random_string(rng)]],
+                )
+                fast, expected = both(Block.block, args)
+                assert fast == expected
+
+        def test_plugin_and_wait(rng):
+            for _ in range(ROUNDS):
+                args = argparse.Namespace(
+                    name=random_string(rng),
+                    plugin=[[random_string(rng) or 'p'] + random_pairs(rng)],
+                    continue_on_failure=rng.random() < 0.5,
+                )
+                assert both(Plugin.plugin, args)[0] == both(Plugin.plugin, args)[1]
+                assert both(Wait.wait, args)[0] == both(Wait.wait, args)[1]
+
+    def describe_anchors():
+        @pytest.fixture
+        def anchors():
+            return emitter.Anchors()
+
+        def test_aliases_repeated_mappings(anchors):
+            step = {'command': 'a', 'env': {'A': '1'}, 'agents': {'queue': 'q'},
+                    'plugins': {'docker#v1': {'image': 'x'}, 'cache#v2': None}}
+            assert emitter.dump([step], anchors=anchors) == (
+                '- command: a\n'
+                '  env: &env1\n'
+                '    A: \'1\'\n'
+                '  agents: &agents1\n'
+                '    queue: q\n'
+                '  plugins: &plugins1\n'
+                '    docker#v1: &plugin1\n'
+                '      image: x\n'
+                '    cache#v2:\n'
+            )
+            other = {'command': 'b', 'env': {'A': '1'},
+                     'plugins': {'docker#v1': {'image': 'x'}}}
+            assert emitter.dump([step, other], anchors=anchors) == (
+                '- command: a\n'
+                '  env: *env1\n'
+                '  agents: *agents1\n'
+                '  plugins: *plugins1\n'
+                '- command: b\n'
+                '  env: *env1\n'
+                '  plugins: &plugins2\n'
+                '    docker#v1: *plugin1\n'
+            )
+
+        def test_only_within_steps(anchors):
+            data = {'env': {'A': 'b'}}
+            assert emitter.dump(data, anchors=anchors) == 'env:\n  A: b\n'
+            assert emitter.dump([{'label': {'A': 'b'}}], anchors=anchors) == '- label:\n    A: b\n'
+
+        def test_unsupported_parts_define_nothing(anchors):
+            with pytest.raises(emitter.Unsupported):
+                emitter.dump([{'env': {'A': 'b'}, 'label': "it's: x"}], anchors=anchors)
+            assert emitter.dump([{'env': {'A': 'b'}}], anchors=anchors) == \
+                '- env: &env1\n    A: b\n'
+
+        def test_intern_step(anchors):
+            first = anchors.intern_step({'env': {'A': 'b'}, 'plugins': {'p': {'c': 'd'}}})
+            second = anchors.intern_step({'build': {'env': {'A': 'b'}},
+                                          'plugins': {'p': {'c': 'd'}, 'q': None}})
+            assert second['build']['env'] is first['env']
+            assert second['plugins']['p'] is first['plugins']['p']
+            assert anchors.intern_step('wait') == 'wait'
+
+        def test_loads_like_repeated_mappings(rng):
+            envs = [{'A': '1'}, {'A': '2', 'B': 'x'}, {'C': ''}]
+            for _ in range(ROUNDS // 10):
+                steps = [{'command': rng.choice(['a', "it's: b"]), 'env': dict(rng.choice(envs)),
+                          'agents': {'queue': rng.choice('ab')},
+                          'plugins': {'p#v1': {'run': rng.choice('xy')}, 'q': None}}
+                         for _ in range(rng.randint(1, 8))]
+                anchors = emitter.Anchors()
+                lines = []
+                for step in steps:
+                    try:
+                        lines.append(emitter.dump([step], anchors=anchors))
+                    except emitter.Unsupported:
+                        lines.append(ruamel_dump([step]))
+                assert RuamelYaml(typ='safe').load(''.join(lines)) == steps
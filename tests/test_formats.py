@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=unused-variable
+# pylint: disable=missing-docstring
+
+import io
+import json
+import sys
+from collections import OrderedDict
+from unittest.mock import patch
+import pytest
+from bkyml import emitter, formats
+from bkyml.skeleton import YAML, parse_main, use_format
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+BATCH = (
+    "comment 'Pipeline'\n"
+    'env --var FORCE_COLOR 1\n'
+    'steps\n'
+    "command --command 'yarn test' --label ':karma: tests'\n"
+    'wait --continue-on-failure\n'
+    "plugin --plugin 'org/upload#1.0.0' dir=./coverage\n"
+)
+
+PIPELINE = OrderedDict([
+    ('env', OrderedDict([('FORCE_COLOR', '1')])),
+    ('steps', [
+        OrderedDict([('label', ':karma: tests'), ('command', 'yarn test')]),
+        OrderedDict([('wait', None), ('continue_on_failure', True)]),
+        OrderedDict([('plugins', OrderedDict([
+            ('org/upload#1.0.0', OrderedDict([('dir', './coverage')])),
+        ]))]),
+    ]),
+])
+
+
+def batch(capsys, fmt):
+    with patch.object(sys, 'stdin', io.StringIO(BATCH)):
+        assert parse_main(['--format', fmt, 'batch']) is None
+    return capsys.readouterr().out
+
+
+def describe_formats():
+
+    @pytest.fixture(autouse=True)
+    def reset_format():
+        yield
+        use_format('yaml')
+
+    def describe_document():
+        def test_as_dict():
+            document = formats.Document()
+            document.add('comment', '# x')
+            document.add('steps', None)
+            document.add('step', {'wait': None})
+            document.add('step', None)
+            document.add('env', {'A': '1'})
+            assert document.comments == ['# x']
+            assert document.as_dict() == {'env': {'A': '1'}, 'steps': [{'wait': None}]}
+
+        def test_fragments_match_yaml_batch():
+            document = formats.Document()
+            document.add('env', {'A': '1'})
+            document.add('steps', None)
+            document.add('step', {'wait': None})
+            assert YAML.document(document) == 'env:\n  A: \'1\'\n\nsteps:\n\n  - wait:\n\n'
+
+    def describe_json():
+        def test_batch(capsys):
+            out = batch(capsys, 'json')
+            assert json.loads(out) == json.loads(json.dumps(PIPELINE))
+            assert list(json.loads(out, object_pairs_hook=OrderedDict)) == ['env', 'steps']
+
+        def test_batch_env_after_steps(capsys):
+            with patch.object(sys, 'stdin', io.StringIO('wait\nenv --var A b\n')):
+                with pytest.raises(SystemExit):
+                    parse_main(['--format', 'json', 'batch'])
+            assert 'env has to come before the steps in json output' in capsys.readouterr().err
+
+        def test_comments_left_out(capsys):
+            with patch.object(sys, 'stdin', io.StringIO(BATCH)):
+                parse_main(['--format', 'json', 'batch'])
+            assert capsys.readouterr().err == \
+                'left out 1 comment(s), json output can not hold them\n'
+            formats.JsonFormat().document(formats.Document())
+            assert capsys.readouterr().err == ''
+
+        def test_single_subcommand(capsys):
+            for argv in [['comment', 'x'], ['steps'], ['wait']]:
+                with pytest.raises(SystemExit):
+                    parse_main(['--format', 'json'] + argv)
+                assert '--format json renders whole pipelines only, use it with batch.' \
+                    in capsys.readouterr().err
+
+    def describe_yaml_flow():
+        def test_batch(capsys):
+            assert batch(capsys, 'yaml-flow') == (
+                '# Pipeline\n'
+                '{env: {FORCE_COLOR: "1"}, steps: ['
+                '{label: ":karma: tests", command: yarn test}, '
+                '{wait: null, continue_on_failure: true}, '
+                '{plugins: {"org/upload#1.0.0": {dir: ./coverage}}}]}\n'
+            )
+
+        def test_comment_after_step(capsys):
+            with patch.object(sys, 'stdin', io.StringIO('wait\ncomment x\n')):
+                with pytest.raises(SystemExit):
+                    parse_main(['--format', 'yaml-flow', 'batch'])
+            out, err = capsys.readouterr()
+            assert out == ''
+            assert 'comments have to come first in yaml-flow output' in err
+
+        def test_quoting():
+            assert emitter.flow(['a b', 'a:b', 'x,y', '', '1', 'true', 'é', 'a\nb']) == \
+                '[a b, "a:b", "x,y", "", "1", "true", é, "a\\nb"]'
+
+        def test_loads_back():
+            yaml = pytest.importorskip('yaml')
+            data = {'k{': ['[', '#x', 'a #b', '- x', '? y', '*', 'null', '0x1f', '\t']}
+            assert yaml.safe_load(emitter.flow(data)) == data
+
+    def describe_yaml_c():
+        def test_batch(capsys):
+            yaml = pytest.importorskip('yaml')
+            if not hasattr(yaml, 'CSafeDumper'):
+                pytest.skip('PyYAML is not built with libyaml')
+            out = batch(capsys, 'yaml-c')
+            assert out.startswith('# Pipeline\nenv:\n  FORCE_COLOR: \'1\'\n\nsteps:\n\n')
+            assert yaml.safe_load(out) == yaml.safe_load(batch(capsys, 'yaml'))
+
+        def test_fallback():
+            with patch.dict(sys.modules, {'yaml': None}):
+                assert formats.CYamlFormat.load(fallback=YAML) is YAML
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=unused-variable
+# pylint: disable=missing-docstring
+
+import glob
+import os
+import random
+import pytest
+from bkyml import globbing
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+NAMES = ['a', 'b', '.h', 'test', 'x1', 'y_2']
+PATTERNS = ['*', '*/', 'a/*', '**', '**/', 'a/**', '**/b', '**/b/', 'a/**/x1', '**/x1/*',
+            '*/*/*', '.h/*', '**/.h', '[ab]/*', '?/x1/', 'a/b', 'a/b/', 'missing/*', '**/*.py']
+
+
+def random_tree(root, seed, size=300):
+    rng = random.Random(seed)
+    for _ in range(size):
+        path = os.path.join(root, *[rng.choice(NAMES) for _ in range(rng.randint(1, 4))])
+        try:
+            if rng.random() < 0.5:
+                os.makedirs(path, exist_ok=True)
+            elif not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                open(path + rng.choice(['', '.py']), 'w').close()
+        except OSError:
+            pass  # a file is in the way
+
+
+def describe_globbing():
+
+    @pytest.fixture
+    def tree(tmpdir, monkeypatch):
+        random_tree(str(tmpdir), seed=3)
+        monkeypatch.chdir(tmpdir)
+        return str(tmpdir)
+
+    def test_same_as_glob(tree):
+        for pattern in PATTERNS + [os.path.join(tree, 'a/*')]:
+            assert globbing.scan(pattern) == sorted(set(glob.glob(pattern, recursive=True))), \
+                pattern
+
+    def test_single_worker(tree):
+        assert globbing.scan('**/b', workers=1) == globbing.scan('**/b')
+
+    def test_symlinks_are_not_descended(tree):
+        os.symlink('a', 'link')
+        assert not [path for path in globbing.scan('**/b/') if path.startswith('link')]
+        assert globbing.scan('link/') == ['link/']
+
+    def test_scan_all():
+        assert globbing.scan_all(['setup.*', 'setup.py', 'src/']) == \
+            ['setup.cfg', 'setup.py', 'src/']
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=unused-variable
+# pylint: disable=missing-docstring
+
+import pytest
+from bkyml import graph
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+
+def step(key=None, depends_on=None, label=None):
+    found = {'command': 'x'}
+    if label is not None:
+        found['label'] = label
+    if key is not None:
+        found['key'] = key
+    if depends_on is not None:
+        found['depends_on'] = depends_on
+    return found
+
+
+def error(steps, known=()):
+    with pytest.raises(ValueError) as excinfo:
+        graph.validate(steps, known)
+    return str(excinfo.value)
+
+
+def describe_graph():
+
+    def test_dependencies():
+        assert graph.dependencies(None) == []
+        assert graph.dependencies('a') == ['a']
+        assert graph.dependencies(['a', {'step': 'b', 'allow_failure': True}]) == ['a', 'b']
+
+    def test_plain_steps_are_left_out():
+        assert graph.node(step()) is None
+        assert graph.node(step(label='Test')) is None
+        assert graph.node('wait') == ['wait', None, [], True]
+        assert graph.node({'block': 'Go', 'key': 'go'}) == ['key: go', 'go', [], True]
+        checked = graph.validate([step(), 'wait', step(), step('a'), step(depends_on='a')])
+        assert len(checked.names) == 3
+
+    def test_valid():
+        graph.validate([step('b', depends_on='a'), step('a'), 'wait',
+                        step(depends_on=['a', {'step': 'b'}])])
+        graph.validate([step(depends_on='earlier')], known=['earlier'])
+
+    def test_unknown_keys():
+        assert error([step(depends_on='a', label='Test')]) == \
+            "label: Test depends on the unknown key 'a'"
+        steps = [step(str(key), depends_on='missing-%d' % key) for key in range(5)]
+        assert error(steps) == (
+            "key: 0 depends on the unknown key 'missing-0'; "
+            "key: 1 depends on the unknown key 'missing-1'; "
+            "key: 2 depends on the unknown key 'missing-2' and 2 more")
+
+    def test_duplicate_keys():
+        assert error([step('a', label='One'), step('a', label='Two')]) == \
+            "more than one step has the key 'a'"
+        assert error([step('a')], known=['a']) == \
+            "the key 'a' is taken by a step uploaded before"
+
+    def test_cycles():
+        assert error([step('a', depends_on='a')]) == 'dependency cycle: key: a -> key: a'
+        assert error([step('a', depends_on='c'), step('b', depends_on='a'),
+                      step('c', depends_on='b')]) == \
+            'dependency cycle: key: a -> key: c -> key: b -> key: a'
+
+    def test_cycles_through_barriers():
+        # a runs before the wait, which b has to wait for
+        assert error([step('a', depends_on='b'), 'wait', step('b')]) == \
+            'dependency cycle: key: a -> key: b -> wait -> key: a'
+        assert error([step('a', depends_on='b'), {'block': 'Go'}, step(), 'wait',
+                      step('b')]) == \
+            'dependency cycle: key: a -> key: b -> wait -> block: Go -> key: a'
+        graph.validate([step('a'), 'wait', step('b', depends_on='a')])
+
+    def test_long_chains():
+        steps = [step(str(key), depends_on=str(key + 1)) for key in range(20000)]
+        assert "unknown key '20000'" in error(steps)
+        steps.append(step('20000', depends_on='0'))
+        assert error(steps).startswith('dependency cycle: key: 0 -> key: 1 -> ')
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=unused-variable
+# pylint: disable=missing-docstring
+
+from collections import OrderedDict
+from unittest.mock import patch
+import pytest
+from bkyml import formats, graph, incremental
+from bkyml.skeleton import YAML
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+STEPS = [
+    OrderedDict([('label', 'Tëst'), ('command', 'make test')]),
+    'wait',
+    OrderedDict([('label', 'Lint'), ('command', ['make lint', 'make check'])]),
+    OrderedDict([('trigger', 'deploy'), ('build', OrderedDict([('env', {'A': '1'})]))]),
+]
+
+
+def render(path, lines, previous=None, checked=None):
+    """Render ``lines`` of ``(argv, parts)`` like ``batch --incremental`` and return the Render"""
+    target = incremental.Render(YAML, previous or incremental.Previous(), checked)
+    for argv, parts in lines:
+        if target.splice_line(argv):
+            continue
+        target.begin_line(argv, True)
+        for kind, data in parts:
+            target.add(kind, data)
+        target.end_line()
+    target.save(path, 'format', 'options')
+    return target
+
+
+def load(path):
+    return incremental.Previous.load(path, 'format', 'options')
+
+
+def describe_incremental():
+
+    @pytest.fixture
+    def path(tmpdir):
+        return str(tmpdir.join('pipeline.yml'))
+
+    @pytest.fixture
+    def lines():
+        return [
+            (['comment', 'x'], [('comment', '# ü')]),
+            (['steps'], [('steps', None)]),
+        ] + [(['step', str(number)], [('step', step)]) for number, step in enumerate(STEPS)]
+
+    def test_no_previous(tmpdir):
+        assert incremental.Previous.load(str(tmpdir.join('missing')), 'f', 'o').text == ''
+
+    def test_splices_lines(path, lines):
+        first = render(path, lines)
+        assert (first.spliced, first.rendered) == (0, 6)
+        with open(path, encoding='utf-8') as stream:
+            expected = stream.read()
+        assert expected.startswith('# ü\nsteps:\n\n  - label: Tëst\n')
+        with patch.object(formats.FragmentWriter, 'add', side_effect=AssertionError):
+            second = render(path, lines[::-1], load(path))
+        assert (second.spliced, second.rendered) == (6, 0)
+        assert render(path, lines, load(path)).spliced == 6
+        with open(path, encoding='utf-8') as stream:
+            assert stream.read() == expected
+
+    def test_splices_parts(path, lines):
+        render(path, lines)
+        moved = [(['all'], [part for _, parts in lines for part in parts])]
+        target = render(path, moved, load(path))
+        assert (target.spliced, target.rendered) == (6, 0)
+        target = render(path, moved + [(['new'], [('step', 'wait'), ('step', {'label': 'x'})])],
+                        load(path))
+        assert (target.spliced, target.rendered) == (7, 1)
+
+    def test_graph_of_spliced_lines(path, lines):
+        lines.append((['depends'], [('step', {'command': 'x', 'depends_on': 'tests'})]))
+        lines.append((['key'], [('step', {'command': 'x', 'key': 'tests'})]))
+        first = render(path, lines, checked=graph.Graph())
+        with patch.object(formats.FragmentWriter, 'add', side_effect=AssertionError):
+            second = render(path, lines, load(path), graph.Graph())
+        assert second.rendered == 0
+        assert second.graph.names == first.graph.names == [
+            'wait', 'command: x', 'key: tests']
+        second.graph.validate()
+
+    def test_index_of_other_renders_is_ignored(path, lines):
+        render(path, lines)
+        assert incremental.Previous.load(path, 'other format', 'options').text == ''
+        previous = incremental.Previous.load(path, 'format', 'other options')
+        assert previous.text and not previous.lines
+        with open(path, 'a') as stream:
+            stream.write('\n')
+        assert load(path).text == ''
+
+    def describe_diff():
+        def test_same_hashes_with_and_without_index(path, lines):
+            render(path, lines)
+            indexed = incremental.steps(path)
+            assert [step for _, step in indexed][0] == '  - label: Tëst\n    command: make test\n\n'
+            with patch.object(incremental, 'INDEX_SUFFIX', '.missing'):
+                parsed = incremental.steps(path)
+            assert [key for key, _ in parsed] == [key for key, _ in indexed]
+            assert parsed[0][1] == STEPS[0]
+
+        def test_changes(path, lines, tmpdir):
+            render(path, lines)
+            new = str(tmpdir.join('new.yml'))
+            render(new, [(['steps'], [('steps', None), ('step', {'label': 'New'}),
+                                      ('step', STEPS[0]), ('step', 'wait'),
+                                      ('step', {'label': 'Lint', 'command': 'make lint'})])])
+            found, unchanged = incremental.diff(incremental.steps(path), incremental.steps(new))
+            assert found == [
+                ('+', 'label: New', []),
+                ('~', 'label: Lint', ['command']),
+                ('-', 'trigger: deploy', []),
+            ]
+            assert unchanged == 2
+
+        def test_duplicates_match_in_order():
+            old = [[incremental.part_hash('step', step), step] for step in ['wait', 'wait']]
+            found, unchanged = incremental.diff(old, old[:1])
+            assert (found, unchanged) == ([('-', 'wait', [])], 1)
+
+        def test_identity():
+            assert incremental.identity({'key': 'k', 'label': 'l'}) == 'key: k'
+            assert incremental.identity({'command': ['a', 'b']}) == 'command: ["a", "b"]'
+            assert incremental.identity({'wait': None, 'continue_on_failure': True}) == 'wait'
+            assert incremental.identity({'x': 1}) == '{"x": 1}'
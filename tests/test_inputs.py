@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=unused-variable
+# pylint: disable=missing-docstring
+
+import os
+from unittest.mock import patch
+import pytest
+from bkyml import inputs
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+
+def age(path, seconds=10):
+    """Move the modification time of ``path`` into the past, out of the racy window"""
+    mtime = os.stat(str(path)).st_mtime - seconds
+    os.utime(str(path), (mtime, mtime))
+
+
+def describe_inputs():
+
+    @pytest.fixture
+    def tree(tmpdir, monkeypatch):
+        for path in ['src/a.py', 'src/b.py', 'src/sub/c.py', 'README']:
+            tmpdir.join(path).write(path, ensure=True)
+            age(tmpdir.join(path))
+        monkeypatch.chdir(tmpdir)
+        monkeypatch.setattr(inputs.Cache, 'INDEXES', {})
+        return tmpdir
+
+    def test_expand(tree):
+        assert inputs.expand(['src', 'README', 'missing']) == \
+            ['README', 'src/', 'src/a.py', 'src/b.py', 'src/sub', 'src/sub/c.py']
+
+    def describe_index():
+        def test_digests(tree):
+            index = inputs.Index('index.json')
+            assert index.digests(['src/a.py', 'src/sub', 'missing']) == \
+                [('src/a.py', inputs.file_digest('src/a.py'))]
+
+        def test_incremental(tree):
+            paths = inputs.expand(['src'])
+            index = inputs.Index('cache/index.json')
+            expected = index.digests(paths)
+            index.save()
+            with patch.object(inputs, 'file_digest', side_effect=AssertionError):
+                assert inputs.Index('cache/index.json').digests(paths) == expected
+            tree.join('src/b.py').write('changed')
+            age(tree.join('src/b.py'))
+            index = inputs.Index('cache/index.json')
+            with patch.object(inputs, 'file_digest', wraps=inputs.file_digest) as digest:
+                index.digests(paths)
+            assert [call[0][0] for call in digest.call_args_list] == \
+                [str(tree.join('src/b.py'))]
+
+        def test_racy(tree):
+            tree.join('src/a.py').write('new')
+            index = inputs.Index('index.json')
+            index.digests(['src/a.py'])
+            index.save()
+            # modified after the index was started, so within its timestamp
+            tree.join('src/a.py').write('old')
+            os.utime('src/a.py', ns=(index.started, index.started))
+            assert inputs.Index('index.json').digests(['src/a.py']) == \
+                [('src/a.py', inputs.file_digest('src/a.py'))]
+
+        def test_broken(tree):
+            tree.join('index.json').write('{')
+            assert inputs.Index('index.json').files == {}
+
+    def describe_cache():
+        def test_hash(tree):
+            cache = inputs.Cache('cache')
+            digest = cache.hash(['src/**/*.py'], {'command': 'test'})
+            assert inputs.HASH.match(digest)
+            assert cache.hash(['src'], {'command': 'test'}) == digest
+            assert cache.hash(['src'], {'command': 'lint'}) != digest
+            assert cache.hash(['src/*.py'], {'command': 'test'}) != digest
+            tree.join('src/a.py').write('changed')
+            assert cache.hash(['src'], {'command': 'test'}) != digest
+
+        def test_record(tree):
+            cache = inputs.Cache('cache')
+            digest = cache.hash(['src'])
+            assert not cache.passed(digest)
+            cache.record(digest)
+            assert cache.passed(digest)
+            assert inputs.Cache('cache').passed(digest)
+
+        def test_default_directory(tree, monkeypatch):
+            monkeypatch.setenv(inputs.CACHE_DIR_ENV, 'elsewhere')
+            assert inputs.Cache().directory == 'elsewhere'
+            monkeypatch.delenv(inputs.CACHE_DIR_ENV)
+            assert inputs.Cache().directory == inputs.DEFAULT_CACHE_DIR
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=unused-variable
+# pylint: disable=missing-docstring
+
+import io
+from collections import OrderedDict
+import pytest
+from bkyml import local
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+
+def step(label, command, **extra):
+    found = OrderedDict([('label', label)])
+    found.update(extra)
+    found['command'] = command
+    return found
+
+
+def run(steps, env=None, jobs=2):
+    """The outcome of every step and the lines written, in order per job"""
+    output = io.StringIO()
+    runner = local.Runner(steps, env, jobs, '/bin/sh -e -c', output)
+    results = runner.run()
+    return [result.outcome for result in results], output.getvalue().splitlines()
+
+
+def lines_of(lines, prefix):
+    return [line[len(prefix) + 3:] for line in lines if line.startswith('[%s] ' % prefix)]
+
+
+def describe_local():
+
+    def test_env_and_parallelism():
+        steps = [step('a', ['echo "$A $B $BUILDKITE_LABEL"', 'echo "$BUILDKITE_STEP_KEY"'],
+                      key='k', env={'B': 2}),
+                 step('b', 'echo "$BUILDKITE_PARALLEL_JOB/$BUILDKITE_PARALLEL_JOB_COUNT"',
+                      parallelism=2)]
+        outcomes, lines = run(steps, {'A': 'one', 'B': 'one'})
+        assert outcomes == [local.PASSED, local.PASSED]
+        assert lines_of(lines, 'a') == ['started', 'one 2 a', 'k', 'passed']
+        assert lines_of(lines, 'b #0') == ['started', '0/2', 'passed']
+        assert lines_of(lines, 'b #1') == ['started', '1/2', 'passed']
+
+    def test_order():
+        steps = [step('a', 'echo a', key='a'), step('b', 'echo b', depends_on='a'),
+                 'wait', step('c', 'echo c')]
+        outcomes, lines = run(steps, jobs=4)
+        assert outcomes == [local.PASSED] * 4
+        started = [line for line in lines if line.endswith('] started')]
+        assert started == ['[a] started', '[b] started', '[c] started']
+
+    def test_failures():
+        steps = [step('a', 'exit 1', key='a'), step('b', 'exit 2', soft_fail=True),
+                 step('c', 'echo c', depends_on='a'),
+                 step('d', 'echo d', depends_on=[{'step': 'a', 'allow_failure': True}]),
+                 'wait', step('e', 'echo e'),
+                 {'wait': None, 'continue_on_failure': True}, step('f', 'echo f')]
+        outcomes, lines = run(steps)
+        assert outcomes == [local.FAILED, local.SOFT_FAILED, local.NOT_RUN, local.PASSED,
+                            local.NOT_RUN, local.NOT_RUN, local.NOT_RUN, local.NOT_RUN]
+        assert '[a] exited with status 1' in lines
+        steps[4] = {'wait': None, 'continue_on_failure': True}
+        outcomes, _ = run(steps)
+        assert outcomes[4:] == [local.PASSED] * 4
+
+    def test_retries():
+        steps = [step('a', 'exit $((3 - BUILDKITE_RETRY_COUNT))',
+                      retry={'automatic': [{'exit_status': 2, 'limit': 1},
+                                           {'exit_status': 3, 'limit': 1}]}),
+                 step('b', 'exit 4', retry={'automatic': {'exit_status': [1, 2], 'limit': 3}})]
+        outcomes, lines = run(steps)
+        assert outcomes == [local.FAILED, local.FAILED]
+        assert lines_of(lines, 'a') == ['started', 'exited with status 3', 'retry 1 started',
+                                        'exited with status 2']
+        assert lines_of(lines, 'b') == ['started', 'exited with status 4']
+        outcomes, _ = run([step('a', 'test "$BUILDKITE_RETRY_COUNT" = 2',
+                                retry={'automatic': True})])
+        assert outcomes == [local.PASSED]
+
+    def test_timeout():
+        outcomes, lines = run([step('a', 'sleep 10', timeout_in_minutes=0.001)])
+        assert outcomes == [local.FAILED]
+        assert lines_of(lines, 'a')[1:] == ['timed out after 0.001 minutes',
+                                            'exited with status -1']
+
+    def test_timeout_while_others_finish():
+        steps = [step('a', 'sleep 10', timeout_in_minutes=0.001),
+                 step('b', 'sleep 0.02', parallelism=20)]
+        output = io.StringIO()
+        runner = local.Runner(steps, None, 2, '/bin/sh -e -c', output)
+        get = runner.finished.get
+        # a queue that is never found empty while jobs keep finishing
+        runner.finished.get = lambda timeout=None: get(timeout=5)
+        assert [result.outcome for result in runner.run()] == [local.FAILED, local.PASSED]
+        lines = output.getvalue().splitlines()
+        assert lines.index('[a] timed out after 0.001 minutes') < lines.index('[b #19] passed')
+
+    def test_concurrency():
+        steps = [step(name, 'echo {name}; sleep 0.1; echo {name}'.format(name=name),
+                      concurrency_group='deploy', concurrency=1) for name in 'ab']
+        outcomes, lines = run(steps)
+        assert outcomes == [local.PASSED] * 2
+        assert [line for line in lines if not line.endswith(('started', 'passed'))] == \
+            ['[a] a', '[a] a', '[b] b', '[b] b']
+
+    def test_skipped():
+        steps = [{'trigger': 'deploy'}, {'block': 'Release'}, {'plugins': {'docker': None}},
+                 step('a', 'echo a', skip=True), step('b', 'echo b')]
+        outcomes, lines = run(steps)
+        assert outcomes == [local.SKIPPED, local.PASSED, local.SKIPPED, local.SKIPPED,
+                            local.PASSED]
+        assert lines[:2] == ['[deploy] skipped, not run locally',
+                             '[{"plugins": {"docker": null}}] skipped, not run locally']
+
+    def test_invalid():
+        with pytest.raises(ValueError):
+            local.Runner([step('a', 'true', depends_on='x')])
+
+    def test_summary():
+        steps = [step('a', 'exit 1'), 'wait', step('b', 'true'), {'trigger': 'x'}]
+        results = local.Runner(steps, shell='/bin/sh -e -c', output=io.StringIO()).run()
+        lines = local.summary(steps, results, 1.25).splitlines()
+        assert lines[0].startswith('failed ') and lines[0].endswith('label: a (exit status 1)')
+        assert lines[1].startswith('not run ') and lines[2].endswith('trigger: x')
+        assert lines[3] == '0 passed, 0 soft failed, 1 failed, 2 not run in 1.2s'
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=unused-variable
+# pylint: disable=missing-docstring
+
+import os
+import sys
+import pytest
+from bkyml import outputs
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+
+def describe_outputs():
+
+    def test_key():
+        assert outputs.key('yaml', [['wait']]) == outputs.key('yaml', [['wait']])
+        assert outputs.key('yaml', [['wait']]) != outputs.key('json', [['wait']])
+        assert outputs.key('yaml', [['wait']]) != outputs.key('yaml', [['wait', '-c']])
+
+    def test_key_covers_versions(monkeypatch):
+        before = outputs.key('yaml')
+        monkeypatch.setattr(outputs, 'versions', lambda: ['other'])
+        assert outputs.key('yaml') != before
+
+    def test_key_covers_sources(monkeypatch):
+        outputs.versions.cache_clear()
+        before = outputs.key('yaml')
+        monkeypatch.setattr(outputs, 'sources', lambda: 'edited')
+        outputs.versions.cache_clear()
+        try:
+            assert outputs.key('yaml') != before
+        finally:
+            outputs.versions.cache_clear()
+
+    def test_pack():
+        assert outputs.unpack(outputs.pack(b'steps:\n', b'pruned\n')) == (b'steps:\n', b'pruned\n')
+        assert outputs.unpack(outputs.pack(b'1\n2')) == (b'1\n2', b'')
+
+    def test_recorded(capsys):
+        def render():
+            sys.stderr.write('pruned\n')
+            return 'steps:'
+        assert outputs.recorded(render) == ('steps:', 'pruned\n')
+        assert capsys.readouterr().err == 'pruned\n'
+
+    def describe_output_cache():
+        @pytest.fixture
+        def cache(tmpdir):
+            return outputs.OutputCache(str(tmpdir), max_bytes=10)
+
+        def test_miss_and_hit(cache):
+            assert cache.get('a') is None
+            cache.put('a', b'abc')
+            assert cache.get('a') == b'abc'
+
+        def test_evicts_least_recently_used(cache):
+            for index, digest in enumerate('ab'):
+                cache.put(digest, b'1234')
+                os.utime(cache.path(digest), ns=(index * 10 ** 9, index * 10 ** 9))
+            assert cache.get('a') == b'1234'
+            cache.put('c', b'1234')
+            assert sorted(os.listdir(cache.directory)) == ['a', 'c']
+
+        def test_too_large(cache):
+            cache.put('a', b'x' * 11)
+            assert cache.get('a') is None
+
+        def test_default_directory(tmpdir, monkeypatch):
+            monkeypatch.setenv('BKYML_CACHE_DIR', str(tmpdir))
+            assert outputs.OutputCache().directory == str(tmpdir.join('outputs'))
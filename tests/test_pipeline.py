@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=unused-variable
+# pylint: disable=missing-docstring
+
+import argparse
+import io
+import json
+import shlex
+from unittest.mock import patch
+import pytest
+import bkyml
+from bkyml.outputs import OutputCache
+from bkyml.pipeline import Pipeline, PipelineWriter
+from bkyml.skeleton import YAML, parse_main
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+
+def cli(lines):
+    return ''.join(parse_main(shlex.split(line)) + '\n' for line in lines)
+
+
+def build(pipeline):
+    pipeline.comment('big').env({'A': '1'})
+    for index in range(3):
+        pipeline.command('run %d' % index)
+    pipeline.wait()
+    return pipeline
+
+
+def describe_pipeline():
+
+    @pytest.fixture
+    def pipeline():
+        return Pipeline() \
+            .comment('Pipeline for running all tests') \
+            .env({'FORCE_COLOR': '1'}) \
+            .command(['yarn install', 'yarn test'], label=':karma: tests',
+                     env={'A': 'b'}, branches='master', parallelism=2,
+                     retry='automatic', retry_automatic_tuple=[['*', 2]],
+                     plugins={'docker#v1.0.0': {'image': 'node'}}) \
+            .wait(continue_on_failure=True) \
+            .plugin({'org/upload-coverage#1.0.0': {'dir': './coverage'}}, name='upload') \
+            .trigger('my-pipeline', is_async=True, build_env={'a': 'b'}) \
+            .block(':rocket: Release', prompt='Sure?',
+                   text_fields=[('notes', 'Notes', 'Hint', False, 'none')],
+                   select_fields=[('type', 'Type', None, True, 'a', {'a': 'A', 'b': 'B'})])
+
+    def test_lazy_export():
+        assert bkyml.Pipeline is Pipeline
+
+    def test_same_as_cli(pipeline):
+        assert len(pipeline) == 5
+        assert pipeline.dump() == cli([
+            "comment 'Pipeline for running all tests'",
+            'env --var FORCE_COLOR 1',
+            'steps',
+            "command --command 'yarn install' 'yarn test' --label ':karma: tests' "
+            '--env A b --branches master --parallelism 2 '
+            "--retry automatic --retry-automatic-tuple '*' 2 "
+            "--plugin 'docker#v1.0.0' image=node",
+            'wait --continue-on-failure',
+            "plugin --name upload --plugin 'org/upload-coverage#1.0.0' dir=./coverage",
+            'trigger my-pipeline --async --build-env a b',
+            "block ':rocket: Release' --prompt 'Sure?' "
+            '--field-text notes Notes Hint false none '
+            '--field-select type Type "" true a a=A b=B',
+        ])
+
+    def test_fast_and_ruamel_agree(pipeline):
+        pipeline.command('echo "multi\nline"', label="it's")
+        fast = pipeline.dump()
+        YAML.fast = False
+        try:
+            assert pipeline.dump() == fast
+        finally:
+            YAML.fast = True
+
+    def test_matrix():
+        pipeline = Pipeline().command('tox -e {py}', matrix={'py': ['py36', 'py37'], 'os': 'x'},
+                                      matrix_exclude=[{'py': 'py36'}])
+        assert pipeline.dump() == 'steps:\n\n  - command: tox -e py37\n\n'
+        pipeline = Pipeline().command('run {os}', env={'OS': '{os}'}, agents={'queue': '{os}'},
+                                      plugins={'docker': {'image': 'build:{os}'}},
+                                      matrix={'os': ['linux', 'mac']})
+        assert pipeline.dump() == Pipeline() \
+            .command('run linux', env={'OS': 'linux'}, agents={'queue': 'linux'},
+                     plugins={'docker': {'image': 'build:linux'}}) \
+            .command('run mac', env={'OS': 'mac'}, agents={'queue': 'mac'},
+                     plugins={'docker': {'image': 'build:mac'}}).dump()
+
+    def test_for_each_glob():
+        pipeline = Pipeline().command('check {path}', for_each_glob='setup.*')
+        assert pipeline.dump() == \
+            'steps:\n\n  - command: check setup.cfg\n\n  - command: check setup.py\n\n'
+
+    def test_watch(capsys):
+        pipeline = Pipeline(changed_files=['src/a.py']) \
+            .command('lint', watch='src/*.py').command('docs', watch=['docs', 'README.rst'])
+        assert pipeline.dump() == 'steps:\n\n  - command: lint\n\n'
+        assert capsys.readouterr().err.startswith("pruned step 'docs': ")
+
+    def test_branch(capsys):
+        pipeline = Pipeline(branch='feature/x').command('test').wait() \
+            .command('deploy', branches='master').block('Release', branches=['master'])
+        assert pipeline.dump() == 'steps:\n\n  - command: test\n\n  - wait\n\n'
+        assert len(capsys.readouterr().err.splitlines()) == 2
+
+    def test_cache_inputs(tmpdir):
+        pipeline = Pipeline().command('check', cache_inputs=['setup.py', 'setup.cfg'],
+                                      cache_dir=str(tmpdir))
+        assert 'BKYML_INPUTS_HASH: ' in pipeline.dump()
+
+    def test_cache(pipeline, tmpdir):
+        cache = OutputCache(str(tmpdir))
+        expected = pipeline.dump()
+        assert pipeline.dump(cache=cache) == expected
+        with patch.object(YAML, 'document', side_effect=AssertionError):
+            assert pipeline.dump(cache=cache) == expected
+        assert pipeline.dump('json', cache=cache) == pipeline.dump('json')
+        assert len(tmpdir.join('outputs').listdir()) == 2
+
+    def test_anchors():
+        def docker(pipeline):
+            for index in range(3):
+                pipeline.command('test %d' % index, env={'A': '1'}, agents={'queue': 'q'},
+                                 plugins={'docker#v1': {'image': 'x'}})
+            return pipeline
+
+        anchored = docker(Pipeline(anchors=True))
+        steps = anchored.document.steps
+        assert steps[0]['env'] is steps[2]['env']
+        assert steps[0]['plugins']['docker#v1'] is steps[1]['plugins']['docker#v1']
+        output = anchored.dump()
+        assert output.count('*env1') == 2
+        assert output == anchored.dump()
+        assert json.loads(json.dumps(YAML.yaml.load(output))) == \
+            json.loads(docker(Pipeline()).dump('json'))
+        stream = io.StringIO()
+        with PipelineWriter(stream, anchors=True) as writer:
+            docker(writer)
+        assert stream.getvalue() == output
+        with pytest.raises(ValueError):
+            anchored.dump('json')
+
+    def test_dependencies():
+        pipeline = Pipeline() \
+            .command('make', key='build') \
+            .trigger('deploy', key='deploy', depends_on='build') \
+            .block('Go', key='go', depends_on=['build', 'deploy'])
+        assert pipeline.dump() == (
+            'steps:\n'
+            '\n'
+            '  - key: build\n'
+            '    command: make\n'
+            '\n'
+            '  - trigger: deploy\n'
+            '    key: deploy\n'
+            '    depends_on: build\n'
+            '\n'
+            '  - block: Go\n'
+            '    key: go\n'
+            '    depends_on:\n'
+            '      - build\n'
+            '      - deploy\n'
+            '\n')
+        pipeline.wait().command('test', depends_on='go', key='build')
+        with pytest.raises(ValueError) as excinfo:
+            pipeline.dump()
+        assert "more than one step has the key 'build'" in str(excinfo.value)
+        with pytest.raises(ValueError) as excinfo:
+            Pipeline().command('test', depends_on='build').dump()
+        assert "depends on the unknown key 'build'" in str(excinfo.value)
+
+    def test_eliminate_waits():
+        pipeline = Pipeline(anchors=True) \
+            .command('make', artifact_paths='dist/*', env={'A': 'b'}) \
+            .wait() \
+            .command('test', needs_artifact='dist/app.whl', env={'A': 'b'}) \
+            .command('lint', needs_artifact=[]) \
+            .wait() \
+            .command('deploy')
+        assert pipeline.eliminate_waits() == 1
+        assert len(pipeline) == 5
+        assert pipeline.dump() == (
+            'steps:\n'
+            '\n'
+            '  - key: step-1\n'
+            '    command: make\n'
+            '    env: &env1\n'
+            '      A: b\n'
+            '    artifact_paths: dist/*\n'
+            '\n'
+            '  - depends_on: step-1\n'
+            '    command: test\n'
+            '    env: *env1\n'
+            '\n'
+            '  - command: lint\n'
+            '\n'
+            '  - wait\n'
+            '\n'
+            '  - command: deploy\n'
+            '\n')
+        with pytest.raises(TypeError):
+            with PipelineWriter(io.StringIO()) as writer:
+                writer.eliminate_waits()
+
+    def test_prioritize():
+        pipeline = Pipeline() \
+            .command('make', key='make', estimate=60) \
+            .command('lint', estimate=10) \
+            .command('docs') \
+            .wait() \
+            .command('test', estimate=300, needs_artifact=[]) \
+            .command('deploy', depends_on='make')
+        analysis = pipeline.critical_path({'command: deploy': 5}, default_duration=1)
+        assert analysis.duration == 360
+        assert pipeline.prioritize({'command: deploy': 5}, 1).path == analysis.path == [0, 3, 4]
+        assert pipeline.needs == [None, None, None, None, [], None]
+        assert pipeline.dump() == (
+            'steps:\n'
+            '\n'
+            '  - key: make\n'
+            '    command: make\n'
+            '    priority: 1\n'
+            '\n'
+            '  - command: lint\n'
+            '\n'
+            '  - command: docs\n'
+            '\n'
+            '  - wait\n'
+            '\n'
+            '  - command: test\n'
+            '    priority: 1\n'
+            '\n'
+            '  - depends_on: make\n'
+            '    command: deploy\n'
+            '\n')
+        with pytest.raises(TypeError):
+            with PipelineWriter(io.StringIO()) as writer:
+                writer.prioritize()
+
+    def test_simulate():
+        pipeline = Pipeline() \
+            .command('make', estimate=60, parallelism=2) \
+            .command('lint', agents={'queue': 'small'}) \
+            .wait() \
+            .command('test', estimate=30)
+        result = pipeline.simulate({'default': 1, 'small': 1}, {'command: lint': 10})
+        assert result.duration == 150
+        assert result.queues['small'].busy == 10
+        with pytest.raises(TypeError):
+            with PipelineWriter(io.StringIO()) as writer:
+                writer.simulate({'default': 1})
+
+    def test_steps_only():
+        assert Pipeline().steps().dump() == 'steps:\n\n'
+        assert Pipeline().dump() == ''
+
+    def test_json(pipeline):
+        data = json.loads(pipeline.dump('json'))
+        assert data['env'] == {'FORCE_COLOR': '1'}
+        assert data['steps'][1] == {'wait': None, 'continue_on_failure': True}
+
+    def test_write(pipeline):
+        stream = io.StringIO()
+        pipeline.write(stream)
+        assert stream.getvalue() == pipeline.dump()
+
+    def test_unknown_options():
+        with pytest.raises(TypeError) as excinfo:
+            Pipeline().command('x', lable='y', paralelism=3)
+        assert "unexpected keyword argument 'lable'" in str(excinfo.value)
+        with pytest.raises(TypeError):
+            Pipeline().trigger('x', build_enx={'a': 'b'})
+        Pipeline().command('x', plugins={'p': None}, matrix={'a': '1'}, retry='manual')
+
+    def test_invalid_options():
+        with pytest.raises(argparse.ArgumentTypeError) as excinfo:
+            Pipeline().command('yarn test', retry_manual_reason='flaky')
+        assert '--retry-manual-reason requires --retry manual.' in str(excinfo.value)
+
+
+def describe_pipeline_writer():
+
+    @pytest.mark.parametrize('fmt', ['yaml', 'yaml-c', 'json', 'yaml-flow'])
+    def test_same_as_dump(fmt):
+        if fmt == 'yaml-c':
+            pytest.importorskip('yaml')
+        stream = io.StringIO()
+        with PipelineWriter(stream, fmt=fmt) as writer:
+            build(writer)
+            assert len(writer) == 4
+        assert stream.getvalue() == build(Pipeline()).dump(fmt)
+
+    def test_streams(tmpdir):
+        path = str(tmpdir.join('pipeline.yml'))
+        with PipelineWriter(path, flush_every=1) as writer:
+            writer.command('yarn test')
+            with open(path) as written:
+                assert written.read() == 'steps:\n\n  - command: yarn test\n\n'
+        assert bkyml.PipelineWriter is PipelineWriter
+
+    def test_empty_json():
+        stream = io.StringIO()
+        with PipelineWriter(stream, fmt='json'):
+            pass
+        assert stream.getvalue() == '{}\n'
+
+    def test_env_after_steps():
+        with pytest.raises(ValueError):
+            with PipelineWriter(io.StringIO(), fmt='json') as writer:
+                writer.wait().env({'A': '1'})
+
+    def test_dependencies():
+        with pytest.raises(ValueError) as excinfo:
+            with PipelineWriter(io.StringIO()) as writer:
+                writer.command('a', key='a', depends_on='b').wait().command('b', key='b')
+        assert 'dependency cycle: ' in str(excinfo.value)
+
+    def test_needs_context():
+        with pytest.raises(RuntimeError):
+            PipelineWriter(io.StringIO()).wait()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=unused-variable
+# pylint: disable=missing-docstring
+
+import io
+import random
+import heapq
+import sys
+from types import SimpleNamespace
+from unittest.mock import patch
+import pytest
+from bkyml import sharding
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+
+def describe_sharding():
+
+    def describe_load_timings():
+        def test_tab_separated():
+            assert sharding.load_timings(io.StringIO('# comment\na b.py\t1.5\n\nc.py\t2\n')) == \
+                {'a b.py': 1.5, 'c.py': 2.0}
+
+        def test_json():
+            assert sharding.load_timings(io.StringIO('{"a.py": 3}')) == {'a.py': 3.0}
+
+        def test_invalid():
+            for line in ['a.py', 'a.py\tslow', '\t1']:
+                with pytest.raises(ValueError) as excinfo:
+                    sharding.load_timings(io.StringIO('x.py\t1\n' + line))
+                assert str(excinfo.value).startswith('timings line 2: ')
+
+    def describe_parse_timings():
+        def test_bytes():
+            assert sharding.parse_timings(b'a.py\t1\r\n# b.py\t2\n \nc\td.py\t3') == \
+                {b'a.py': 1.0, b'c\td.py': 3.0}
+
+        def test_invalid():
+            with pytest.raises(ValueError) as excinfo:
+                sharding.parse_timings(b'a.py\t1\n\nb.py 2\n')
+            assert str(excinfo.value) == \
+                "timings line 3: expected PATH<TAB>SECONDS, got 'b.py 2'"
+
+    def describe_read_lines():
+        def test_file(tmpdir):
+            tmpdir.join('tests.txt').write_binary(b'a.py\r\n\n  b.py\n')
+            assert sharding.read_lines(str(tmpdir.join('tests.txt'))) == [b'a.py', b'b.py']
+
+        def test_empty_file(tmpdir):
+            tmpdir.join('tests.txt').write('')
+            assert sharding.read_lines(str(tmpdir.join('tests.txt'))) == []
+
+        def test_stdin():
+            with patch.object(sys, 'stdin', io.StringIO('a.py\nb.py\n')):
+                assert sharding.read_lines('-') == [b'a.py', b'b.py']
+
+    def test_read_paths():
+        assert sharding.read_paths(io.StringIO('b.py\n\na.py\n b.py \n')) == ['b.py', 'a.py']
+
+    def describe_estimate():
+        def test_known_and_size(tmpdir):
+            tmpdir.join('known.py').write('x' * 2048)
+            tmpdir.join('new.py').write('x' * 1024)
+            paths = [str(tmpdir.join(name)) for name in ('known.py', 'new.py', 'gone.py')]
+            assert sharding.estimate(paths, {paths[0]: 10.0}) == [10.0, 5.0, 0.0]
+            assert sharding.estimate(paths, {paths[0]: 10.0}, seconds_per_kb=2) == \
+                [10.0, 2.0, 0.0]
+            assert sharding.estimate(paths[1:], {}) == [sharding.DEFAULT_SECONDS_PER_KB, 0.0]
+
+    def test_shard_count():
+        assert sharding.shard_count([1, 2], shards=5) == 5
+        assert sharding.shard_count([10, 20, 15], target_duration=10) == 5
+        assert sharding.shard_count([], target_duration=10) == 1
+
+    def describe_partition():
+        def test_longest_first():
+            paths = ['a', 'b', 'c', 'd', 'e']
+            shards, loads = sharding.partition(paths, [7, 5, 4, 3, 3], 2)
+            assert shards == [['a', 'd'], ['b', 'c', 'e']]
+            assert loads == [10, 12]
+
+        def test_empty_shards_are_dropped():
+            assert sharding.partition(['a'], [1], 3) == ([['a']], [1])
+
+        def test_independent_of_order():
+            rng = random.Random(7)
+            paths = ['t%d' % index for index in range(500)]
+            durations = {path: float(rng.randint(1, 5)) for path in paths}
+            expected = sharding.partition(paths, [durations[path] for path in paths], 7)
+            rng.shuffle(paths)
+            assert sharding.partition(paths, [durations[path] for path in paths], 7) == expected
+
+        def test_balanced():
+            rng = random.Random(3)
+            durations = [rng.expovariate(0.1) for _ in range(10000)]
+            _, loads = sharding.partition([str(index) for index in range(10000)], durations, 20)
+            assert max(loads) - min(loads) <= max(durations)
+
+        def test_one_heap_operation_per_file(monkeypatch):
+            paths = ['tests/test_%d.py' % index for index in range(100000)]
+            durations = [float(index % 977) for index in range(100000)]
+            calls = []
+
+            def heapreplace(heap, item):
+                calls.append(len(heap))
+                return heapq.heapreplace(heap, item)
+
+            monkeypatch.setattr(sharding, 'heapq', SimpleNamespace(heapreplace=heapreplace))
+            sharding.partition(paths, durations, 50)
+            # every file goes to the least loaded of the 50 shards in log(50) steps
+            assert calls == [50] * 100000
+
+    def describe_select():
+        @pytest.fixture
+        def tests():
+            rng = random.Random(5)
+            paths = [('t%d' % index).encode() for index in range(1000)]
+            timings = {path: float(rng.randint(1, 60)) for path in paths[::2]}
+            return paths, timings
+
+        def test_jobs_cover_every_path_once(tests):
+            paths, timings = tests
+            jobs = [sharding.select(paths, timings, index, 7) for index in range(7)]
+            assert sorted(path for job in jobs for path in job) == sorted(paths)
+
+        def test_same_shards_as_partition(tests):
+            paths, timings = tests
+            default = sum(timings.values()) / len(timings)
+            names = [path.decode() for path in paths]
+            shards, _ = sharding.partition(
+                names, [timings.get(path, default) for path in paths], 7)
+            jobs = [[path.decode() for path in sharding.select(paths, timings, index, 7)]
+                    for index in range(7)]
+            assert sorted(jobs) == sorted(shards)
+
+        def test_independent_of_order(tests):
+            paths, timings = tests
+            expected = sharding.select(paths, timings, 3, 7)
+            random.Random(1).shuffle(paths)
+            assert sharding.select(paths, timings, 3, 7) == expected
+
+        def test_without_timings():
+            assert sharding.select([b'b', b'a', b'c'], {}, 0, 2) == [b'a', b'c']
+            assert sharding.select([b'b', b'a', b'c'], {}, 1, 2) == [b'b']
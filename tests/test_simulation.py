@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=unused-variable
+# pylint: disable=missing-docstring
+
+import json
+from collections import OrderedDict
+import pytest
+from bkyml import critical, simulation
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+
+def step(label, **extra):
+    found = OrderedDict([('label', label)])
+    found.update(extra)
+    found['command'] = label
+    return found
+
+
+def simulate(steps, seconds, agents, **options):
+    """The simulation of ``steps`` taking ``seconds`` by label"""
+    durations, _, _ = critical.durations(steps, seconds, default=1)
+    return simulation.Simulation(steps, durations, agents, **options)
+
+
+def describe_simulation():
+
+    def test_agents():
+        steps = [step('a'), step('b'), step('c'), 'wait', step('d')]
+        seconds = {'a': 10, 'b': 10, 'c': 10, 'd': 5}
+        assert simulate(steps, seconds, {'default': 3}).duration == 15
+        result = simulate(steps, seconds, {'default': 2})
+        assert result.duration == 25
+        found = result.queues['default']
+        assert (found.jobs, found.busy, found.waited, found.longest_wait) == (4, 35, 10, 10)
+        assert found.utilization(result.duration) == 35 / 50
+        assert found.mean_wait() == 2.5
+
+    def test_queues():
+        steps = [step('a', agents={'queue': 'big'}), step('b', agents=['queue=big', 'os=linux']),
+                 step('c'), {'trigger': 'docs'}, {'block': 'Release'}, step('d')]
+        result = simulate(steps, {'a': 4, 'b': 4, 'c': 1, 'docs': 20, 'd': 1},
+                          OrderedDict([('default', 1), ('big', 1)]))
+        assert result.duration == 21
+        assert [(name, found.jobs) for name, found in result.queues.items()] == [
+            ('default', 2), ('big', 2)]
+        with pytest.raises(ValueError, match="label: a runs on the queue 'big'"):
+            simulate(steps, {}, {'default': 1})
+
+    def test_parallelism_and_dependencies():
+        steps = [step('a', key='a'), step('b', parallelism=4), step('c', depends_on='a')]
+        result = simulate(steps, {'a': 1, 'b': 3, 'c': 5}, {'default': 2})
+        # c queues behind the jobs of b created before it
+        assert result.queues['default'].jobs == 6
+        assert result.duration == 11
+        assert simulate(steps, {'a': 1, 'b': 3, 'c': 5}, {'default': 5}).duration == 6
+
+    def test_priority():
+        steps = [step('a'), step('b'), step('c', priority=1)]
+        result = simulate(steps, {'a': 1, 'b': 2, 'c': 4}, {'default': 1})
+        assert result.duration == 7
+        assert result.queues['default'].waited == 4 + 5
+
+    def test_concurrency():
+        steps = [step('a', concurrency_group='deploy', concurrency=1),
+                 step('b', concurrency_group='deploy', concurrency=1), step('c')]
+        result = simulate(steps, {'a': 2, 'b': 2, 'c': 2}, {'default': 3})
+        assert result.duration == 4
+        assert result.queues['default'].longest_wait == 2
+
+    def test_retries():
+        steps = [step('a', retry={'automatic': [{'exit_status': 1, 'limit': 3}]}),
+                 step('b', retry={'automatic': True}), step('c')]
+        result = simulate(steps, {}, {'default': 1}, failure_rate=0.999)
+        assert (result.retries, result.failed) == (5, 3)
+        assert result.queues['default'].jobs == 8
+        # the same seed, the same failures
+        first, second = [simulate(steps, {}, {'default': 1}, failure_rate=0.5, seed=3)
+                         for _ in range(2)]
+        assert (first.retries, first.failed, first.duration) == \
+            (second.retries, second.failed, second.duration)
+
+    def test_retry_limit():
+        assert simulation.retry_limit({}) == 0
+        assert simulation.retry_limit({'retry': {'manual': False}}) == 0
+        assert simulation.retry_limit({'retry': {'automatic': True}}) == 2
+        assert simulation.retry_limit({'retry': {'automatic': {'exit_status': '*'}}}) == 2
+        assert simulation.retry_limit({'retry': {'automatic': [{'limit': 1}, {'limit': 4}]}}) == 4
+
+    def test_empty():
+        assert simulate([], {}, {}).duration == 0
+        assert simulate(['wait'], {}, {}).duration == 0
+
+    def test_load(tmpdir):
+        path = tmpdir.join('pipeline.yml')
+        path.write('env:\n  A: b\n\nsteps:\n  - command: a\n  - wait\n')
+        assert simulation.load(str(path)) == [{'command': 'a'}, 'wait']
+        path.write(json.dumps({'steps': [{'command': 'a'}]}))
+        assert simulation.load(str(path)) == [{'command': 'a'}]
+        path.write('steps: [')
+        with pytest.raises(ValueError):
+            simulation.load(str(path))
+
+    def test_many_jobs():
+        steps = [step(str(number), parallelism=10) for number in range(10000)] + ['wait']
+        result = simulate(steps, {}, {'default': 100})
+        assert result.queues['default'].jobs == 100000
+        assert result.duration == 1000
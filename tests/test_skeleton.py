@@ -4,7 +4,13 @@
 # pylint: disable=missing-docstring
 
 import argparse
+import io
+import json
+import os
+import shlex
+import subprocess
 import sys
+from collections import OrderedDict
 from unittest.mock import patch
 import pytest
 from bkyml.skeleton import Block, \
@@ -15,16 +21,72 @@ from bkyml.skeleton import Block, \
                            Plugin, \
                            Wait, \
                            Trigger, \
+                           Batch, \
+                           build_parser, \
+                           chosen_subcommand, \
                            parse_main, \
                            run, \
                            check_positive, \
+                           matrix_dimension, \
+                           matrix_rule, \
                            bool_or_string, \
-                           plugin_or_key_value_pair
+                           plugin_or_key_value_pair, \
+                           use_branch, \
+                           use_changed_paths, \
+                           use_format, \
+                           YAML
 
 __author__ = "Joscha Feth"
 __copyright__ = "Joscha Feth"
 __license__ = "mit"
 
+# Cumulative import time (in microseconds) a cold ``bkyml comment`` may spend
+# importing modules after interpreter startup, best of IMPORT_TIME_RUNS runs.
+IMPORT_TIME_BUDGET_US = 100000
+IMPORT_TIME_RUNS = 3
+
+
+def import_times(args):
+    """Run python -X importtime and return the top-level imports after startup"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True
+    )
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            entries.append((name.strip(), int(cumulative)))
+    names = [name for name, _ in entries]
+    if 'site' in names:
+        entries = entries[names.index('site') + 1:]
+    return result.stdout, entries
+
+
+def cached_batch(capsys, lines, argv=()):
+    """Output of ``batch --cache`` for ``lines`` on stdin"""
+    with patch.object(sys, 'stdin', io.StringIO(lines)):
+        assert parse_main(list(argv) + ['batch', '--cache']) is None
+    return capsys.readouterr().out
+
+
+def incremental_batch(capsys, lines, path, argv=()):
+    """Output of ``batch --incremental`` for ``lines`` on stdin and what it reports on stderr"""
+    with patch.object(sys, 'stdin', io.StringIO(lines)):
+        assert parse_main(list(argv) + ['batch', '--incremental', path]) is None
+    with open(path, encoding='utf-8') as stream:
+        return stream.read(), capsys.readouterr().err
+
+
+def step_hash(output):
+    """The $BKYML_INPUTS_HASH of the first step of a rendered fragment"""
+    return output.split('BKYML_INPUTS_HASH: ')[1].split()[0]
+
 
 def describe_bkyaml():
 
@@ -531,6 +593,236 @@ def describe_bkyaml():
                 ]
                 generic_command_call(args, snapshot)
 
+        def test_key_and_depends_on():
+            assert parse_main(['command', '--command', 'make', '--label', 'Build',
+                               '--key', 'build', '--depends-on', 'a', 'b',
+                               '--depends-on', 'c']) == (
+                '  - label: Build\n'
+                '    key: build\n'
+                '    depends_on:\n'
+                '      - a\n'
+                '      - b\n'
+                '      - c\n'
+                '    command: make\n')
+            assert parse_main(['trigger', 'deploy', '--key', 'deploy',
+                               '--depends-on', 'build']) == (
+                '  - trigger: deploy\n'
+                '    key: deploy\n'
+                '    depends_on: build\n')
+            assert parse_main(['block', 'Go', '--key', 'go', '--prompt', 'Sure?']) == (
+                '  - block: Go\n'
+                '    key: go\n'
+                '    prompt: Sure?\n')
+
+        def describe_command_matrix():
+
+            def test_matrix_dimension():
+                assert matrix_dimension('os=linux,windows') == ('os', ['linux', 'windows'])
+                for value in ['os', 'os=', '=linux']:
+                    with pytest.raises(argparse.ArgumentTypeError):
+                        matrix_dimension(value)
+
+            def test_matrix_rule():
+                assert matrix_rule('os=linux,py=3.6') == {'os': 'linux', 'py': '3.6'}
+                with pytest.raises(argparse.ArgumentTypeError):
+                    matrix_rule('os')
+
+            def test_matrix_cli(snapshot, capsys):
+                run_run(capsys, snapshot, [
+                    'command', '--command', 'tox -e py{py}', '--label', ':{os}: {py}',
+                    '--env', 'PY', '{py}', '--agents', 'os', '{os}',
+                    '--plugin', 'docker#v1.0.0', 'image=python:{py}',
+                    '--matrix', 'os=linux,windows', '--matrix', 'py=3.6,3.7',
+                    '--matrix-exclude', 'os=windows,py=3.6',
+                ])
+
+            def test_matrix_same_as_separate_commands(capsys):
+                with patch.object(sys, 'argv', ['', 'command', '--command', 'test {a}{b}',
+                                                '--matrix', 'a=1,2', '--matrix', 'b=x,y']):
+                    run()
+                expected = ''.join(
+                    parse_main(['command', '--command', 'test ' + combination]) + '\n'
+                    for combination in ['1x', '1y', '2x', '2y']
+                )
+                assert capsys.readouterr().out == expected
+
+            def test_matrix_is_lazy(args):
+                args.matrix = [(str(index), [str(value) for value in range(100)])
+                               for index in range(10)]
+                args.matrix_exclude = [OrderedDict([('9', '0')])]
+                combinations = Command.combinations(args)
+                assert list(next(combinations).values()) == ['0'] * 9 + ['1']
+
+            def test_matrix_errors(capsys):
+                for argv, message in [
+                        (['--matrix-exclude', 'a=1'],
+                         '--matrix-exclude requires --matrix or --for-each-glob.'),
+                        (['--matrix', 'a=1', '--matrix-exclude', 'b=1'],
+                         '--matrix-exclude: unknown dimension b.'),
+                        (['--matrix', 'a=1', '--matrix', 'a=2'],
+                         '--matrix dimensions have to be unique.'),
+                        (['--for-each-glob', '*', '--matrix', 'path=a'],
+                         '--matrix path is taken by --for-each-glob.')]:
+                    with pytest.raises(SystemExit):
+                        parse_main(['command', '--command', 'cmd'] + argv)
+                    assert message in capsys.readouterr().err
+
+        def describe_command_for_each_glob():
+
+            @pytest.fixture
+            def tree(tmpdir, monkeypatch):
+                for path in ['test/b/x.py', 'test/a/x.py', 'test/.hidden/x.py', 'test/README']:
+                    tmpdir.join(path).ensure()
+                monkeypatch.chdir(tmpdir)
+
+            def test_one_step_per_match(tree):
+                assert parse_main(['command', '--for-each-glob', 'test/*/',
+                                   '--command', 'run_tests {path}',
+                                   '--label', "Run tests for '{path}'"]) == (
+                    "  - label: Run tests for 'test/a/'\n"
+                    "    command: run_tests test/a/\n"
+                    "\n"
+                    "  - label: Run tests for 'test/b/'\n"
+                    "    command: run_tests test/b/\n"
+                )
+
+            def test_with_matrix(tree):
+                out = parse_main(['command', '--for-each-glob', 'test/**/*.py',
+                                  '--matrix', 'py=3.6,3.7', '--matrix-exclude', 'py=3.6',
+                                  '--command', 'python{py} {path}'])
+                assert out == ('  - command: python3.7 test/a/x.py\n\n'
+                               '  - command: python3.7 test/b/x.py\n')
+
+            def test_no_match(tree):
+                assert parse_main(['command', '--for-each-glob', 'nothing/*',
+                                   '--command', 'cmd']) == ''
+
+        def describe_command_watch():
+
+            @pytest.fixture
+            def changed(tmpdir, monkeypatch):
+                for path in ['packages/a/setup.py', 'packages/b/setup.py']:
+                    tmpdir.join(path).ensure()
+                tmpdir.join('changes.txt').write('packages/b/src/x.py\ndocs/index.rst\n')
+                monkeypatch.chdir(tmpdir)
+
+            def test_pruned(changed, capsys):
+                assert parse_main(['--changed-files', 'changes.txt', 'command',
+                                   '--command', 'make', '--watch', 'packages/a',
+                                   '--watch', '**/*.md']) is None
+                assert capsys.readouterr().err == "pruned step 'make': none of the 2 " \
+                    "changed paths matches --watch packages/a **/*.md\n"
+
+            def test_kept(changed):
+                assert parse_main(['--changed-files', 'changes.txt', 'command',
+                                   '--command', 'make', '--watch', 'docs/*.rst']) == \
+                    '  - command: make\n'
+
+            def test_without_changed_files(changed):
+                assert parse_main(['command', '--command', 'make', '--watch', 'nothing']) == \
+                    '  - command: make\n'
+
+            def test_for_each_glob(changed, capsys):
+                assert parse_main(['--changed-files', 'changes.txt', 'command',
+                                   '--for-each-glob', 'packages/*/', '--watch', '{path}',
+                                   '--command', 'cd {path} && make', '--label', '{path}']) == (
+                    "  - label: packages/b/\n"
+                    "    command: cd packages/b/ && make\n"
+                )
+                assert capsys.readouterr().err.startswith("pruned step 'packages/a/': ")
+
+            def test_batch(changed, capsys):
+                with patch.object(sys, 'stdin', io.StringIO(
+                        'command --command a --watch packages/a\n'
+                        'command --command b --watch packages/b\n')):
+                    parse_main(['--changed-files', 'changes.txt', 'batch'])
+                captured = capsys.readouterr()
+                assert captured.out == '  - command: b\n\n'
+                assert captured.err.startswith("pruned step 'a': ")
+
+            def test_missing_changed_files(changed, capsys):
+                with pytest.raises(SystemExit):
+                    parse_main(['--changed-files', 'missing.txt', 'wait'])
+                assert '--changed-files: [Errno 2]' in capsys.readouterr().err
+
+    def describe_cache_inputs():
+
+        @pytest.fixture
+        def tree(tmpdir, monkeypatch):
+            tmpdir.join('src/a.py').write('a', ensure=True)
+            monkeypatch.chdir(tmpdir)
+            monkeypatch.delenv('BKYML_CACHE_DIR', raising=False)
+            return tmpdir
+
+        def test_skipped_once_recorded(tree):
+            argv = ['command', '--command', 'pytest', '--cache-inputs', 'src', 'setup.cfg']
+            first = parse_main(argv)
+            assert 'skip' not in first
+            assert parse_main(['cache', 'record', step_hash(first)]) is None
+            assert tree.join('.bkyml-cache/passed', step_hash(first)).check()
+            second = parse_main(argv)
+            assert step_hash(second) == step_hash(first)
+            assert second.endswith(
+                "    skip: inputs unchanged (hash %s)\n" % step_hash(first)[:12])
+            tree.join('src/a.py').write('changed')
+            assert 'skip' not in parse_main(argv)
+
+        def test_hash_covers_the_step(tree):
+            hashes = {step_hash(parse_main(['command', '--command', command,
+                                            '--cache-inputs', 'src', '--env', 'A', 'a']))
+                      for command in ('pytest', 'flake8')}
+            assert len(hashes) == 2
+
+        def test_matrix(tree):
+            tree.join('lib/b.py').write('b', ensure=True)
+            output = parse_main(['command', '--command', 'pytest {dir}', '--matrix', 'dir=src,lib',
+                                 '--cache-inputs', '{dir}', '--cache-dir', 'cache'])
+            assert output.count('BKYML_INPUTS_HASH') == 2
+            assert tree.join('cache/inputs-index.json').check()
+
+        def test_record_invalid_hash(capsys):
+            with pytest.raises(SystemExit):
+                parse_main(['cache', 'record', 'abc'])
+            assert 'abc is not a hash of --cache-inputs' in capsys.readouterr().err
+
+    def describe_resolve_branches():
+
+        def test_omitted(capsys):
+            for argv in [['command', '--command', 'deploy', '--branches', 'master'],
+                         ['trigger', 'deploy', '--branches', 'master'],
+                         ['block', 'Deploy', '--branches', 'master', 'stable/*']]:
+                assert parse_main(['--resolve-branches', 'feature/x'] + argv) is None
+            assert capsys.readouterr().err.splitlines() == [
+                "omitted step 'deploy': branch 'feature/x' does not match --branches master",
+                "omitted step 'deploy': branch 'feature/x' does not match --branches master",
+                "omitted step 'Deploy': branch 'feature/x' does not match "
+                "--branches master stable/*",
+            ]
+
+        def test_kept():
+            for argv in [['command', '--command', 'deploy', '--branches', 'stable/*'],
+                         ['trigger', 'deploy', '--branches', '!master'],
+                         ['block', 'Deploy'],
+                         ['wait']]:
+                assert parse_main(['--resolve-branches', 'stable/1.x'] + argv) == \
+                    parse_main(argv)
+
+        def test_empty_branch():
+            argv = ['command', '--command', 'deploy', '--branches', 'master']
+            assert parse_main(['--resolve-branches', ''] + argv) == parse_main(argv)
+
+        def test_batch(capsys):
+            with patch.object(sys, 'stdin', io.StringIO(
+                    "command --command test\n"
+                    "command --command deploy --branches master --matrix env=a,b\n"
+                    "block Release --branches 'master !*'\n")):
+                parse_main(['--resolve-branches', 'master', 'batch'])
+            assert capsys.readouterr().out == (
+                '  - command: test\n\n'
+                '  - command: deploy\n    branches: master\n\n'
+                '  - command: deploy\n    branches: master\n\n'
+            )
+
     def describe_plugin():
 
         @pytest.fixture
@@ -567,11 +859,562 @@ def describe_bkyaml():
                 ]
                 generic_plugin_call(args, snapshot)
 
+    def describe_shard():
+        @pytest.fixture
+        def tests(tmpdir, monkeypatch):
+            for name, size in [('a.py', 1024), ('b.py', 4096), ('c.py', 2048), ('d.py', 0)]:
+                tmpdir.join(name).write('x' * size)
+            tmpdir.join('timings.tsv').write('a.py\t30\nb.py\t20\n')
+            tmpdir.join('tests.txt').write('a.py\nb.py\nc.py\nd.py\n')
+            monkeypatch.chdir(tmpdir)
+
+        def test_shard(tests, capsys):
+            assert parse_main(['shard', '--files', 'tests.txt', '--timings', 'timings.tsv',
+                               '--shards', '2', '--command', 'pytest -x {files}',
+                               '--label', 'Tests {index}/{total}']) == (
+                '  - label: Tests 1/2\n'
+                '    command: pytest -x a.py d.py\n'
+                '\n'
+                '  - label: Tests 2/2\n'
+                '    command: pytest -x b.py c.py\n'
+            )
+            assert capsys.readouterr().err == \
+                'predicted makespan: 40.0s (2 shards, 70.0s in total)\n'
+
+        def test_target_duration(tests, capsys):
+            with patch.object(sys, 'stdin', io.StringIO('a.py\nb.py\n')):
+                out = parse_main(['shard', '--timings', 'timings.tsv',
+                                  '--target-duration', '20', '--command', 'pytest'])
+            assert out == '  - command: pytest a.py\n\n  - command: pytest b.py\n'
+            assert 'predicted makespan: 30.0s (2 shards' in capsys.readouterr().err
+
+        def test_in_batch(tests, capsys):
+            args = argparse.Namespace(file=io.StringIO(
+                'shard --files tests.txt --shards 4 --command "t {files}"\nwait\n'))
+            Batch.batch(args)
+            out = capsys.readouterr().out
+            assert out.count('  - command: t ') == 4
+            assert out.endswith('  - wait\n\n')
+
+        def test_invalid_timings(tests, capsys):
+            with pytest.raises(SystemExit) as excinfo:
+                parse_main(['shard', '--files', 'tests.txt', '--timings', 'tests.txt',
+                            '--shards', '2', '--command', 'pytest'])
+            assert 'timings line 1: expected PATH<TAB>SECONDS' in str(excinfo.value)
+
+    def describe_split():
+        @pytest.fixture
+        def tests(tmpdir, monkeypatch):
+            tmpdir.join('timings.tsv').write('a.py\t30\nb.py\t20\nc.py\t10\n')
+            tmpdir.join('tests.txt').write('c.py\nb.py\na.py\nd.py\n')
+            monkeypatch.chdir(tmpdir)
+
+        def test_split(tests):
+            assert [parse_main(['split', '--index', str(index), '--total', '2', '--files',
+                                'tests.txt', '--timings', 'timings.tsv']) for index in (0, 1)] \
+                == ['a.py\nc.py', 'b.py\nd.py']
+
+        def test_parallel_job_environment(tests):
+            with patch.dict(os.environ, {'BUILDKITE_PARALLEL_JOB': '1',
+                                         'BUILDKITE_PARALLEL_JOB_COUNT': '3'}), \
+                    patch.object(sys, 'stdin', io.StringIO('a.py\nb.py\nc.py\n')):
+                assert parse_main(['split', '--timings', 'timings.tsv']) == 'b.py'
+
+        def test_no_tests_left(tests):
+            assert parse_main(['split', '--index', '4', '--total', '5',
+                               '--files', 'tests.txt']) is None
+
+        def test_errors(tests):
+            with patch.dict(os.environ, {'BUILDKITE_PARALLEL_JOB': '',
+                                         'BUILDKITE_PARALLEL_JOB_COUNT': ''}):
+                for argv, message in [
+                        ([], '--index and --total are required'),
+                        (['--index', '2', '--total', '2'], '--index has to be at least 0'),
+                        (['--index', '0', '--total', '1', '--files', 'missing.txt'],
+                         'No such file or directory')]:
+                    with pytest.raises(SystemExit) as excinfo:
+                        parse_main(['split'] + argv)
+                    assert message in str(excinfo.value)
+
+    def describe_batch():
+        @pytest.fixture
+        def batch_lines():
+            return [
+                "comment 'Pipeline for running all tests'",
+                'env --var FORCE_COLOR 1',
+                'steps',
+                "command --command 'yarn test' --label ':karma: tests'",
+                'wait --continue-on-failure',
+                "plugin --plugin 'org/upload-coverage#1.0.0' dir=./coverage",
+                'trigger my-pipeline --build-env a b',
+                "block ':rocket: Release'",
+            ]
+
+        def test_batch_lines():
+            stream = io.StringIO(
+                '# skipped\n'
+                '\n'
+                "bkyml command --command 'a b' \\\n"
+                '    --label x\n'
+                'wait\n'
+                'bkyml steps \\\n'
+            )
+            assert list(Batch.lines(stream)) == [
+                ['command', '--command', 'a b', '--label', 'x'],
+                ['wait'],
+                ['steps'],
+            ]
+
+        def test_batch_byte_identical(capsys, batch_lines):
+            expected = ''.join(
+                parse_main(shlex.split(line)) + '\n'
+                for line in batch_lines
+            )
+            args = argparse.Namespace(file=io.StringIO('\n'.join(batch_lines)))
+            assert Batch.batch(args) is None
+            captured = capsys.readouterr()
+            assert captured.out == expected
+
+        def test_batch_unbalanced_quote(capsys):
+            args = argparse.Namespace(file=io.StringIO(
+                'wait\ncommand \\\n  --command \'unterminated\n'))
+            with pytest.raises(SystemExit):
+                Batch.batch(args)
+            captured = capsys.readouterr()
+            assert captured.out == '  - wait\n\n'
+            assert 'line 2: No closing quotation' in captured.err
+
+        def test_batch_nested(capsys):
+            args = argparse.Namespace(file=io.StringIO('batch\n'))
+            with pytest.raises(SystemExit):
+                Batch.batch(args)
+            assert 'batch can not be nested' in capsys.readouterr().err
+
+        def test_batch_missing_subcommand(capsys):
+            args = argparse.Namespace(file=io.StringIO('-v\n'))
+            with pytest.raises(SystemExit):
+                Batch.batch(args)
+            assert 'missing subcommand' in capsys.readouterr().err
+
+        def describe_batch_cache():
+            @pytest.fixture
+            def cache_dir(tmpdir, monkeypatch):
+                monkeypatch.chdir(tmpdir)
+                monkeypatch.setenv('BKYML_CACHE_DIR', str(tmpdir.join('cache')))
+                return tmpdir.join('cache', 'outputs')
+
+            def test_hit(cache_dir, capsys, batch_lines):
+                expected = cached_batch(capsys, '\n'.join(batch_lines))
+                # keyed by the exact input and by its lines
+                assert len(cache_dir.listdir()) == 2
+                with patch.object(Batch, 'render', side_effect=AssertionError):
+                    # comments, blank lines and program names do not change the key
+                    assert cached_batch(capsys, '# cached\n\n' + '\n'.join(
+                        'bkyml ' + line for line in batch_lines)) == expected
+                    with patch.object(Batch, 'lines', side_effect=AssertionError):
+                        assert cached_batch(capsys, '\n'.join(batch_lines)) == expected
+                assert len(cache_dir.listdir()) == 3
+                with patch.object(sys, 'stdin', io.StringIO('\n'.join(batch_lines))):
+                    parse_main(['batch'])
+                assert capsys.readouterr().out == expected
+
+            def test_key_covers_options(cache_dir, capsys):
+                lines = 'command --command deploy --branches master\n'
+                cached_batch(capsys, lines)
+                assert cached_batch(capsys, lines, ['--resolve-branches', 'feature']) == ''
+                cached_batch(capsys, lines, ['--format', 'json'])
+                assert len(cache_dir.listdir()) == 6
+
+            def test_hit_writes_messages(cache_dir, capsys):
+                lines = 'command --command deploy --branches master\n'
+                for _ in range(2):
+                    with patch.object(sys, 'stdin', io.StringIO(lines)):
+                        parse_main(['--resolve-branches', 'feature', 'batch', '--cache'])
+                    out, err = capsys.readouterr()
+                    assert out == ''
+                    assert err.startswith("omitted step 'deploy': branch 'feature'")
+
+            def test_reading_files_is_not_cached(cache_dir, capsys):
+                for lines in ['command --command x --for-each-glob "*"\n',
+                              'command --command x --for-each "*"\n',
+                              'command --command x --cache-in "*"\n',
+                              'shard --files - --shards 1 --command x\n']:
+                    cached_batch(capsys, lines)
+                assert not cache_dir.check()
+
+        def describe_batch_incremental():
+            @pytest.fixture
+            def path(tmpdir):
+                return str(tmpdir.join('pipeline.yml'))
+
+            def test_same_as_batch(capsys, batch_lines, path):
+                lines = '\n'.join(batch_lines)
+                with patch.object(sys, 'stdin', io.StringIO(lines)):
+                    parse_main(['batch'])
+                expected = capsys.readouterr().out
+                assert incremental_batch(capsys, lines, path) == (
+                    expected, 'copied 0 parts from the last render, rendered 8\n')
+                with patch.object(Batch, 'render', side_effect=AssertionError):
+                    assert incremental_batch(capsys, lines, path) == (
+                        expected, 'copied 8 parts from the last render, rendered 0\n')
+
+            def test_splices_unchanged_steps(capsys, path, tmpdir, monkeypatch):
+                monkeypatch.chdir(tmpdir)
+                tmpdir.join('a').ensure(dir=True)
+                lines = 'steps\ncommand --command "test {path}" --for-each-glob "*/"\n'
+                incremental_batch(capsys, lines, path)
+                tmpdir.join('b').ensure(dir=True)
+                # the line reads files, so its steps are rendered and only spliced
+                output, reported = incremental_batch(capsys, lines, path)
+                assert reported == 'copied 2 parts from the last render, rendered 1\n'
+                assert output == 'steps:\n\n  - command: test a/\n\n  - command: test b/\n\n'
+
+            def test_changed_options_render_lines_again(capsys, path):
+                lines = 'steps\ncommand --command deploy --branches master\n'
+                incremental_batch(capsys, lines, path)
+                output, reported = incremental_batch(capsys, lines, path,
+                                                     ['--resolve-branches', 'feature'])
+                assert output == 'steps:\n\n'
+                assert reported.endswith('copied 1 parts from the last render, rendered 0\n')
+                # a new format does not splice anything
+                output, reported = incremental_batch(capsys, lines, path, ['--format', 'yaml-c'])
+                assert reported == 'copied 0 parts from the last render, rendered 2\n'
+
+            def test_edited_output_is_rendered_again(capsys, path):
+                incremental_batch(capsys, 'steps\n', path)
+                with open(path, 'a') as stream:
+                    stream.write('# edited\n')
+                assert incremental_batch(capsys, 'steps\n', path) == (
+                    'steps:\n\n', 'copied 0 parts from the last render, rendered 1\n')
+
+            def test_needs_streamable_format(capsys, path):
+                with pytest.raises(SystemExit):
+                    incremental_batch(capsys, 'steps\n', path, ['--format', 'json'])
+                assert '--incremental can not be used with --format json' in \
+                    capsys.readouterr().err
+
+        def test_diff_cli(capsys, snapshot, tmpdir):
+            old, new = str(tmpdir.join('old.yml')), str(tmpdir.join('new.yml'))
+            incremental_batch(capsys, 'steps\ncommand --label a --command x\nwait\n', old)
+            incremental_batch(capsys, 'steps\ncommand --label a --command y\n'
+                                      'command --label b --command z\n', new)
+            run_run(capsys, snapshot, ['diff', old, new])
+            run_run(capsys, snapshot, ['diff', old, old])
+
+        def test_split_into_files(capsys, tmpdir, batch_lines):
+            directory = tmpdir.join('fragments')
+            with patch.object(sys, 'stdin', io.StringIO('\n'.join(batch_lines))):
+                parse_main(['batch', '--max-steps-per-file', '2', '--output-dir', str(directory)])
+            paths = capsys.readouterr().out
+            assert directory.join('manifest.txt').read() == paths
+            assert [os.path.basename(path) for path in paths.splitlines()] == [
+                'pipeline-0001.yml', 'pipeline-0002.yml', 'pipeline-0003.yml']
+            # the wait barrier starts the second fragment
+            assert directory.join('pipeline-0002.yml').read() == (
+                '# Pipeline for running all tests\n'
+                'env:\n'
+                "  FORCE_COLOR: '1'\n"
+                '\n'
+                'steps:\n'
+                '\n'
+                '  - wait:\n'
+                '    continue_on_failure: true\n'
+                '\n'
+                "  - plugins:\n"
+                "      org/upload-coverage#1.0.0:\n"
+                "        dir: ./coverage\n"
+                '\n'
+            )
+            for argv in (['batch', '--max-steps-per-file', '1', '--cache'],
+                         ['--anchors', 'batch', '--max-bytes-per-file', '1000']):
+                with pytest.raises(SystemExit):
+                    parse_main(argv)
+                assert 'error: ' in capsys.readouterr().err
+
+        def test_stages(capsys, tmpdir, batch_lines):
+            plan = str(tmpdir.join('plan.json'))
+            with patch.object(sys, 'stdin', io.StringIO('\n'.join(batch_lines))):
+                parse_main(['batch'])
+            steps = YAML.yaml.load(capsys.readouterr().out)['steps']
+            with patch.object(sys, 'stdin', io.StringIO('\n'.join(batch_lines))):
+                parse_main(['batch', '--stage-steps', '5', '--plan', plan])
+            first = YAML.yaml.load(capsys.readouterr().out)
+            # the first stage ends before the wait
+            assert first['steps'][:-1] == steps[:1]
+            assert first['steps'][-1]['command'] == (
+                'buildkite-agent artifact download {plan} . && '
+                'bkyml stage {plan} | buildkite-agent pipeline upload').format(plan=plan)
+            parse_main(['stage', plan])
+            rest = YAML.yaml.load(capsys.readouterr().out)
+            assert rest['env'] == first['env'] == {'FORCE_COLOR': '1'}
+            assert rest['steps'] == steps[1:]
+            # nothing left, no plan
+            with patch.object(sys, 'stdin', io.StringIO('steps\nwait\n')):
+                parse_main(['batch', '--stage-steps', '5', '--plan', str(tmpdir.join('none'))])
+            assert capsys.readouterr().out == 'steps:\n\n  - wait\n\n'
+            assert not tmpdir.join('none').check()
+
+        def test_dependencies(capsys, tmpdir):
+            valid = ('steps\n'
+                     'command --command make --key build\n'
+                     'command --command test --key test-{n} --depends-on build --matrix n=1,2\n'
+                     'wait\n'
+                     'trigger deploy --depends-on test-1 test-2\n')
+            for argv in (['batch'], ['--format', 'json', 'batch'],
+                         ['batch', '--incremental', str(tmpdir.join('pipeline.yml'))],
+                         ['batch', '--max-steps-per-file', '2', '--output-dir', str(tmpdir)]):
+                with patch.object(sys, 'stdin', io.StringIO(valid)):
+                    parse_main(argv)
+                capsys.readouterr()
+            try:
+                for lines, message in [
+                        ('command --command a --depends-on missing\n',
+                         "command: a depends on the unknown key 'missing'"),
+                        ('command --command a --key a --depends-on b\nwait\n'
+                         'command --command b --key b\n',
+                         'dependency cycle: key: a -> key: b -> wait -> key: a'),
+                        ('command --command a --key a\ntrigger a --key a\n',
+                         "more than one step has the key 'a'")]:
+                    for argv in (['batch'], ['--format', 'json', 'batch']):
+                        with patch.object(sys, 'stdin', io.StringIO(lines)):
+                            with pytest.raises(SystemExit):
+                                parse_main(argv)
+                        assert 'error: ' + message in capsys.readouterr().err
+            finally:
+                use_format('yaml')
+
+        def test_eliminate_waits(capsys):
+            lines = ('comment generated\n'
+                     'steps\n'
+                     "command --command build --label 'build {py}' --matrix py=3.6,3.7 "
+                     "--artifact-paths 'dist/{py}/*.whl'\n"
+                     'wait\n'
+                     "command --command test --label 'test {py}' --matrix py=3.6,3.7 "
+                     "--needs-artifact 'dist/{py}/app.whl'\n"
+                     'command --command lint --needs-artifact\n')
+            try:
+                for fmt in ('yaml', 'json'):
+                    with patch.object(sys, 'stdin', io.StringIO(lines)):
+                        parse_main(['--format', fmt, 'batch', '--eliminate-waits'])
+                    out, err = capsys.readouterr()
+                    assert err.startswith('removed 1 of 1 waits\n')
+                    if fmt == 'json':
+                        assert err.endswith('json output can not hold them\n')
+                        document = json.loads(out)
+                    else:
+                        assert out.startswith('# generated\n')
+                        document = YAML.yaml.load(out)
+                    assert [(step.get('key'), step.get('depends_on'))
+                            for step in document['steps']] == [
+                        ('step-1', None), ('step-2', None),
+                        (None, 'step-1'), (None, 'step-2'), (None, None)]
+            finally:
+                use_format('yaml')
+            with pytest.raises(SystemExit):
+                parse_main(['batch', '--eliminate-waits', '--stage-steps', '1'])
+            assert 'error: --eliminate-waits ' in capsys.readouterr().err
+
+        def test_analyze_critical_path(capsys, tmpdir):
+            lines = tmpdir.join('batch.txt')
+            lines.write('command --command make --key build --estimate 120\n'
+                        'command --command lint --label Lint --estimate 30\n'
+                        'wait\n'
+                        "command --command test --label 'Test {n}' --matrix n=1,2 --estimate 60\n"
+                        'command --command deploy --depends-on build\n')
+            timings = tmpdir.join('timings.tsv')
+            timings.write('Test 2\t100\n')
+            assert parse_main(['analyze', 'critical-path', '--file', str(lines),
+                               '--timings', str(timings)]) == (
+                '     START   DURATION      SLACK  STEP\n'
+                '       0.0      120.0        0.0  key: build\n'
+                '       0.0       30.0       90.0  label: Lint\n'
+                '     120.0       60.0       40.0  label: Test 1\n'
+                '     120.0      100.0        0.0  label: Test 2\n'
+                '     120.0       77.5       22.5  command: deploy\n'
+                '1 of 5 steps had no timings or --estimate and took 77.5s\n'
+                'critical path: key: build -> label: Test 2\n'
+                'least build time: 220.0s')
+            try:
+                parse_main(['--format', 'json', 'analyze', 'critical-path', '--file', str(lines),
+                            '--default-duration', '1', '--prioritize', '--max-slack', '30'])
+            finally:
+                use_format('yaml')
+            out, err = capsys.readouterr()
+            assert err.endswith('least build time: 180.0s\n')
+            assert [step if step == 'wait' else (step.get('label', step['command']),
+                                                 step.get('priority'))
+                    for step in json.loads(out)['steps']] == [
+                ('make', 1), ('Lint', None), 'wait', ('Test 1', 1), ('Test 2', 1),
+                ('deploy', None)]
+            lines.write('command --command a --depends-on b\n')
+            with pytest.raises(SystemExit) as error:
+                parse_main(['analyze', 'critical-path', '--file', str(lines)])
+            assert str(error.value) == \
+                "bkyml analyze: command: a depends on the unknown key 'b'"
+
+        def test_simulate(tmpdir):
+            pipeline = tmpdir.join('pipeline.yml')
+            pipeline.write('steps:\n'
+                           '  - label: Build\n    command: make\n    parallelism: 2\n'
+                           '  - wait\n'
+                           '  - label: Docs\n    command: docs\n'
+                           '    agents:\n      queue: small\n')
+            timings = tmpdir.join('timings.tsv')
+            timings.write('Build\t60\nDocs\t20\n')
+            assert parse_main(['simulate', str(pipeline), '--agents', 'default=1',
+                               '--agents', 'small=1', '--timings', str(timings)]) == (
+                'build time: 140.0s\n'
+                'QUEUE                 AGENTS     JOBS         BUSY  UTILIZATION  MEAN WAIT   MAX WAIT\n' # NOQA
+                'default                    1        2       120.0s       85.7%      30.0s      60.0s\n' # NOQA
+                'small                      1        1        20.0s       14.3%       0.0s       0.0s') # NOQA
+            found = parse_main(['simulate', str(pipeline), '--agents', 'default=1,2',
+                                '--agents', 'small=1', '--timings', str(timings)])
+            assert [line for line in found.split('\n') if line.startswith(('agents', 'build'))] \
+                == ['agents: default=1 small=1', 'build time: 140.0s',
+                    'agents: default=2 small=1', 'build time: 80.0s']
+            assert parse_main(['simulate', str(pipeline), '--agents', 'default=1',
+                               '--agents', 'small=1', '--failure-rate', '0.5']).endswith(
+                                   '0 retries, 1 jobs failed')
+            with pytest.raises(SystemExit) as error:
+                parse_main(['simulate', str(pipeline), '--agents', 'default=1'])
+            assert str(error.value) == \
+                "bkyml simulate: label: Docs runs on the queue 'small', which has no agents"
+
+        def test_run_local(capsys, tmpdir):
+            pipeline = tmpdir.join('pipeline.json')
+            pipeline.write(json.dumps({'env': {'A': 'a'}, 'steps': [
+                {'label': 'Echo', 'command': 'echo $A'}, 'wait',
+                {'label': 'Fail', 'command': 'exit 2'}]}))
+            with pytest.raises(SystemExit) as error:
+                parse_main(['run-local', str(pipeline), '--jobs', '1', '--shell', 'sh -c'])
+            assert str(error.value) == 'bkyml run-local: 1 step failed'
+            out = capsys.readouterr().out.splitlines()
+            assert out[:6] == ['[Echo] started', '[Echo] a', '[Echo] passed', '[Fail] started',
+                               '[Fail] exited with status 2', out[5]]
+            assert out[5].startswith('passed ') and out[6].startswith('failed ')
+            assert out[7].startswith('1 passed, 0 soft failed, 1 failed, 0 not run in ')
+            pipeline.write('steps:\n  - command: "true"\n')
+            assert parse_main(['run-local', str(pipeline)]) is None
+            with pytest.raises(SystemExit) as error:
+                parse_main(['run-local', str(tmpdir.join('missing.yml'))])
+            assert str(error.value).startswith('bkyml run-local: [Errno 2]')
+
+        def test_stages_keep_keys(capsys, tmpdir):
+            plan = str(tmpdir.join('plan.json'))
+            lines = ('command --command a --key a\n'
+                     'command --command b --key b --depends-on a\n')
+            with patch.object(sys, 'stdin', io.StringIO(lines)):
+                parse_main(['batch', '--stage-steps', '1', '--plan', plan])
+            capsys.readouterr()
+            parse_main(['stage', plan])
+            assert capsys.readouterr().out == \
+                'steps:\n\n  - key: b\n    depends_on: a\n    command: b\n\n'
+            with patch.object(sys, 'stdin', io.StringIO(
+                    'command --command b --key b --depends-on a\ncommand --command a --key a\n')):
+                with pytest.raises(SystemExit):
+                    parse_main(['batch', '--stage-steps', '1', '--plan', plan])
+            assert "key: b depends on the key 'a' of a step of a later stage" in \
+                capsys.readouterr().err
+
+        def test_stages_keep_options(capsys, tmpdir):
+            plan = str(tmpdir.join('plan.json'))
+            changed = tmpdir.join('changed.txt')
+            changed.write('docs/index.rst\n')
+            lines = ('command --command a\n'
+                     'command --command b --watch src/**\n'
+                     'command --command c --branches main --watch docs/**\n')
+            try:
+                with patch.object(sys, 'stdin', io.StringIO(lines)):
+                    parse_main(['--format', 'json', '--changed-files', str(changed),
+                                '--resolve-branches', 'main', 'batch', '--stage-steps', '1',
+                                '--plan', plan, '--stage-command', 'upload {plan}',
+                                '--stage-label', 'Rest'])
+                assert capsys.readouterr().out == (
+                    '{"steps":[{"command":"a"},{"label":"Rest","command":"upload %s"}]}\n'
+                    % plan)
+                changed.remove()
+                use_format('yaml')
+                use_branch(None)
+                use_changed_paths(None)
+                parse_main(['stage', plan])
+                assert capsys.readouterr().out == '{"steps":[{"command":"c","branches":"main"}]}\n'
+            finally:
+                use_format('yaml')
+                use_branch(None)
+                use_changed_paths(None)
+            tmpdir.join('other.json').write('{"version": 0}')
+            for argv in (['stage', str(tmpdir.join('missing'))],
+                         ['stage', str(tmpdir.join('other.json'))]):
+                with pytest.raises(SystemExit) as error:
+                    parse_main(argv)
+                assert str(error.value).startswith('bkyml stage: ')
+            with pytest.raises(SystemExit):
+                parse_main(['batch', '--stage-steps', '1', '--cache'])
+            assert 'error: --stage-steps ' in capsys.readouterr().err
+
+        def test_anchors_cli(capsys, snapshot):
+            lines = ('steps\n'
+                     'command --command a --env A B --agents queue q --plugin docker#v1 image=x\n'
+                     'command --command b --env A B --agents queue r --plugin docker#v1 image=x\n'
+                     'trigger t --build-env A B\n')
+            try:
+                with patch.object(sys, 'stdin', io.StringIO(lines)):
+                    run_run(capsys, snapshot, ['--anchors', 'batch'])
+            finally:
+                use_format('yaml')
+            for argv in (['--anchors', '--format', 'json', 'batch'],
+                         ['--anchors', 'batch', '--incremental', 'pipeline.yml']):
+                with pytest.raises(SystemExit):
+                    parse_main(argv)
+                assert 'error: --anchors ' in capsys.readouterr().err
+
+        def test_batch_cli(capsys, snapshot):
+            with patch.object(sys, 'stdin', io.StringIO('steps\nwait\n')):
+                run_run(capsys, snapshot, ['batch'])
+
+    def describe_cold_start():
+        def test_comment_does_not_import_ruamel():
+            out, entries = import_times(['-m', 'bkyml.skeleton', 'comment', 'x'])
+            assert out == '# x\n'
+            assert not [name for name, _ in entries if name.startswith('ruamel')]
+
+        def test_import_time_budget():
+            best = min(
+                sum(cumulative for _, cumulative in
+                    import_times(['-m', 'bkyml.skeleton', 'comment', 'x'])[1])
+                for _ in range(IMPORT_TIME_RUNS)
+            )
+            assert best < IMPORT_TIME_BUDGET_US
+
+        def test_lazy_subparser():
+            assert chosen_subcommand(['-v', 'wait', '--continue-on-failure']) == 'wait'
+            assert chosen_subcommand(['--version']) is None
+            assert chosen_subcommand(['unknown']) is None
+            assert chosen_subcommand(['--format', 'json', '--resolve-branches', 'main',
+                                      '--changed-files=-', 'batch']) == 'batch'
+            assert chosen_subcommand(['--format', 'json']) is None
+            with patch.object(Command, 'install') as install:
+                build_parser(only=chosen_subcommand(['--format', 'json', 'batch']))
+            install.assert_not_called()
+            parser = build_parser(only='wait')
+            assert parser.parse_args(['wait', '--continue-on-failure']).continue_on_failure
+            with pytest.raises(SystemExit):
+                parser.parse_args(['command', '--command', 'x'])
+
     def describe_parse_main():
         def test_main(snapshot):
             snapshot.assert_match(parse_main(['command', '--command', 'x']))
 
     def describe_cli():
+        def test_version(capsys):
+            with pytest.raises(SystemExit) as sys_exit:
+                with patch.object(sys, 'argv', ['', '--version']):
+                    run()
+            assert sys_exit.value.code == 0
+            captured = capsys.readouterr()
+            assert captured.out.startswith('bkyml ')
+            assert captured.err == ''
+
         def test_cli_command(snapshot, capsys):
             run_run(capsys, snapshot, ['command', '--command', 'x'])
 
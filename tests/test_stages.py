@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=unused-variable
+# pylint: disable=missing-docstring
+
+import pytest
+from bkyml import stages
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+
+def describe_stages():
+
+    def test_round_trip(tmpdir):
+        path = str(tmpdir.join('plan.json'))
+        lines = [['steps'], ['command', '--command', 'tëst']]
+        stages.Plan(lines, 'json', 'main', ['a/b'], True, ['key']).save(path)
+        plan = stages.Plan.load(path)
+        assert (plan.lines, plan.format, plan.branch, plan.changed_files, plan.anchors,
+                plan.keys) == (lines, 'json', 'main', ['a/b'], True, ['key'])
+        assert tmpdir.listdir() == [tmpdir.join('plan.json')]
+
+    def test_other_versions(tmpdir):
+        path = tmpdir.join('plan.json')
+        for text in ('[]', '{"version": 2, "lines": []}'):
+            path.write(text)
+            with pytest.raises(ValueError):
+                stages.Plan.load(str(path))
+
+    def test_follow_up():
+        assert stages.follow_up('upload {plan} && rm {plan}', 'Rest', 'my plan.json') == [
+            'command', '--command', "upload 'my plan.json' && rm 'my plan.json'",
+            '--label', 'Rest']
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=unused-variable
+# pylint: disable=missing-docstring
+
+import io
+import os
+import pytest
+from bkyml import timings
+from bkyml.skeleton import parse_main
+
+__author__ = "Joscha Feth"
+__copyright__ = "Joscha Feth"
+__license__ = "mit"
+
+
+def report(*cases):
+    """A JUnit XML report of ``(classname, name, file, time, outcome)`` cases"""
+    lines = ['<?xml version="1.0" encoding="utf-8"?>', '<testsuites><testsuite name="s">']
+    for classname, name, test_file, time, outcome in cases:
+        lines.append('<testcase classname="{}" name="{}" file="{}" time="{}">{}</testcase>'.format(
+            classname, name, test_file, time, '<%s/>' % outcome if outcome else ''))
+    lines.append('</testsuite></testsuites>')
+    return '\n'.join(lines)
+
+
+def describe_timings():
+
+    @pytest.fixture
+    def reports(tmpdir, monkeypatch):
+        monkeypatch.chdir(tmpdir)
+        tmpdir.join('1.xml').write(report(('t.a', 'test_x', 'a.py', '1.0', None),
+                                          ('t.a', 'test_y', 'a.py', '2.0', 'failure'),
+                                          ('t.b', 'test_z', 'b.py', '4.0', 'skipped')))
+        tmpdir.join('2.xml').write(report(('t.a', 'test_x', 'a.py', '3.0', 'error'),
+                                          ('t.b', 'test_z', 'b.py', '1,000.5', None)))
+        return tmpdir
+
+    def describe_testcases():
+        def test_outcomes():
+            source = io.BytesIO(report(('t.a', 'x', '', '0.5', 'failure'),
+                                       ('', 'y', '', '', None),
+                                       ('t.a', 'z', '', '1', 'skipped')).encode())
+            assert list(timings.testcases(source)) == [
+                ('t.a::x', 't.a', 0.5, True),
+                ('y', 'y', 0.0, False),
+            ]
+
+    def describe_database():
+        def test_ingest(reports):
+            with timings.Database('t.sqlite') as database:
+                assert database.ingest(['1.xml', '2.xml'], alpha=0.5) == (2, 4, 0)
+                assert database.values(by='test') == \
+                    {'t.a::test_x': 2.0, 't.a::test_y': 2.0, 't.b::test_z': 1000.5}
+                assert database.values('failures') == {'a.py': 2, 'b.py': 0}
+                assert database.values('runs', by='file') == {'a.py': 3, 'b.py': 1}
+
+        def test_incremental(reports):
+            with timings.Database('t.sqlite') as database:
+                assert database.ingest(['1.xml'], alpha=0.5) == (1, 2, 0)
+                assert database.ingest(['1.xml', '2.xml'], alpha=0.5) == (1, 2, 1)
+                assert database.values(by='test')['t.a::test_x'] == 2.0
+                reports.join('1.xml').write(report(('t.a', 'test_x', 'a.py', '6.0', None)))
+                assert database.ingest(['1.xml', '2.xml'], alpha=0.5) == (1, 1, 1)
+                assert database.values(by='test')['t.a::test_x'] == 4.0
+
+        def test_same_as_one_by_one(reports):
+            for index in range(3):
+                reports.join('%d.xml' % (index + 3)).write(report(
+                    ('t.a', 'test_x', 'a.py', str(index * 7 % 5), None)))
+            paths = ['%d.xml' % index for index in range(1, 6)]
+            with timings.Database('all.sqlite') as database:
+                database.ingest(paths)
+                together = database.values(by='test')
+            with timings.Database('single.sqlite') as database:
+                for path in paths:
+                    database.ingest([path])
+                one_by_one = database.values(by='test')
+            assert together.keys() == one_by_one.keys()
+            for test, duration in together.items():
+                assert duration == pytest.approx(one_by_one[test])
+
+        def test_invalid_values(reports):
+            with timings.Database('t.sqlite') as database:
+                with pytest.raises(ValueError):
+                    database.values('id; DROP TABLE tests')
+
+    def describe_cli():
+        def test_ingest_and_export(reports):
+            assert parse_main(['timings', 'ingest', '--alpha', '0.5', '1.xml', '2.xml']) == \
+                'ingested 2 reports with 4 test cases, skipped 0 unchanged reports'
+            assert os.path.exists(timings.DEFAULT_DATABASE)
+            assert parse_main(['timings', 'export']) == 'a.py\t4.000\nb.py\t1000.500'
+            assert parse_main(['timings', 'export', '--by', 'test', '--failures']) == \
+                't.a::test_x\t1\nt.a::test_y\t1\nt.b::test_z\t0'
+
+        def test_export_feeds_shard(reports, capsys):
+            parse_main(['timings', 'ingest', '--db', 'x.sqlite', '1.xml', '2.xml'])
+            reports.join('timings.tsv').write(parse_main(['timings', 'export', '--db', 'x.sqlite']))
+            reports.join('tests.txt').write('a.py\nb.py\n')
+            assert parse_main(['shard', '--files', 'tests.txt', '--timings', 'timings.tsv',
+                               '--shards', '2', '--command', 'pytest']).count('command') == 2
+
+        def test_empty_export(reports):
+            assert parse_main(['timings', 'export']) is None
+
+        def test_errors(reports, capsys):
+            reports.join('broken.xml').write('<testsuite>')
+            for argv, message in [
+                    (['ingest', 'missing.xml'], 'No such file or directory'),
+                    (['ingest', 'broken.xml'], 'no element found'),
+                    (['ingest', '--alpha', '2', '1.xml'], '--alpha has to be greater than 0')]:
+                with pytest.raises(SystemExit) as excinfo:
+                    parse_main(['timings'] + argv)
+                assert message in str(excinfo.value)
+            with pytest.raises(SystemExit):
+                parse_main(['timings'])
+            assert 'required: {ingest,export}' in capsys.readouterr().err